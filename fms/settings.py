@@ -177,6 +177,16 @@ MEDIA_URL = '/media/'
 
 IMPORT_EXPORT_USE_TRANSACTIONS = True  # should it be True with reversion ?
 
+# Maximum number of data rows read from a template uploaded through the API
+TEMPLATE_MAX_ROWS = int(os.environ.get("FMS_TEMPLATE_MAX_ROWS", "10000"))
+
+# Number of seconds a successful template check can be submitted by token for
+TEMPLATE_CHECK_TOKEN_TTL = int(os.environ.get("FMS_TEMPLATE_CHECK_TOKEN_TTL", "3600"))
+
+# Number of seconds after which a running template job whose worker stopped
+# reporting is considered abandoned (e.g. the worker crashed) and queued again
+TEMPLATE_JOB_STALE_TIMEOUT = int(os.environ.get("FMS_TEMPLATE_JOB_STALE_TIMEOUT", "120"))
+
 
 # Tests
 
@@ -66,6 +66,7 @@ class ContainerForm(forms.ModelForm):
 class ContainerAdmin(AggregatedAdmin):
     form = ContainerForm
     resource_class = ContainerResource
+    autocomplete_fields = ("location",)
 
     list_display = (
         "barcode",
@@ -138,6 +139,7 @@ class SampleForm(forms.ModelForm):
 class SampleAdmin(AggregatedAdmin):
     form = SampleForm
     resource_class = SampleResource
+    autocomplete_fields = ("individual", "container", "extracted_from")
 
     list_display = (
         "sample_kind",
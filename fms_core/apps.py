@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class FmsCoreConfig(AppConfig):
     name = "fms_core"
     verbose_name = "Sample Tracking"
+
+    def ready(self):
+        # Connects the signal handlers keeping summary counts and the search index up to date
+        from . import search_index, summaries  # noqa: F401
@@ -0,0 +1,90 @@
+"""
+Conditional GETs (If-None-Match / If-Modified-Since) for list and detail
+endpoints, validated against the latest revision saved by django-reversion.
+
+Every change to an object goes through a revision, so the latest revision
+holding a version of a model tells whether anything changed since a client
+last fetched a list or detail. Deletes don't save a revision, so the number of
+objects (from the summary counts) is part of the ETag as well; Last-Modified
+can't reflect deletes, so clients should prefer If-None-Match.
+"""
+
+import hashlib
+
+from datetime import datetime
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Max, Model, OuterRef, Subquery
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from reversion.models import Version
+from typing import Iterable, Optional, Tuple, Type
+
+from .summaries import SUMMARIES_BY_MODEL, get_total_counts
+
+
+__all__ = [
+    "get_data_version",
+    "ConditionalGetMixin",
+]
+
+
+def get_data_version(models: Iterable[Type[Model]]) -> Tuple[str, Optional[datetime]]:
+    """
+    Returns a value which changes whenever objects of the given models are
+    saved or deleted, and when the latest of them was saved, if ever.
+    """
+
+    models = tuple(models)
+    content_types = ContentType.objects.get_for_models(*models).values()
+
+    latest_version = Version.objects.filter(content_type=OuterRef("pk")).order_by("-revision_id")
+    latest = ContentType.objects.filter(pk__in=[ct.pk for ct in content_types]).aggregate(
+        revision_id=Max(Subquery(latest_version.values("revision_id")[:1])),
+        date_created=Max(Subquery(latest_version.values("revision__date_created")[:1])),
+    )
+
+    counts = get_total_counts(SUMMARIES_BY_MODEL[m] for m in models if m in SUMMARIES_BY_MODEL)
+
+    return f"{latest['revision_id']}:{counts}", latest["date_created"]
+
+
+class ConditionalGetMixin:
+    """
+    Answers conditional list and retrieve requests with 304 Not Modified
+    when none of conditional_models changed, before querying or serializing
+    anything; other responses get ETag and Last-Modified headers. Models
+    whose objects are part of the representation of a view's objects, e.g.
+    the samples of a container, must be listed as well.
+    """
+
+    conditional_models: Tuple[Type[Model], ...] = ()
+
+    def _conditional_response(self, request, get_response):
+        data_version, last_modified = get_data_version(self.conditional_models)
+
+        # Representations also depend on the query and the negotiated format
+        etag = quote_etag(hashlib.md5("\n".join((
+            data_version,
+            request.get_full_path(),
+            request.accepted_renderer.media_type,
+        )).encode("utf-8")).hexdigest())
+        last_modified = None if last_modified is None else int(last_modified.timestamp())
+
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = get_response()
+
+        if response.status_code in (200, 304):
+            response["ETag"] = etag
+            if last_modified is not None:
+                response["Last-Modified"] = http_date(last_modified)
+
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self._conditional_response(request, lambda: super(ConditionalGetMixin, self).list(
+            request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        return self._conditional_response(request, lambda: super(ConditionalGetMixin, self).retrieve(
+            request, *args, **kwargs))
@@ -0,0 +1,142 @@
+"""
+Queries over the container hierarchy (the tree formed by Container.location).
+These are indexed lookups on Container.ancestors, rather than walks of the
+tree one level at a time.
+"""
+
+from django.contrib.postgres.fields import ArrayField
+from django.db.models import F, Func, IntegerField, OuterRef, Q, QuerySet, Subquery, Value
+from django.db.models.expressions import RawSQL
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .models import Container, Sample
+
+
+__all__ = [
+    "container_descendants_q",
+    "sample_descendants_q",
+    "get_container_ancestors",
+    "get_containers_by_barcode",
+    "get_container_subtree",
+    "get_container_subtree_samples",
+    "annotate_container_counts",
+]
+
+
+def container_descendants_q(pk: int, max_depth: Optional[int] = None) -> Q:
+    """
+    Filter for the containers nested within a container, at most max_depth
+    levels below it (1 for its direct children) if specified.
+    """
+
+    q = Q(ancestors__contains=[pk])
+
+    if max_depth is not None:
+        depth = Func(F("ancestors"), function="cardinality", output_field=IntegerField())
+        container_depth = Subquery(Container.objects.filter(pk=pk).annotate(depth=depth).values("depth"))
+        q &= Q(ancestors__len__lte=container_depth + Value(max_depth, output_field=IntegerField()))
+
+    return q
+
+
+def sample_descendants_q(pk: int, max_depth: Optional[int] = None) -> Q:
+    """
+    Filter for the samples stored in a container or in any container nested
+    within it, at most max_depth levels below it (0 for the samples of the
+    container itself) if specified.
+    """
+
+    containers = Q(pk=pk)
+    if max_depth is None or max_depth > 0:
+        containers |= container_descendants_q(pk, max_depth)
+    return Q(container_id__in=Container.objects.filter(containers).values("id"))
+
+
+def get_container_ancestors(pk: int, queryset: Optional[QuerySet] = None) -> Optional[List[Container]]:
+    """
+    Returns the containers a container is nested within, in order from the
+    root to its direct parent, or None if the container doesn't exist.
+    """
+
+    queryset = Container.objects.all() if queryset is None else queryset
+    ancestor_ids = RawSQL(f"SELECT unnest(ancestors) FROM {Container._meta.db_table} WHERE id = %s", (pk,))
+    containers = {c.id: c for c in queryset.filter(Q(id=pk) | Q(id__in=ancestor_ids))}
+
+    container = containers.get(pk)
+    if container is None:
+        return None
+
+    return [containers[i] for i in container.ancestors if i in containers]
+
+
+def get_containers_by_barcode(barcodes: Iterable[str], queryset: Optional[QuerySet] = None) \
+        -> Tuple[Dict[str, Container], Dict[int, Container]]:
+    """
+    Returns the containers with the given barcodes, by barcode, and all the
+    containers they are nested within, by ID, fetched in a single query.
+    Barcodes which don't exist are left out.
+    """
+
+    barcodes = list(barcodes)
+    queryset = Container.objects.all() if queryset is None else queryset
+    ancestor_ids = RawSQL(f"SELECT unnest(ancestors) FROM {Container._meta.db_table} WHERE barcode = ANY(%s)",
+                          (barcodes,))
+
+    containers = {c.id: c for c in queryset.filter(Q(barcode__in=barcodes) | Q(id__in=ancestor_ids))}
+
+    wanted = set(barcodes)
+    containers_by_barcode = {c.barcode: c for c in containers.values() if c.barcode in wanted}
+    ancestor_ids = {i for c in containers_by_barcode.values() for i in c.ancestors}
+    return containers_by_barcode, {i: c for i, c in containers.items() if i in ancestor_ids}
+
+
+def get_container_subtree(pk: int, max_depth: Optional[int] = None, queryset: Optional[QuerySet] = None) -> QuerySet:
+    """
+    Returns all containers nested within a container, at most max_depth levels
+    below it (1 for its direct children) if specified.
+    """
+    queryset = Container.objects.all() if queryset is None else queryset
+    return queryset.filter(container_descendants_q(pk, max_depth))
+
+
+def get_container_subtree_samples(pk: int, max_depth: Optional[int] = None,
+                                  queryset: Optional[QuerySet] = None) -> QuerySet:
+    """
+    Returns all samples stored in a container or in any container nested
+    within it, at most max_depth levels below it (0 for the samples of the
+    container itself) if specified.
+    """
+    queryset = Sample.objects.all() if queryset is None else queryset
+    return queryset.filter(sample_descendants_q(pk, max_depth))
+
+
+def _count(queryset: QuerySet) -> Subquery:
+    # COUNT without GROUP BY, so that there is a row (of 0) even when nothing matches
+    return Subquery(queryset.order_by().annotate(
+        count=Func(F("pk"), function="COUNT", output_field=IntegerField())).values("count"))
+
+
+def _first_ids(queryset: QuerySet, limit: int) -> Func:
+    return Func(Subquery(queryset.order_by("pk").values("pk")[:limit]), function="ARRAY",
+                output_field=ArrayField(IntegerField()))
+
+
+def annotate_container_counts(queryset: QuerySet, ids_limit: Optional[int] = None) -> QuerySet:
+    """
+    Annotates containers with the number of their children and samples
+    (children_count and samples_count), counted in the database instead of
+    fetching them. If ids_limit is given, the IDs of at most that many of
+    each, the lowest first, are annotated as well (children_ids and
+    samples_ids). Prefetches of children and samples are dropped.
+    """
+
+    children = Container.objects.filter(location=OuterRef("pk"))
+    samples = Sample.objects.filter(container=OuterRef("pk"))
+
+    queryset = queryset.prefetch_related(None).annotate(children_count=_count(children),
+                                                        samples_count=_count(samples))
+    if ids_limit is not None:
+        queryset = queryset.annotate(children_ids=_first_ids(children, ids_limit),
+                                     samples_ids=_first_ids(samples, ids_limit))
+
+    return queryset
@@ -1,5 +1,5 @@
 from typing import Dict, List, Tuple
-from .coordinates import CoordinateSpec, alphas, ints, validate_and_normalize_coordinates
+from .coordinates import CoordinateCodec, CoordinateSpec, alphas, get_coordinate_codec, ints
 
 
 __all__ = [
@@ -39,6 +39,7 @@ class ContainerSpec:
                  children: Tuple["ContainerSpec", ...]):
         self._container_kind_id = container_kind_id
         self._coordinate_spec = coordinate_spec
+        self._coordinate_codec = get_coordinate_codec(coordinate_spec)
         self._coordinate_overlap_allowed = coordinate_overlap_allowed
         self._children = children
         for c in children:
@@ -66,6 +67,14 @@ class ContainerSpec:
     def coordinate_spec(self) -> CoordinateSpec:
         return self._coordinate_spec
 
+    @property
+    def coordinate_codec(self) -> CoordinateCodec:
+        return self._coordinate_codec
+
+    @property
+    def capacity(self) -> int:
+        return self._coordinate_codec.capacity
+
     @property
     def coordinate_overlap_allowed(self) -> bool:
         return self._coordinate_overlap_allowed
@@ -82,7 +91,7 @@ class ContainerSpec:
         return next((c for c in self._children if c.container_kind_id == kind_id), None) is not None
 
     def validate_and_normalize_coordinates(self, coordinates: str) -> str:
-        return validate_and_normalize_coordinates(coordinates, self._coordinate_spec)
+        return self._coordinate_codec.normalize(coordinates)
 
     def serialize(self) -> dict:
         return {
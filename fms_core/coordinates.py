@@ -5,9 +5,12 @@ container, and can be customized to use different types of coordinate ranges.
 """
 
 
-import re
+import threading
 import unicodedata
-from typing import Tuple, Union
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import product
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
 
 
 __all__ = [
@@ -19,8 +22,15 @@ __all__ = [
     "alphas",
     "ints",
 
+    "CoordinateCodec",
+    "get_coordinate_codec",
     "validate_and_normalize_coordinates",
+
+    "CoordinateOccupancyIndex",
+    "coordinate_occupancy_index",
+    "get_coordinate_occupancy_index",
     "check_coordinate_overlap",
+    "add_coordinate_occupant",
 ]
 
 
@@ -59,31 +69,274 @@ def ints(end: int, pad_to: int = 0) -> CoordinateAxis:
     return tuple(str(i).zfill(pad_to) for i in range(1, end + 1))
 
 
+class CoordinateCodec:
+    """
+    Compiled form of a coordinate spec. Every valid set of coordinates is
+    enumerated up front (axis by axis, i.e. row-major for 2D specs) so that
+    validation is a dictionary lookup, and each set of coordinates maps to a
+    dense integer slot index in [0, capacity).
+    """
+
+    def __init__(self, spec: CoordinateSpec):
+        self._spec = spec
+        self._pattern = "^" + "".join(f"({'|'.join(s)})" for s in spec) + "$"
+        self._shape = tuple(len(axis) for axis in spec)
+        self._slots: Tuple[str, ...] = tuple("".join(c) for c in product(*spec))
+        self._slot_indices: Dict[str, int] = {}
+        for i, c in enumerate(self._slots):
+            # Keep the first slot if differently-split axis values happen to
+            # produce the same string.
+            self._slot_indices.setdefault(c, i)
+
+    @property
+    def spec(self) -> CoordinateSpec:
+        return self._spec
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self._shape
+
+    @property
+    def capacity(self) -> int:
+        """
+        Number of distinct positions in the coordinate system. A spec without
+        any axes has a single, blank position.
+        """
+        return len(self._slots)
+
+    def normalize(self, coords: str) -> str:
+        """
+        Validates a set of coordinates against the spec, returning the
+        normalized version or raising a CoordinateError if they are invalid.
+        """
+
+        # TODO: Handle padded 0s?
+
+        c = unicodedata.normalize("NFC", coords.strip())
+
+        if c not in self._slot_indices:
+            raise CoordinateError(f"Invalid coordinates {c} specified for coordinate system {self._pattern}")
+
+        return c
+
+    def to_index(self, coords: str) -> int:
+        return self._slot_indices[self.normalize(coords)]
+
+    def from_index(self, index: int) -> str:
+        if not 0 <= index < len(self._slots):
+            raise CoordinateError(f"Invalid slot index {index} specified for coordinate system {self._pattern}")
+        return self._slots[index]
+
+    def to_axes(self, coords: str) -> Tuple[int, ...]:
+        """
+        Returns the position along each axis of a set of coordinates, e.g.
+        (0, 11) for A12 in a 96-well plate.
+        """
+        index = self.to_index(coords)
+        axes = []
+        for size in reversed(self._shape):
+            index, position = divmod(index, size)
+            axes.append(position)
+        return tuple(reversed(axes))
+
+
+@lru_cache(maxsize=None)
+def get_coordinate_codec(spec: CoordinateSpec) -> CoordinateCodec:
+    return CoordinateCodec(spec)
+
+
 def validate_and_normalize_coordinates(coords: str, spec: CoordinateSpec) -> str:
     """
     Given a set of coordinates and a coordinate spec, validates if those
     coordinates are valid by the spec.
     """
+    return get_coordinate_codec(spec).normalize(coords)
+
+
+_MISSING = object()
+
+
+class CoordinateOccupancyIndex:
+    """
+    In-memory index of the coordinates occupied within a set of parent
+    containers, keyed by parent and normalized coordinates. Used to validate
+    many objects against the same parents (e.g. the rows of a template) without
+    a database query per object. Each parent's contents are loaded once, and
+    objects must be added to the index as they are accepted so that later
+    objects are also checked against them, even before they are saved.
+
+    Changes made to the index after a savepoint can be rolled back, e.g. when
+    the row of a template which added them fails and isn't imported.
+    """
+
+    def __init__(self):
+        # (model label, parent pk) -> {coordinates: occupant pk or unsaved instance}
+        self._occupied: Dict[Tuple[str, Any], Dict[str, Any]] = {}
+        # (model label, occupant pk) -> (model label, parent pk), coordinates
+        self._positions: Dict[Tuple[str, Any], Tuple[Tuple[str, Any], str]] = {}
+        # Previous values of what was changed since the first active savepoint
+        self._undo: List[Tuple[dict, Any, Any]] = []
+        self._savepoints = 0
 
-    # TODO: Handle padded 0s?
+    def _set(self, mapping: dict, key: Any, value: Any) -> None:
+        if self._savepoints:
+            self._undo.append((mapping, key, mapping.get(key, _MISSING)))
+        mapping[key] = value
 
-    c = unicodedata.normalize("NFC", coords.strip())
+    def _pop(self, mapping: dict, key: Any) -> Any:
+        value = mapping.get(key, _MISSING)
+        if value is _MISSING:
+            return None
+        if self._savepoints:
+            self._undo.append((mapping, key, value))
+        del mapping[key]
+        return value
 
-    coordinate_regex_str = "^" + "".join(f"({'|'.join(s)})" for s in spec) + "$"
-    coordinate_regex = re.compile(coordinate_regex_str)
+    def _store(self, key: Tuple[str, Any], pk: Any, coordinates: str) -> None:
+        self._set(self._occupied[key], coordinates, pk)
+        self._set(self._positions, (key[0], pk), (key, coordinates))
 
-    if not coordinate_regex.match(c):
-        raise CoordinateError(f"Invalid coordinates {c} specified for coordinate system {coordinate_regex_str}")
+    def savepoint(self) -> int:
+        """
+        Starts recording changes to the index, so that they can be rolled back
+        to this point; returns the savepoint to roll back to or release.
+        """
+        self._savepoints += 1
+        return len(self._undo)
 
-    return c
+    def rollback(self, savepoint: int) -> None:
+        """
+        Undoes the changes made to the index since the savepoint, and releases it.
+        """
+        while len(self._undo) > savepoint:
+            mapping, key, value = self._undo.pop()
+            if value is _MISSING:
+                mapping.pop(key, None)
+            else:
+                mapping[key] = value
+        self.release(savepoint)
+
+    def release(self, savepoint: int) -> None:
+        """
+        Keeps the changes made to the index since the savepoint.
+        """
+        self._savepoints -= 1
+        if not self._savepoints:
+            self._undo.clear()
+
+    def load(self, model, parent_field: str, parent_ids: Iterable[Any]) -> None:
+        """
+        Loads the occupied coordinates of any of the given parents which
+        aren't indexed yet, using a single query.
+        """
+        label = model._meta.label
+        parent_ids = {p for p in parent_ids if p is not None and (label, p) not in self._occupied}
+        if not parent_ids:
+            return
+
+        for p in parent_ids:
+            self._set(self._occupied, (label, p), {})
+
+        parent_attname = model._meta.get_field(parent_field).attname
+        for pk, parent_id, coordinates in (model.objects.filter(**{f"{parent_attname}__in": parent_ids})
+                                           .values_list("pk", parent_attname, "coordinates")):
+            self._store((label, parent_id), pk, coordinates)
+
+    def _get_occupied(self, queryset, parent) -> Optional[Dict[str, Any]]:
+        if parent.pk is None:
+            return None
+
+        key = (queryset.model._meta.label, parent.pk)
+        if key not in self._occupied:
+            self._set(self._occupied, key, {})
+            for pk, coordinates in queryset.values_list("pk", "coordinates"):
+                self._store(key, pk, coordinates)
+        return self._occupied[key]
+
+    def check(self, queryset, obj, parent, obj_type: str = "container") -> None:
+        """
+        Raises a CoordinateError if obj's coordinates are already taken by
+        another object within the parent.
+        """
+        occupied = self._get_occupied(queryset, parent)
+        if occupied is None:
+            return
+
+        occupant = occupied.get(obj.coordinates)
+        if occupant is None or occupant is obj or (obj.pk is not None and occupant == obj.pk):
+            return
+
+        # Only hit the database to describe the existing object in the error
+        existing = queryset.get(pk=occupant) if not hasattr(occupant, "_meta") else occupant
+        raise CoordinateError(f"Parent container {parent} already contains {obj_type} {existing} at "
+                              f"coordinates {obj.coordinates}")
+
+    def add(self, queryset, obj, parent) -> None:
+        """
+        Records obj as occupying its coordinates in the parent, freeing up any
+        position it previously held in the index (e.g. if it was moved.) If
+        parent is None, the object's previous position is only freed up.
+        """
+        label = obj._meta.label
+
+        if obj.pk is not None:
+            previous = self._pop(self._positions, (label, obj.pk))
+            if previous is not None and self._occupied[previous[0]].get(previous[1]) == obj.pk:
+                self._pop(self._occupied[previous[0]], previous[1])
+
+        occupied = self._get_occupied(queryset, parent) if parent is not None else None
+        if occupied is None:
+            return
+
+        if obj.pk is not None:
+            self._store((label, parent.pk), obj.pk, obj.coordinates)
+        else:
+            self._set(occupied, obj.coordinates, obj)
+
+
+_local = threading.local()
+
+
+@contextmanager
+def coordinate_occupancy_index():
+    """
+    Makes a new coordinate occupancy index active for the current thread for
+    the duration of the block; overlap checks and saves will go through it.
+    """
+    previous = getattr(_local, "index", None)
+    _local.index = CoordinateOccupancyIndex()
+    try:
+        yield _local.index
+    finally:
+        _local.index = previous
+
+
+def get_coordinate_occupancy_index() -> Optional[CoordinateOccupancyIndex]:
+    return getattr(_local, "index", None)
 
 
 def check_coordinate_overlap(queryset, obj, parent, obj_type: str = "container"):
     """
     Check for coordinate overlap with existing child containers/samples of the
     parent using a queryset, assuming that the queried model has a coordinates
-    field which specifies possibly-overlapping item locations.
+    field which specifies possibly-overlapping item locations. If a coordinate
+    occupancy index is active, it is used instead of querying the database.
     """
+    index = get_coordinate_occupancy_index()
+    if index is not None:
+        index.check(queryset, obj, parent, obj_type)
+        return
+
     existing = queryset.exclude(pk=obj.pk).get(coordinates=obj.coordinates)
     raise CoordinateError(f"Parent container {parent} already contains {obj_type} {existing} at "
                           f"coordinates {obj.coordinates}")
+
+
+def add_coordinate_occupant(queryset, obj, parent):
+    """
+    Records an accepted object in the active coordinate occupancy index, if any.
+    The queryset and parent can be None for an object without a parent.
+    """
+    index = get_coordinate_occupancy_index()
+    if index is not None:
+        index.add(queryset, obj, parent)
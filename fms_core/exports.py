@@ -0,0 +1,198 @@
+"""
+Streaming CSV and newline-delimited JSON exports for list_export actions.
+Rows are built from a queryset iterated in chunks and written out as they are
+built, so exports never hold the whole set of serialized objects in memory.
+"""
+
+import csv
+import json
+
+from django.http import StreamingHttpResponse
+from io import StringIO
+from itertools import islice
+from rest_framework.fields import SkipField
+from rest_framework.relations import PKOnlyObject
+from rest_framework.renderers import BaseRenderer
+from rest_framework.settings import api_settings
+from rest_framework.utils.encoders import JSONEncoder
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+__all__ = [
+    "EXPORT_CHUNK_SIZE",
+    "EXPORT_RENDERER_CLASSES",
+    "NDJSONRenderer",
+    "is_streaming_export",
+    "serializer_row_builder",
+    "values_row_builder",
+    "stream_export",
+]
+
+
+# Number of objects fetched from the database and written out at a time
+EXPORT_CHUNK_SIZE = 2000
+
+
+RowBuilder = Callable[[Any], List[Any]]
+
+# values() lookup and conversion of the fetched value for an export column
+ValuesField = Tuple[str, Callable[[Any], Any]]
+
+
+def _ndjson_line(data) -> str:
+    # Same encoding as the JSON renderer, one object per line
+    return json.dumps(data, cls=JSONEncoder, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+
+class NDJSONRenderer(BaseRenderer):
+    """
+    Renders a list of objects as newline-delimited JSON.
+    """
+
+    media_type = "application/x-ndjson"
+    format = "ndjson"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        if not isinstance(data, list):
+            data = [data]
+        return "".join(_ndjson_line(d) for d in data).encode(self.charset)
+
+
+EXPORT_RENDERER_CLASSES = [*api_settings.DEFAULT_RENDERER_CLASSES, NDJSONRenderer]
+
+STREAMING_EXPORT_FORMATS = frozenset({"csv", NDJSONRenderer.format})
+
+
+def is_streaming_export(request) -> bool:
+    return request.accepted_renderer.format in STREAMING_EXPORT_FORMATS
+
+
+def serializer_row_builder(serializer_class, header: Iterable[str]) -> RowBuilder:
+    """
+    Returns a function building the row for an object from the given
+    serializer's fields, in the order of the header. This does what the
+    serializer's to_representation does, without building a dictionary for
+    every object.
+    """
+
+    fields = serializer_class().fields
+    fields = [fields[f] for f in header]
+
+    def build_row(obj) -> List[Any]:
+        row = []
+        for field in fields:
+            try:
+                attribute = field.get_attribute(obj)
+            except SkipField:
+                row.append(None)
+                continue
+
+            check_for_none = attribute.pk if isinstance(attribute, PKOnlyObject) else attribute
+            row.append(None if check_for_none is None else field.to_representation(attribute))
+
+        return row
+
+    return build_row
+
+
+def _skip_none(convert: Callable[[Any], Any]) -> Callable[[Any], Any]:
+    # None values aren't converted by serializers
+    return lambda v: None if v is None else convert(v)
+
+
+def values_row_builder(serializer_class, header: Iterable[str],
+                       values_fields: Dict[str, ValuesField]) -> Tuple[List[str], RowBuilder]:
+    """
+    Returns the lookups to fetch with values_list() for the given columns, and
+    a function building rows from the tuples fetched. Serializer fields backed
+    by a model field (possibly through relationships) are looked up from their
+    source and converted by the serializer field; other fields, e.g. method
+    fields, must be given in values_fields.
+    """
+
+    fields = serializer_class().fields
+    lookups = []
+    converters = []
+
+    for name in header:
+        if name in values_fields:
+            lookup, convert = values_fields[name]
+        else:
+            field = fields[name]
+            lookup = "__".join(field.source_attrs)
+            convert = _skip_none(field.to_representation)
+
+        lookups.append(lookup)
+        converters.append(convert)
+
+    def build_row(values: tuple) -> List[Any]:
+        return [convert(v) for convert, v in zip(converters, values)]
+
+    return lookups, build_row
+
+
+def _iter_rows(queryset, build_row: RowBuilder, chunk_size: int) -> Iterator[List[List[Any]]]:
+    rows = (build_row(obj) for obj in queryset.iterator(chunk_size=chunk_size))
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _iter_csv(header: List[str], labels: Optional[dict], chunks: Iterator[List[List[Any]]],
+              encoding: str) -> Iterator[bytes]:
+    # Written the same way as by the CSV renderer; None values are left blank.
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+
+    writer.writerow([labels.get(h, h) for h in header] if labels else header)
+    for chunk in chunks:
+        writer.writerows(chunk)
+        yield buffer.getvalue().encode(encoding)
+        buffer.seek(0)
+        buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue().encode(encoding)
+
+
+def _iter_ndjson(header: List[str], chunks: Iterator[List[List[Any]]], encoding: str) -> Iterator[bytes]:
+    for chunk in chunks:
+        yield "".join(_ndjson_line(dict(zip(header, row))) for row in chunk).encode(encoding)
+
+
+def stream_export(request, queryset, serializer_class, renderer_context: dict,
+                  values_fields: Optional[Dict[str, ValuesField]] = None,
+                  chunk_size: Optional[int] = None) -> StreamingHttpResponse:
+    """
+    Streams an export of a queryset in the format negotiated for the request,
+    which must be one of the streaming export formats. Columns follow the
+    header and labels of the renderer context, as for the CSV renderer; without
+    a header, the serializer's fields are used in alphabetical order.
+
+    If values_fields is given, all columns are fetched in a single values()
+    query and rows are built from plain tuples; see values_row_builder.
+    Otherwise, rows are built from model instances.
+    """
+
+    renderer = request.accepted_renderer
+    header = list(renderer_context.get("header") or sorted(serializer_class().fields))
+
+    if values_fields is not None:
+        lookups, build_row = values_row_builder(serializer_class, header, values_fields)
+        queryset = queryset.values_list(*lookups)
+    else:
+        build_row = serializer_row_builder(serializer_class, header)
+
+    chunks = _iter_rows(queryset, build_row, chunk_size or EXPORT_CHUNK_SIZE)
+
+    if renderer.format == NDJSONRenderer.format:
+        content = _iter_ndjson(header, chunks, renderer.charset)
+    else:
+        content = _iter_csv(header, renderer_context.get("labels"), chunks, renderer.charset)
+
+    return StreamingHttpResponse(content, content_type=f"{renderer.media_type}; charset={renderer.charset}")
@@ -0,0 +1,117 @@
+"""
+Sparse fieldsets: ?fields=<name>,<name>,... limits the fields serialized for
+list and detail requests, and the columns and relations fetched to build them.
+"""
+
+from django.db.models import ManyToOneRel, Prefetch
+from django.utils.functional import cached_property
+from rest_framework.exceptions import ValidationError
+from rest_framework.relations import ManyRelatedField, PrimaryKeyRelatedField
+from typing import FrozenSet, List, Optional
+
+
+__all__ = [
+    "SparseFieldsetMixin",
+]
+
+
+def _select_related_lookups(select_related: dict, prefix: str = "") -> List[str]:
+    # Query.select_related holds lookups as a tree, e.g. {"a": {"b": {}}} for "a__b"
+    lookups = []
+    for name, nested in select_related.items():
+        lookup = f"{prefix}{name}"
+        lookups.extend(_select_related_lookups(nested, f"{lookup}__") if nested else [lookup])
+    return lookups
+
+
+class SparseFieldsetMixin:
+    """
+    Lets list and retrieve requests ask for a subset of the serializer's
+    fields with ?fields=. Only the model fields backing the requested fields
+    are loaded, and relations which aren't requested are neither joined nor
+    prefetched. Related objects only serialized by primary key aren't joined,
+    or are prefetched without any of their other columns.
+    """
+
+    fields_query_param = "fields"
+    sparse_fieldset_actions = ("list", "retrieve")
+
+    @cached_property
+    def sparse_fieldset(self) -> Optional[FrozenSet[str]]:
+        if self.action not in self.sparse_fieldset_actions:
+            return None
+
+        fields = self.request.query_params.get(self.fields_query_param, "")
+        if not fields:
+            return None
+
+        fields = frozenset(f.strip() for f in fields.split(",") if f.strip())
+        unknown = fields - set(self._get_serializer_fields())
+        if unknown:
+            raise ValidationError({self.fields_query_param: [
+                f"Unknown field{'s' if len(unknown) > 1 else ''}: {', '.join(sorted(unknown))}."]})
+
+        return fields
+
+    def _get_serializer_fields(self):
+        return self.get_serializer_class()(context=self.get_serializer_context()).fields
+
+    def get_serializer(self, *args, **kwargs):
+        serializer = super().get_serializer(*args, **kwargs)
+
+        if self.sparse_fieldset is not None:
+            fields = getattr(serializer, "child", serializer).fields
+            for name in set(fields) - self.sparse_fieldset:
+                fields.pop(name)
+
+        return serializer
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.sparse_fieldset is None:
+            return queryset
+
+        model = queryset.model
+        serializer_fields = self._get_serializer_fields()
+        requested = {}
+        for name in self.sparse_fieldset:
+            field = serializer_fields[name]
+            if not field.source_attrs:
+                return queryset  # Built from the whole object, so nothing can be left out
+            requested[field.source_attrs[0]] = field
+
+        model_fields = {f.name: f for f in model._meta.get_fields()}
+        if not set(requested) <= set(model_fields):
+            return queryset  # Built from properties or methods, which may use any field
+
+        only = [model._meta.pk.name, *(n for n in requested if model_fields[n].concrete)]
+
+        select_related = queryset.query.select_related
+        if isinstance(select_related, dict):
+            # Related objects serialized by primary key only need the foreign key
+            select_related = [
+                lookup for lookup in _select_related_lookups(select_related)
+                if lookup.split("__")[0] in requested
+                and not isinstance(requested[lookup.split("__")[0]], PrimaryKeyRelatedField)
+            ]
+            queryset = queryset.select_related(None)
+            if select_related:  # select_related() without lookups would follow every foreign key
+                queryset = queryset.select_related(*select_related)
+
+        prefetch_related = []
+        for lookup in queryset._prefetch_related_lookups:
+            name = getattr(lookup, "prefetch_to", lookup).split("__")[0]
+            if name not in requested:
+                continue
+
+            field, relation = requested[name], model_fields[name]
+            if isinstance(lookup, str) and lookup == name and isinstance(relation, ManyToOneRel) \
+                    and isinstance(field, ManyRelatedField) \
+                    and isinstance(field.child_relation, PrimaryKeyRelatedField):
+                related_model = relation.related_model
+                lookup = Prefetch(lookup, queryset=related_model.objects.only(
+                    related_model._meta.pk.name, relation.field.name))
+
+            prefetch_related.append(lookup)
+
+        return queryset.prefetch_related(None).prefetch_related(*prefetch_related).only(*only)
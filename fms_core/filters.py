@@ -0,0 +1,34 @@
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import BaseFilterBackend
+from rest_framework.settings import api_settings
+
+
+__all__ = [
+    "AncestorFilterBackend",
+    "ANCESTOR_FILTER_BACKENDS",
+]
+
+
+class AncestorFilterBackend(BaseFilterBackend):
+    """
+    Filters a list down to what is stored within a given container, at any
+    depth, with ?ancestor=<container ID>. Views must set ancestor_filter to a
+    function returning the filter for a container ID; see container_hierarchy.
+    """
+
+    ancestor_query_param = "ancestor"
+
+    def filter_queryset(self, request, queryset, view):
+        ancestor = request.query_params.get(self.ancestor_query_param, "")
+        ancestor_filter = getattr(view, "ancestor_filter", None)
+
+        if ancestor == "" or ancestor_filter is None:
+            return queryset
+
+        if not ancestor.isdigit():
+            raise ValidationError({self.ancestor_query_param: ["Enter a whole number."]})
+
+        return queryset.filter(ancestor_filter(int(ancestor)))
+
+
+ANCESTOR_FILTER_BACKENDS = [*api_settings.DEFAULT_FILTER_BACKENDS, AncestorFilterBackend]
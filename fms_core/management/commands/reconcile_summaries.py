@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from ...summaries import reconcile_summaries
+
+
+class Command(BaseCommand):
+    help = "Recompute dashboard summary counts and correct any which have drifted; meant to be run periodically"
+
+    def handle(self, *args, **options):
+        corrections = reconcile_summaries()
+
+        for (summary, dimension, value), (previous, count) in sorted(corrections.items()):
+            self.stdout.write(f"Corrected {summary} {dimension}{f' {value!r}' if value else ''}: {previous} -> {count}")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Summary counts reconciled ({len(corrections)} correction{'' if len(corrections) == 1 else 's'})."))
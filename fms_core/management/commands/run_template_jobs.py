@@ -0,0 +1,38 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...models import TemplateImportJob
+from ...template_jobs import claim_next_job, run_job
+
+
+class Command(BaseCommand):
+    help = "Run queued template submissions"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true",
+                            help="run every queued job and exit, instead of waiting for new jobs")
+        parser.add_argument("--interval", type=float, default=5.0,
+                            help="number of seconds to wait between checks for new jobs")
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.SUCCESS("Started template job worker."))
+
+        while True:
+            job = claim_next_job()
+
+            if job is None:
+                if options["once"]:
+                    break
+                time.sleep(options["interval"])
+                continue
+
+            self.stdout.write(f"Running template job {job.id} ({job.viewset} action {job.action}).")
+            run_job(job)
+
+            if job.status == TemplateImportJob.STATUS_SUCCEEDED:
+                self.stdout.write(self.style.SUCCESS(f"Template job {job.id} succeeded."))
+            else:
+                self.stdout.write(self.style.ERROR(f"Template job {job.id} failed."))
+
+        self.stdout.write(self.style.SUCCESS("No more template jobs to run."))
@@ -1,18 +1,91 @@
 # Generated by Django 3.1 on 2021-02-17 22:15
 
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+import django.contrib.postgres.operations
 from django.db import migrations, models
 import django.utils.timezone
 import django.db.models.deletion
 import json
+from django.conf import settings
 
 SAMPLE_KINDS = ['DNA', 'RNA', 'BLOOD', 'CELLS', 'EXPECTORATION', 'GARGLE', 'PLASMA', 'SALIVA', 'SWAB']
 
 def create_pg_fzy(apps, schema_editor):
-    schema_editor.execute("CREATE EXTENSION fzy;")
+    # Global search uses an in-process index instead where fzy isn't available
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'fzy'")
+        if cursor.fetchone() is None:
+            return
+    schema_editor.execute("CREATE EXTENSION IF NOT EXISTS fzy;")
 
 def drop_pg_fzy(apps, schema_editor):
     schema_editor.execute("DROP EXTENSION IF EXISTS fzy;")
 
+# Fills in the hierarchy index of existing containers, from the roots down
+FILL_CONTAINER_ANCESTORS = """
+WITH RECURSIVE tree(id, ancestors) AS (
+    SELECT id, ARRAY[]::integer[] FROM fms_core_container WHERE location_id IS NULL
+    UNION ALL
+    SELECT c.id, t.ancestors || c.location_id FROM fms_core_container c JOIN tree t ON c.location_id = t.id
+)
+UPDATE fms_core_container c SET ancestors = tree.ancestors FROM tree WHERE c.id = tree.id;
+"""
+
+# Fills in the running counts for dashboard summaries from existing objects
+FILL_SUMMARY_COUNTS = """
+INSERT INTO fms_core_summarycount (summary, dimension, value, count)
+SELECT 'sample', 'total_count', '', COUNT(*) FROM fms_core_sample
+UNION ALL
+SELECT 'sample', 'extracted_count', '', COUNT(extracted_from_id) FROM fms_core_sample
+UNION ALL
+SELECT 'sample', 'kinds_counts', k.name, COUNT(*)
+FROM fms_core_sample s JOIN fms_core_samplekind k ON k.id = s.sample_kind_id GROUP BY k.name
+UNION ALL
+SELECT 'sample', 'tissue_source_counts', tissue_source, COUNT(*) FROM fms_core_sample GROUP BY tissue_source
+UNION ALL
+SELECT 'sample', 'collection_site_counts', collection_site, COUNT(*) FROM fms_core_sample GROUP BY collection_site
+UNION ALL
+SELECT 'sample', 'experimental_group_counts', g.value, COUNT(*)
+FROM fms_core_sample s CROSS JOIN LATERAL jsonb_array_elements_text(s.experimental_group) AS g(value)
+WHERE jsonb_typeof(s.experimental_group) = 'array' GROUP BY g.value
+UNION ALL
+SELECT 'container', 'total_count', '', COUNT(*) FROM fms_core_container
+UNION ALL
+SELECT 'container', 'root_count', '', COUNT(*) FROM fms_core_container WHERE location_id IS NULL
+UNION ALL
+SELECT 'container', 'kind_counts', kind, COUNT(*) FROM fms_core_container GROUP BY kind;
+"""
+
+SEARCH_TRIGRAM_INDEXES = """
+CREATE INDEX fms_core_container_name_trgm ON fms_core_container USING gin (UPPER(name::text) gin_trgm_ops);
+CREATE INDEX fms_core_individual_name_trgm ON fms_core_individual USING gin (UPPER(name::text) gin_trgm_ops);
+CREATE INDEX fms_core_sample_name_trgm ON fms_core_sample USING gin (UPPER(name::text) gin_trgm_ops);
+CREATE INDEX fms_core_user_search_trgm ON auth_user USING gin (
+    UPPER(username::text) gin_trgm_ops, UPPER(first_name::text) gin_trgm_ops, UPPER(last_name::text) gin_trgm_ops);
+"""
+
+DROP_SEARCH_TRIGRAM_INDEXES = """
+DROP INDEX IF EXISTS fms_core_container_name_trgm;
+DROP INDEX IF EXISTS fms_core_individual_name_trgm;
+DROP INDEX IF EXISTS fms_core_sample_name_trgm;
+DROP INDEX IF EXISTS fms_core_user_search_trgm;
+"""
+
+AUTOCOMPLETE_PREFIX_INDEXES = """
+CREATE INDEX fms_core_container_name_prefix ON fms_core_container (UPPER(name::text) text_pattern_ops);
+CREATE INDEX fms_core_container_barcode_prefix ON fms_core_container (UPPER(barcode::text) text_pattern_ops);
+CREATE INDEX fms_core_individual_name_prefix ON fms_core_individual (UPPER(name::text) text_pattern_ops);
+CREATE INDEX fms_core_sample_name_prefix ON fms_core_sample (UPPER(name::text) text_pattern_ops);
+"""
+
+DROP_AUTOCOMPLETE_PREFIX_INDEXES = """
+DROP INDEX IF EXISTS fms_core_container_name_prefix;
+DROP INDEX IF EXISTS fms_core_container_barcode_prefix;
+DROP INDEX IF EXISTS fms_core_individual_name_prefix;
+DROP INDEX IF EXISTS fms_core_sample_name_prefix;
+"""
+
 
 class Migration(migrations.Migration):
     def create_sample_kinds(apps, schema_editor):
@@ -55,7 +128,9 @@ class Migration(migrations.Migration):
 
 
     dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
         ('fms_core', '0013_v3_0_1'),
+        ('reversion', '0001_squashed_0004_auto_20160611_1202'),
     ]
 
     operations = [
@@ -148,4 +223,92 @@ class Migration(migrations.Migration):
             old_name='reception_date',
             new_name='creation_date',
         ),
+
+        # Queue for template submissions imported in the background
+        migrations.CreateModel(
+            name='TemplateImportJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('viewset', models.CharField(help_text='Name of the viewset the template action belongs to.', max_length=100)),
+                ('action', models.PositiveIntegerField(help_text="Index of the template action within the viewset's actions.")),
+                ('template', models.FileField(help_text='Submitted template file.', upload_to='template_jobs/')),
+                ('preamble_skipped', models.BooleanField(default=False, help_text='Whether the template file was saved without its preamble.')),
+                ('token', models.CharField(blank=True, db_index=True, help_text='Token returned by the template check, to submit the checked template with.', max_length=32)),
+                ('template_hash', models.CharField(blank=True, help_text='SHA-256 digest of the template file which was checked.', max_length=64)),
+                ('status', models.CharField(choices=[('checked', 'checked'), ('queued', 'queued'), ('running', 'running'), ('succeeded', 'succeeded'), ('failed', 'failed')], default='queued', help_text='Current status of the import.', max_length=20)),
+                ('rows_total', models.PositiveIntegerField(default=0, help_text='Number of rows in the template.')),
+                ('rows_processed', models.PositiveIntegerField(default=0, help_text='Number of rows imported so far.')),
+                ('result', models.JSONField(blank=True, default=dict, help_text='Errors encountered during the import, if any.')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('heartbeat_at', models.DateTimeField(blank=True, help_text='Last time the worker running the job reported it was alive.', null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('created_by', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='template_import_jobs', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+
+        # Container hierarchy index
+        migrations.AddField(
+            model_name='container',
+            name='ancestors',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), blank=True, default=list, editable=False, help_text='IDs of the containers this container is nested within, from the root down to its location.', size=None),
+        ),
+        migrations.RunSQL(
+            FILL_CONTAINER_ANCESTORS,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddIndex(
+            model_name='container',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['ancestors'], name='fms_core_container_anc_gin'),
+        ),
+
+        # Running counts for dashboard summaries
+        migrations.CreateModel(
+            name='SummaryCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('summary', models.CharField(help_text='Summary the count belongs to.', max_length=20)),
+                ('dimension', models.CharField(help_text='Summary figure the count is for.', max_length=40)),
+                ('value', models.CharField(blank=True, help_text='Value the objects are counted for, or blank for overall counts.', max_length=200)),
+                ('count', models.BigIntegerField(default=0, help_text='Number of objects.')),
+            ],
+            options={
+                'unique_together': {('summary', 'dimension', 'value')},
+            },
+        ),
+        migrations.RunSQL(
+            FILL_SUMMARY_COUNTS,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.CreateModel(
+            name='SummaryCountChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('summary', models.CharField(help_text='Summary the count belongs to.', max_length=20)),
+                ('dimension', models.CharField(help_text='Summary figure the count is for.', max_length=40)),
+                ('value', models.CharField(blank=True, help_text='Value the objects are counted for, or blank for overall counts.', max_length=200)),
+                ('count', models.BigIntegerField(help_text='Number of objects added to the count (negative if removed).')),
+            ],
+        ),
+
+        # Latest revision holding a version of each model, for conditional GETs
+        migrations.RunSQL(
+            "CREATE INDEX fms_core_version_ct_revision ON reversion_version (content_type_id, revision_id);",
+            reverse_sql="DROP INDEX IF EXISTS fms_core_version_ct_revision;",
+        ),
+
+        # Trigram indexes for substring searches of names, including the
+        # candidates of global search; Django's icontains lookup compares
+        # UPPER(<field>::text), so that's what is indexed.
+        django.contrib.postgres.operations.TrigramExtension(),
+        migrations.RunSQL(
+            SEARCH_TRIGRAM_INDEXES,
+            reverse_sql=DROP_SEARCH_TRIGRAM_INDEXES,
+        ),
+
+        # Prefix indexes for autocompletion (case-insensitive LIKE 'prefix%')
+        migrations.RunSQL(
+            AUTOCOMPLETE_PREFIX_INDEXES,
+            reverse_sql=DROP_AUTOCOMPLETE_PREFIX_INDEXES,
+        ),
     ]
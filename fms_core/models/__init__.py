@@ -7,9 +7,11 @@ from .individual import Individual
 from .sample import Sample
 from .sample_kind import SampleKind
 from .sample_update import SampleUpdate
+from .summary_count import SummaryCount, SummaryCountChange
 from .protocol import Protocol
 from .process import Process
 from .process_by_sample import ProcessBySample
+from .template_import_job import TemplateImportJob
 
 __all__ = [
     "Container",
@@ -21,7 +23,10 @@ __all__ = [
     "Sample",
     "SampleKind",
     "SampleUpdate",
+    "SummaryCount",
+    "SummaryCountChange",
     "Protocol",
     "Process",
-    "ProcessBySample"
+    "ProcessBySample",
+    "TemplateImportJob",
 ]
@@ -1,14 +1,18 @@
 import reversion
 
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
 from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models.expressions import RawSQL
+from typing import List
 
 from ..containers import (
     CONTAINER_KIND_SPECS,
     CONTAINER_KIND_CHOICES,
     PARENT_CONTAINER_KINDS,
 )
-from ..coordinates import CoordinateError, check_coordinate_overlap
+from ..coordinates import CoordinateError, add_coordinate_occupant, check_coordinate_overlap
 from ..utils import str_cast_and_normalize
 
 from ._constants import BARCODE_NAME_FIELD_LENGTH
@@ -19,7 +23,8 @@ from ._validators import name_validator, container_barcode_validator
 __all__ = ["Container"]
 
 
-@reversion.register()
+# The ancestors index is derived from locations, so it isn't versioned
+@reversion.register(exclude=("ancestors",))
 class Container(models.Model):
     """ Class to store information about a sample. """
 
@@ -46,13 +51,46 @@ class Container(models.Model):
     coordinates = models.CharField(max_length=20, blank=True,
                                    help_text="Coordinates of this container within the parent container.")
 
+    # Hierarchy index: IDs of all the containers this container is nested
+    # within, from the root to its location. Kept up to date on save; deletes
+    # don't affect it, since containers with children can't be deleted.
+    ancestors = ArrayField(models.IntegerField(), default=list, blank=True, editable=False,
+                           help_text="IDs of the containers this container is nested within, from the root down to "
+                                     "its location.")
+
     comment = models.TextField(blank=True, help_text="Other relevant information about the container.")
     update_comment = models.TextField(blank=True, help_text="Comment describing the latest updates made to the "
                                                             "container. Change this whenever updates are made.")
 
+    class Meta:
+        indexes = [
+            GinIndex(fields=["ancestors"], name="fms_core_container_anc_gin"),
+        ]
+
     def __str__(self):
         return self.barcode
 
+    def get_ancestors_from_location(self) -> List[int]:
+        location = self.location
+        return [] if location is None else [*location.ancestors, location.id]
+
+    def update_ancestors(self) -> bool:
+        """
+        Sets the hierarchy index of the container from its location (which
+        must be up to date itself), returning whether it changed. Containers
+        created without save() (e.g. with bulk_create) must call this first.
+        """
+        ancestors = self.get_ancestors_from_location()
+        changed = ancestors != self.ancestors
+        self.ancestors = ancestors
+        return changed
+
+    def _update_descendant_ancestors(self):
+        # Descendants keep the part of their ancestors from this container down,
+        # below this container's new ancestors.
+        Container.objects.filter(ancestors__contains=[self.pk]).update(ancestors=RawSQL(
+            "%s::integer[] || ancestors[array_position(ancestors, %s):]", (self.ancestors, self.pk)))
+
     def normalize(self):
         # Normalize any string values to make searching / data manipulation easier
         self.kind = str_cast_and_normalize(self.kind).lower()
@@ -78,7 +116,7 @@ class Container(models.Model):
             add_error("coordinates", "Cannot specify coordinates in non-specified container")
 
         if self.location is not None:
-            if self.location.barcode == self.barcode:
+            if self.location.barcode == self.barcode or (self.pk is not None and self.pk in self.location.ancestors):
                 add_error("location", "Container cannot contain itself")
 
             else:
@@ -116,4 +154,10 @@ class Container(models.Model):
         # Normalize and validate before saving, always!
         self.normalize()
         self.full_clean()
+        moved = self.update_ancestors() and self.pk is not None
         super().save(*args, **kwargs)  # Save the object
+        if moved:
+            self._update_descendant_ancestors()
+        # Keep any bulk overlap check going on up to date with the new position
+        location = self.location
+        add_coordinate_occupant(location.children if location is not None else None, self, location)
@@ -12,7 +12,7 @@ from ..containers import (
     CONTAINER_KIND_SPECS,
     SAMPLE_CONTAINER_KINDS,
 )
-from ..coordinates import CoordinateError, check_coordinate_overlap
+from ..coordinates import CoordinateError, add_coordinate_occupant, check_coordinate_overlap
 from ..schema_validators import JsonSchemaValidator, VOLUME_VALIDATOR, EXPERIMENTAL_GROUP_SCHEMA
 from ..utils import float_to_decimal, str_cast_and_normalize
 
@@ -317,7 +317,7 @@ class Sample(models.Model):
 
             #  - Currently, extractions can only output tubes in a TUBE_RACK_8X12
             #    Only run this check when the object is first created - it can be updated later if it's moved elsewhere.
-            if not Sample.objects.filter(id=self.id).exists() and self.extracted_from is not None and any((
+            if self.extracted_from is not None and not Sample.objects.filter(id=self.id).exists() and any((
                     parent_spec != CONTAINER_SPEC_TUBE,
                     self.container.location is None,
                     CONTAINER_KIND_SPECS[self.container.location.kind] != CONTAINER_SPEC_TUBE_RACK_8X12
@@ -331,7 +331,6 @@ class Sample(models.Model):
                 except CoordinateError as e:
                     add_error("container", str(e))
 
-            # TODO: This isn't performant for bulk ingestion
             # - Check for coordinate overlap with existing child containers of the parent
             if not errors.get("container") and not parent_spec.coordinate_overlap_allowed:
                 try:
@@ -350,3 +349,6 @@ class Sample(models.Model):
         self.normalize()
         self.full_clean()
         super().save(*args, **kwargs)  # Save the object
+        # Keep any bulk overlap check going on up to date with the new position
+        container = self.container if self.container_id is not None else None
+        add_coordinate_occupant(container.samples if container is not None else None, self, container)
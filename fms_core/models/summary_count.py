@@ -0,0 +1,38 @@
+from django.db import models
+
+__all__ = [
+    "SummaryCount",
+    "SummaryCountChange",
+]
+
+
+class SummaryCount(models.Model):
+    """ Running count of objects for a dashboard summary; kept up to date by fms_core.summaries. """
+
+    summary = models.CharField(max_length=20, help_text="Summary the count belongs to.")
+    dimension = models.CharField(max_length=40, help_text="Summary figure the count is for.")
+    value = models.CharField(max_length=200, blank=True,
+                             help_text="Value the objects are counted for, or blank for overall counts.")
+    count = models.BigIntegerField(default=0, help_text="Number of objects.")
+
+    class Meta:
+        unique_together = ("summary", "dimension", "value")
+
+    def __str__(self):
+        return f"{self.summary} {self.dimension} {self.value}: {self.count}"
+
+
+class SummaryCountChange(models.Model):
+    """
+    Change to a running count, not yet added to its SummaryCount; only ever
+    inserted by writers, and folded into the counts by fms_core.summaries.
+    """
+
+    summary = models.CharField(max_length=20, help_text="Summary the count belongs to.")
+    dimension = models.CharField(max_length=40, help_text="Summary figure the count is for.")
+    value = models.CharField(max_length=200, blank=True,
+                             help_text="Value the objects are counted for, or blank for overall counts.")
+    count = models.BigIntegerField(help_text="Number of objects added to the count (negative if removed).")
+
+    def __str__(self):
+        return f"{self.summary} {self.dimension} {self.value}: {self.count:+}"
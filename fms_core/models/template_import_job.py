@@ -0,0 +1,52 @@
+from django.contrib.auth.models import User
+from django.db import models
+
+__all__ = ["TemplateImportJob"]
+
+
+class TemplateImportJob(models.Model):
+    """
+    Queued template submission, imported in the background by the
+    run_template_jobs command; or successfully checked template, kept until
+    it is submitted with its token.
+    """
+
+    STATUS_CHECKED = "checked"
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_SUCCEEDED = "succeeded"
+    STATUS_FAILED = "failed"
+
+    STATUS_CHOICES = (
+        (STATUS_CHECKED, STATUS_CHECKED),
+        (STATUS_QUEUED, STATUS_QUEUED),
+        (STATUS_RUNNING, STATUS_RUNNING),
+        (STATUS_SUCCEEDED, STATUS_SUCCEEDED),
+        (STATUS_FAILED, STATUS_FAILED),
+    )
+
+    viewset = models.CharField(max_length=100, help_text="Name of the viewset the template action belongs to.")
+    action = models.PositiveIntegerField(help_text="Index of the template action within the viewset's actions.")
+    template = models.FileField(upload_to="template_jobs/", help_text="Submitted template file.")
+    preamble_skipped = models.BooleanField(default=False,
+                                           help_text="Whether the template file was saved without its preamble.")
+    token = models.CharField(max_length=32, blank=True, db_index=True,
+                             help_text="Token returned by the template check, to submit the checked template with.")
+    template_hash = models.CharField(max_length=64, blank=True,
+                                     help_text="SHA-256 digest of the template file which was checked.")
+
+    status = models.CharField(choices=STATUS_CHOICES, max_length=20, default=STATUS_QUEUED,
+                              help_text="Current status of the import.")
+    rows_total = models.PositiveIntegerField(default=0, help_text="Number of rows in the template.")
+    rows_processed = models.PositiveIntegerField(default=0, help_text="Number of rows imported so far.")
+    result = models.JSONField(default=dict, blank=True, help_text="Errors encountered during the import, if any.")
+
+    created_by = models.ForeignKey(User, null=True, on_delete=models.SET_NULL, related_name="template_import_jobs")
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True,
+                                        help_text="Last time the worker running the job reported it was alive.")
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return str(self.id)
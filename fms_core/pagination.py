@@ -0,0 +1,203 @@
+"""
+Keyset ("cursor") pagination for large lists, which can be opted into with the
+cursor query parameter on views which use LimitOffsetOrCursorPagination.
+"""
+
+import json
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+from collections import OrderedDict
+from django.db.models import F, Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+from typing import Any, List, Optional, Tuple
+
+from .utils import check_truth_like
+
+
+__all__ = [
+    "LimitOffsetOrCursorPagination",
+]
+
+
+# Ordering of the page, as (annotation name, descending) pairs
+KeysetOrdering = List[Tuple[str, bool]]
+
+
+class LimitOffsetOrCursorPagination(LimitOffsetPagination):
+    """
+    Limit/offset pagination, unless the cursor query parameter is present (it
+    can be left empty to get the first page.) In that case, pages are fetched
+    by filtering on the values of the ordering fields of the last row seen
+    rather than by skipping rows, so the time it takes to get a page doesn't
+    depend on its depth. The ordering from the ordering query parameter is
+    kept, with the primary key added to break ties.
+
+    The total count is only computed in cursor mode if count=true is passed.
+    """
+
+    cursor_query_param = "cursor"
+    count_query_param = "count"
+    invalid_cursor_message = "Invalid cursor"
+
+    def __init__(self):
+        self.cursor_mode = False
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.cursor_query_param not in request.query_params:
+            return super().paginate_queryset(queryset, request, view)
+
+        self.cursor_mode = True
+        self.request = request
+        self.limit = self.get_limit(request)
+        self.count = self.get_count(queryset) \
+            if check_truth_like(request.query_params.get(self.count_query_param, "")) else None
+
+        position, reverse = self.decode_cursor(request)
+        queryset, ordering = self._get_keyset_queryset(queryset)
+
+        if reverse:
+            ordering = [(key, not descending) for key, descending in ordering]
+
+        queryset = queryset.order_by(*(
+            F(key).desc(nulls_first=True) if descending else F(key).asc(nulls_last=True)
+            for key, descending in ordering
+        ))
+
+        if position is not None:
+            if len(position) != len(ordering):
+                raise NotFound(self.invalid_cursor_message)
+            queryset = queryset.filter(_keyset_after(ordering, position))
+
+        # Fetch an extra row to find out if there is a page after this one
+        page = list(queryset[:self.limit + 1])
+        has_more = len(page) > self.limit
+        page = page[:self.limit]
+
+        if reverse:
+            page.reverse()
+
+        keys = [key for key, _ in ordering]
+        first = [getattr(page[0], key) for key in keys] if page else None
+        last = [getattr(page[-1], key) for key in keys] if page else None
+
+        # Without any rows, the cursor received can still be used to go back
+        self.next_position = None
+        self.previous_position = None
+        if reverse:
+            self.next_position = last if page else position
+            self.previous_position = first if has_more else None
+        else:
+            self.next_position = last if has_more else None
+            self.previous_position = (first if page else position) if position is not None else None
+
+        return page
+
+    def get_paginated_response(self, data):
+        if not self.cursor_mode:
+            return super().get_paginated_response(data)
+
+        return Response(OrderedDict((
+            *((("count", self.count),) if self.count is not None else ()),
+            ("next", self.get_next_link()),
+            ("previous", self.get_previous_link()),
+            ("results", data),
+        )))
+
+    def get_next_link(self):
+        if not self.cursor_mode:
+            return super().get_next_link()
+        if self.next_position is None:
+            return None
+        return self.encode_cursor(self.next_position, reverse=False)
+
+    def get_previous_link(self):
+        if not self.cursor_mode:
+            return super().get_previous_link()
+        if self.previous_position is None:
+            return None
+        return self.encode_cursor(self.previous_position, reverse=True)
+
+    def decode_cursor(self, request) -> Tuple[Optional[list], bool]:
+        encoded = request.query_params[self.cursor_query_param]
+        if not encoded:
+            return None, False
+
+        try:
+            cursor = json.loads(urlsafe_b64decode(encoded.encode("ascii")))
+            position = cursor["p"]
+            reverse = bool(cursor.get("r", False))
+        except (BinasciiError, KeyError, TypeError, UnicodeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+        if not isinstance(position, list):
+            raise NotFound(self.invalid_cursor_message)
+
+        return position, reverse
+
+    def encode_cursor(self, position: list, reverse: bool) -> str:
+        cursor = {"p": position, **({"r": True} if reverse else {})}
+        encoded = urlsafe_b64encode(json.dumps(cursor, default=str).encode("ascii")).decode("ascii")
+
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+        url = remove_query_param(url, self.offset_query_param)
+        return replace_query_param(url, self.cursor_query_param, encoded)
+
+    @staticmethod
+    def _get_keyset_queryset(queryset) -> Tuple[Any, KeysetOrdering]:
+        """
+        Annotates a queryset with the values of its ordering fields, so that
+        fields spanning relationships can be read from the rows and filtered
+        on the same way as local fields.
+        """
+
+        pk_name = queryset.model._meta.pk.name
+        annotations = {}
+        ordering = []
+
+        for field in (*(queryset.query.order_by or queryset.model._meta.ordering), "pk"):
+            if not isinstance(field, str) or field == "?":
+                continue
+
+            descending = field.startswith("-")
+            field = field.lstrip("-")
+
+            key = f"keyset_{len(ordering)}"
+            annotations[key] = F(field)
+            ordering.append((key, descending))
+
+            if field in ("pk", pk_name):
+                # Unique, so any fields after it would never be compared
+                break
+
+        return queryset.annotate(**annotations), ordering
+
+
+def _keyset_after(ordering: KeysetOrdering, position: list) -> Q:
+    """
+    Builds a filter for the rows which come after the given position, i.e.
+    (a > x) OR (a = x AND b > y) OR ... Nulls are sorted last in ascending
+    order and first in descending order, as Postgres does by default.
+    """
+
+    after = Q(pk__in=[])
+    equal = Q()
+
+    for (key, descending), value in zip(ordering, position):
+        if value is None:
+            key_after = Q(**{f"{key}__isnull": False}) if descending else Q(pk__in=[])
+            key_equal = Q(**{f"{key}__isnull": True})
+        else:
+            key_after = Q(**{f"{key}__{'lt' if descending else 'gt'}": value})
+            if not descending:
+                key_after |= Q(**{f"{key}__isnull": True})
+            key_equal = Q(**{key: value})
+
+        after |= equal & key_after
+        equal &= key_equal
+
+    return after
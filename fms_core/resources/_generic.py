@@ -1,13 +1,78 @@
 import reversion
+import traceback
 
+from django.db import IntegrityError, transaction
 from import_export import resources
-from reversion.models import Version
+from import_export.results import RowResult
+
+from ..coordinates import coordinate_occupancy_index, get_coordinate_occupancy_index
+from ..summaries import counting_changes
+from ._utils import add_bulk_to_revision
 
 
 class GenericResource(resources.ModelResource):
     clean_model_instances = True
     skip_unchanged = True
 
+    # Number of rows before the header row in this resource's template
+    preamble_rows = 0
+
+    # Comment for the revision created by an import; if not set, one is picked
+    # based on whether the import created any new objects.
+    revision_comment = None
+
+    def __init__(self):
+        super().__init__()
+        self._bulk_error = None
+
+        # Row (and its result) which queued each instance for bulk saving, and
+        # the instances which then couldn't be saved, with what went wrong.
+        self._bulk_rows = {}
+        self._bulk_row_errors = []
+
+        # Optionally called with the row number after each row is imported
+        self.progress_callback = None
+
+    def import_data(self, *args, **kwargs):
+        self._bulk_rows.clear()
+        self._bulk_row_errors.clear()
+
+        # Check coordinate overlaps against an in-memory index for the whole
+        # import, rather than querying the parent container for every row.
+        with coordinate_occupancy_index():
+            return super().import_data(*args, **kwargs)
+
+    def _rollback_row(self, index, savepoint, pending) -> None:
+        if index is not None:
+            index.rollback(savepoint)
+        # Instances queued for bulk saving by the failed row aren't saved either
+        del self.create_instances[pending[0]:]
+        del self.update_instances[pending[1]:]
+
+    def import_row(self, row, instance_loader, **kwargs):
+        # Positions taken by a row which fails are freed up again, since the
+        # row isn't imported; later rows mustn't be reported as overlapping it.
+        index = get_coordinate_occupancy_index()
+        savepoint = index.savepoint() if index is not None else None
+        pending = (len(self.create_instances), len(self.update_instances))
+
+        try:
+            row_result = super().import_row(row, instance_loader, **kwargs)
+        except Exception:
+            self._rollback_row(index, savepoint, pending)
+            raise
+
+        if row_result.errors or row_result.validation_error is not None:
+            self._rollback_row(index, savepoint, pending)
+        else:
+            if index is not None:
+                index.release(savepoint)
+            for instance in (*self.create_instances[pending[0]:], *self.update_instances[pending[1]:]):
+                self._bulk_rows[id(instance)] = (row_result, row)
+        if self.progress_callback is not None:
+            self.progress_callback(kwargs.get("row_number"))
+        return row_result
+
     def save_instance(self, instance, using_transactions=True, dry_run=False):
         if dry_run:
             with reversion.create_revision(manage_manually=True):
@@ -17,7 +82,75 @@ class GenericResource(resources.ModelResource):
 
         super().save_instance(instance, using_transactions, dry_run)
 
-    def after_save_instance(self, instance, using_transactions, dry_run):
-        if not dry_run:
-            versions = Version.objects.get_for_object(instance)
-            reversion.set_comment("Updated from template." if len(versions) >= 1 else "Imported from template.")
+    def _save_in_bulk(self, instances, save_all, save_one, using_transactions, dry_run, raise_errors, fields=None):
+        # django-import-export only logs errors raised while persisting a batch
+        # unless raise_errors is set, which would report a failed import as a
+        # success. Hold on to the error so after_import can surface it instead.
+        # Nothing is written on dry runs outside of a transaction, so nothing is counted either
+        counted = instances if using_transactions or not dry_run else ()
+        failed = set()
+        try:
+            try:
+                with transaction.atomic(), counting_changes(counted, fields):
+                    save_all()
+            except IntegrityError:
+                # Some instance conflicts with data written since it was
+                # validated; save them one at a time to find out which, so
+                # that the error is reported on the row it comes from.
+                with counting_changes(counted, fields):
+                    for instance in instances:
+                        try:
+                            with transaction.atomic():
+                                save_one(instance)
+                        except IntegrityError as e:
+                            if raise_errors:
+                                raise e
+                            self._bulk_row_errors.append((instance, e, traceback.format_exc()))
+                            failed.add(id(instance))
+        except Exception as e:
+            self._bulk_error = e
+            if raise_errors:
+                raise e
+            return
+        add_bulk_to_revision((i for i in instances if id(i) not in failed), dry_run)
+
+    def bulk_create(self, using_transactions, dry_run, raise_errors, batch_size=None):
+        instances = tuple(self.create_instances)
+        self._save_in_bulk(
+            instances,
+            lambda: super(GenericResource, self).bulk_create(using_transactions, dry_run, True, batch_size),
+            lambda i: self._meta.model.objects.bulk_create([i]),
+            using_transactions, dry_run, raise_errors)
+
+    def bulk_update(self, using_transactions, dry_run, raise_errors, batch_size=None):
+        instances = tuple(self.update_instances)
+        fields = self.get_bulk_update_fields()
+        self._save_in_bulk(
+            instances,
+            lambda: super(GenericResource, self).bulk_update(using_transactions, dry_run, True, batch_size),
+            lambda i: self._meta.model.objects.bulk_update([i], fields),
+            using_transactions, dry_run, raise_errors, fields)
+
+    def after_import(self, dataset, result, using_transactions, dry_run, **kwargs):
+        if self._bulk_error is not None:
+            # Raising here turns the error into a base error on the result,
+            # which rolls back the import.
+            error, self._bulk_error = self._bulk_error, None
+            raise error
+
+        # Errors found saving instances one at a time are reported on their rows,
+        # which makes the import fail and roll back like any other row error.
+        for instance, error, tb in self._bulk_row_errors:
+            row_result, row = self._bulk_rows[id(instance)]
+            if row_result.import_type != RowResult.IMPORT_TYPE_ERROR:
+                result.totals[row_result.import_type] -= 1
+                result.totals[RowResult.IMPORT_TYPE_ERROR] += 1
+                row_result.import_type = RowResult.IMPORT_TYPE_ERROR
+            row_result.errors.append(self.get_error_result_class()(error, tb, row))
+
+        if not dry_run and reversion.is_active() and not reversion.is_manage_manually():
+            # Set once for the whole import, rather than for every saved row
+            reversion.set_comment(self.revision_comment or (
+                "Imported from template." if result.totals[RowResult.IMPORT_TYPE_NEW] else "Updated from template."))
+
+        super().after_import(dataset, result, using_transactions, dry_run, **kwargs)
@@ -1,10 +1,17 @@
+import reversion
+
+from django.db import models
 from tablib import Dataset
+from typing import Any, Dict, Iterable, Type
 from ..models import Container
-from ..utils import str_normalize
+from ..template_reader import normalize_template_row
 
 
 __all__ = [
     "get_container_pk",
+    "get_instances_by_field",
+    "instance_matches",
+    "add_bulk_to_revision",
     "skip_rows",
     "remove_column_from_preview",
     "add_column_to_preview",
@@ -18,18 +25,63 @@ def get_container_pk(**query):
         raise Container.DoesNotExist(f"Container matching query {query} does not exist")
 
 
+def get_instances_by_field(model: Type[models.Model], field: str, values: Iterable[Any],
+                           queryset=None) -> Dict[Any, models.Model]:
+    """
+    Fetches every instance of a model whose field value is one of the values
+    provided, using a single IN (...) query, and returns them keyed by that
+    field value. Blank values are ignored, since they never reference anything.
+    """
+    values = {v for v in values if v not in ("", None)}
+    if not values:
+        return {}
+    queryset = model.objects.all() if queryset is None else queryset
+    return {getattr(i, field): i for i in queryset.filter(**{f"{field}__in": values})}
+
+
+def instance_matches(instance: models.Model, **lookups) -> bool:
+    """
+    Checks an already-fetched instance against a set of get_or_create-style
+    lookups without going back to the database. Related objects are compared
+    by primary key, so that no extra queries are made to load them.
+    """
+    for key, value in lookups.items():
+        if key.endswith("__isnull"):
+            if (getattr(instance, f"{key[:-len('__isnull')]}_id") is None) != value:
+                return False
+        elif isinstance(value, models.Model):
+            if getattr(instance, f"{key}_id") != value.pk:
+                return False
+        elif getattr(instance, key) != value:
+            return False
+    return True
+
+
+def add_bulk_to_revision(instances: Iterable[models.Model], dry_run: bool) -> None:
+    """
+    bulk_create and bulk_update do not send the signals django-reversion
+    listens for, so objects saved in bulk must be added to the current
+    revision by hand in order to get a version like any other saved object.
+    """
+    if dry_run or not reversion.is_active() or reversion.is_manage_manually():
+        return
+    for instance in instances:
+        if instance.pk is not None:
+            reversion.add_to_revision(instance)
+
+
 def skip_rows(dataset: Dataset, num_rows: int = 0, col_skip: int = 1) -> None:
-    if num_rows <= 0:
+    # Templates read with read_template already had their preamble skipped
+    if num_rows <= 0 or getattr(dataset, "preamble_skipped", False):
         return
     dataset_headers = dataset[num_rows - 1]
     dataset_data = dataset[num_rows:]
     dataset.wipe()
     dataset.headers = dataset_headers
     for r in dataset_data:
-        vals = set(("" if c is None else c) for c in r[col_skip:])
-        if len(vals) == 1 and "" in vals:
-            continue
-        dataset.append(tuple(str_normalize(c) if isinstance(c, str) else ("" if c is None else c) for c in r))
+        r = normalize_template_row(r, col_skip)
+        if r is not None:
+            dataset.append(r)
 
 
 def remove_column_from_preview(results, column_name: str):
@@ -1,4 +1,3 @@
-import reversion
 from import_export.fields import Field
 from import_export.widgets import ForeignKeyWidget
 from ._generic import GenericResource
@@ -19,13 +18,16 @@ class ContainerResource(GenericResource):
     coordinates = Field(attribute='coordinates', column_name='Location Coordinate')
     comment = Field(attribute='comment', column_name='Comment')
 
+    preamble_rows = 6
+    revision_comment = "Imported containers from template."
+
     class Meta:
         model = Container
         import_id_fields = ('barcode',)
         fields = ('kind', 'name', 'barcode', 'location', 'coordinates',)
 
     def before_import(self, dataset, using_transactions, dry_run, **kwargs):
-        skip_rows(dataset, 6)
+        skip_rows(dataset, self.preamble_rows)
 
     def import_field(self, field, obj, data, is_m2m=False):
         if field.attribute == "kind":
@@ -38,7 +40,3 @@ class ContainerResource(GenericResource):
             # Normalize None comments to empty strings
             data["Comment"] = get_normalized_str(data, "Comment")
         super().import_field(field, obj, data, is_m2m)
-
-    def after_save_instance(self, instance, using_transactions, dry_run):
-        super().after_save_instance(instance, using_transactions, dry_run)
-        reversion.set_comment("Imported containers from template.")
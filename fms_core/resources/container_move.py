@@ -1,5 +1,3 @@
-import reversion
-
 from import_export.fields import Field
 from import_export.widgets import ForeignKeyWidget
 
@@ -17,6 +15,9 @@ class ContainerMoveResource(GenericResource):
     coordinates = Field(attribute="coordinates", column_name="Dest. Location Coord")
     update_comment = Field(attribute="update_comment", column_name="Update Comment")
 
+    preamble_rows = 6
+    revision_comment = "Moved containers from template."
+
     class Meta:
         model = Container
         import_id_fields = ("barcode",)
@@ -27,7 +28,7 @@ class ContainerMoveResource(GenericResource):
         )
 
     def before_import(self, dataset, using_transactions, dry_run, **kwargs):
-        skip_rows(dataset, 6)  # Skip preamble and normalize dataset
+        skip_rows(dataset, self.preamble_rows)  # Skip preamble and normalize dataset
 
     def import_field(self, field, obj, data, is_m2m=False):
         if field.attribute == "location":
@@ -40,7 +41,3 @@ class ContainerMoveResource(GenericResource):
             data["Update Comment"] = get_normalized_str(data, "Update Comment")
 
         super().import_field(field, obj, data, is_m2m)
-
-    def after_save_instance(self, *args, **kwargs):
-        super().after_save_instance(*args, **kwargs)
-        reversion.set_comment("Moved containers from template.")
@@ -1,10 +1,10 @@
-import reversion
-
+from django.core.exceptions import ValidationError
 from django.db.models import Q
 from import_export.fields import Field
+from import_export.instance_loaders import CachedInstanceLoader
 
 from ._generic import GenericResource
-from ._utils import get_container_pk, skip_rows
+from ._utils import add_bulk_to_revision, get_instances_by_field, skip_rows
 from ..models import Container
 from ..utils import get_normalized_str
 from ..models._constants import TEMPORARY_RENAME_SUFFIX
@@ -18,10 +18,15 @@ class ContainerRenameResource(GenericResource):
     name = Field(attribute="name", column_name="New Container Name")
     update_comment = Field(attribute="update_comment", column_name="Update Comment")
 
+    preamble_rows = 6
+    revision_comment = "Renamed containers from template."
+
     def __init__(self):
         super().__init__()
         self.new_barcode_old_barcode_map = {}
         self.new_barcode_old_name_map = {}
+        self.containers_by_old_barcode = {}
+        self.renamed_containers = []
 
     class Meta:
         model = Container
@@ -32,24 +37,72 @@ class ContainerRenameResource(GenericResource):
             "update_comment",
         )
 
+        instance_loader_class = CachedInstanceLoader
         use_bulk = True
         batch_size = None
 
+    def get_queryset(self):
+        # clean() needs each container's location
+        return super().get_queryset().select_related("location")
+
     def before_import(self, dataset, using_transactions, dry_run, **kwargs):
-        skip_rows(dataset, 6)  # Skip preamble and normalize dataset
+        skip_rows(dataset, self.preamble_rows)  # Skip preamble and normalize dataset
+
+        self.renamed_containers = []
 
+        old_barcodes = []
         old_barcodes_set = set()
-        id_col = []
 
         for d in dataset.dict:
             old_barcode = get_normalized_str(d, "Old Container Barcode")
             if old_barcode in old_barcodes_set:
                 raise ValueError(f"Cannot rename container with barcode {old_barcode} more than once")
 
+            old_barcodes.append(old_barcode)
             old_barcodes_set.add(old_barcode)
-            id_col.append(get_container_pk(barcode=old_barcode))
 
-        dataset.append_col(id_col, header="id")
+        self.containers_by_old_barcode = get_instances_by_field(Container, "barcode", old_barcodes)
+
+        for old_barcode in old_barcodes:
+            if old_barcode not in self.containers_by_old_barcode:
+                query = {"barcode": old_barcode}
+                raise Container.DoesNotExist(f"Container matching query {query} does not exist")
+
+        self._check_new_values_unique(dataset)
+
+        dataset.append_col([self.containers_by_old_barcode[b].pk for b in old_barcodes], header="id")
+
+    def _check_new_values_unique(self, dataset):
+        """
+        Checks that the new barcodes and names are unique, both within the
+        template and against containers which aren't being renamed, with a
+        single query rather than a full_clean() for every container.
+        """
+
+        new_values = {"barcode": [], "name": []}
+
+        for d in dataset.dict:
+            container = self.containers_by_old_barcode[get_normalized_str(d, "Old Container Barcode")]
+            new_values["barcode"].append(get_normalized_str(d, "New Container Barcode"))
+            new_values["name"].append(get_normalized_str(d, "New Container Name") or container.name)
+
+        taken = {field: set() for field in new_values}
+
+        # Containers being renamed free up their current barcode and name
+        for barcode, name in (Container.objects
+                              .filter(Q(barcode__in=new_values["barcode"]) | Q(name__in=new_values["name"]))
+                              .exclude(pk__in=[c.pk for c in self.containers_by_old_barcode.values()])
+                              .values_list("barcode", "name")):
+            taken["barcode"].add(barcode)
+            taken["name"].add(name)
+
+        for field, values in new_values.items():
+            for value in values:
+                if not value:
+                    continue  # Reported when the row itself is imported
+                if value in taken[field]:
+                    raise ValidationError({field: [Container().unique_error_message(Container, (field,))]})
+                taken[field].add(value)
 
     def import_obj(self, obj, data, dry_run):
         old_container_barcode = get_normalized_str(data, "Old Container Barcode")
@@ -57,8 +110,7 @@ class ContainerRenameResource(GenericResource):
         new_container_name = get_normalized_str(data, "New Container Name")
 
         self.new_barcode_old_barcode_map[new_container_barcode] = old_container_barcode
-        self.new_barcode_old_name_map[new_container_barcode] = \
-            Container.objects.get(barcode=old_container_barcode).name
+        self.new_barcode_old_name_map[new_container_barcode] = obj.name
 
         # Only set new container name if a new one is specified
         data["New Container Name"] = new_container_name or obj.name
@@ -71,7 +123,8 @@ class ContainerRenameResource(GenericResource):
         #  - The validators will not be called automatically since we're not running
         #    full_clean, so pass a special kwarg into our clean() implementation to
         #    manually check that the barcodes and names are good without checking for
-        #    uniqueness the way full_clean() does.
+        #    uniqueness the way full_clean() does. Uniqueness was checked for the
+        #    whole template in before_import.
         obj.normalize()
         obj.clean(check_regexes=True)
 
@@ -80,19 +133,20 @@ class ContainerRenameResource(GenericResource):
             # These will be removed after the initial import succeeds.
             obj.barcode = obj.barcode + TEMPORARY_RENAME_SUFFIX
             obj.name = obj.name + TEMPORARY_RENAME_SUFFIX
-
-    def after_save_instance(self, *args, **kwargs):
-        super().after_save_instance(*args, **kwargs)
-        reversion.set_comment("Renamed containers from template.")
+            self.renamed_containers.append(obj)
 
     def after_import(self, dataset, result, using_transactions, dry_run, **kwargs):
-        if not dry_run:
+        if not dry_run and self._bulk_error is None \
+                and not (result.has_errors() or result.has_validation_errors()):
             # Remove the zero-width spaces introduced before, ideally without errors.
             # If there are integrity errors, django-import-export will revert to the save-point.
-            for container in Container.objects.filter(
-                    Q(barcode__endswith=TEMPORARY_RENAME_SUFFIX) | Q(name__endswith=TEMPORARY_RENAME_SUFFIX)):
-                container.barcode = container.barcode.replace(TEMPORARY_RENAME_SUFFIX, "")
-                container.name = container.name.replace(TEMPORARY_RENAME_SUFFIX, "")
-                container.save()  # Will also run normalize and full_clean
+            for container in self.renamed_containers:
+                container.barcode = container.barcode[:-len(TEMPORARY_RENAME_SUFFIX)]
+                container.name = container.name[:-len(TEMPORARY_RENAME_SUFFIX)]
+
+            Container.objects.bulk_update(self.renamed_containers, ("barcode", "name"))
+
+            # Replace the versions saved with the temporary values
+            add_bulk_to_revision(self.renamed_containers, dry_run)
 
         return super().after_import(dataset, result, using_transactions, dry_run, **kwargs)
@@ -1,5 +1,3 @@
-import reversion
-
 from datetime import datetime
 from import_export.fields import Field
 from import_export.widgets import DateWidget, DecimalWidget, JSONWidget, ForeignKeyWidget
@@ -41,6 +39,9 @@ class ExtractionResource(GenericResource):
     creation_date = Field(attribute='creation_date', column_name='Extraction Date', widget=DateWidget())
     comment = Field(attribute='comment', column_name='Comment')
 
+    preamble_rows = 7
+    revision_comment = "Imported extracted samples from template."
+
     class Meta:
         model = Sample
         import_id_fields = ()
@@ -73,7 +74,7 @@ class ExtractionResource(GenericResource):
         )
 
     def before_import(self, dataset, using_transactions, dry_run, **kwargs):
-        skip_rows(dataset, 7)  # Skip preamble
+        skip_rows(dataset, self.preamble_rows)  # Skip preamble
 
     def import_field(self, field, obj, data, is_m2m=False):
         # More!! ugly hacks
@@ -203,4 +204,3 @@ class ExtractionResource(GenericResource):
         instance.extracted_from.save()
 
         super().after_save_instance(instance, using_transactions, dry_run)
-        reversion.set_comment("Imported extracted samples from template.")
@@ -1,17 +1,22 @@
 import json
-import reversion
 
 from crequest.middleware import CrequestMiddleware
 from django.contrib import messages
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.db.models import Q
 from import_export.fields import Field
 from import_export.widgets import DateWidget, DecimalWidget, JSONWidget
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 from ._generic import GenericResource
-from ._utils import skip_rows
+from ._utils import add_bulk_to_revision, get_instances_by_field, instance_matches, skip_rows
 from ..containers import (
     SAMPLE_CONTAINER_KINDS,
     SAMPLE_CONTAINER_KINDS_WITH_COORDS,
 )
+from ..coordinates import add_coordinate_occupant, get_coordinate_occupancy_index
 from ..models import Container, Individual, Sample, SampleKind
+from ..summaries import counting_changes
 from ..utils import (
     RE_SEPARATOR,
     VolumeHistoryUpdateType,
@@ -80,6 +85,9 @@ class SampleResource(GenericResource):
         "context_sensitive_coordinates",
     ))
 
+    preamble_rows = 6
+    revision_comment = "Imported samples from template."
+
     class Meta:
         model = Sample
         import_id_fields = ("container__barcode", "context_sensitive_coordinates")
@@ -92,6 +100,14 @@ class SampleResource(GenericResource):
             "container__barcode",
         )
         excluded = ("volume_history", "individual", "depleted", "container")
+
+        # Samples are validated row by row, but only written once every row
+        # has been processed; see before_import for how the objects they
+        # reference are resolved in bulk. Since bulk_create skips save(),
+        # have django-import-export run full_clean on each row instead.
+        use_bulk = True
+        batch_size = None
+        clean_model_instances = True
         export_order = (
             "sample_kind",
             "name",
@@ -118,11 +134,34 @@ class SampleResource(GenericResource):
             "comment",
         )
 
-    def before_import(self, dataset, using_transactions, dry_run, **kwargs):
-        skip_rows(dataset, 6)
+    def __init__(self):
+        super().__init__()
+        self._reset_related_objects()
 
-    def import_obj(self, obj, data, dry_run):
-        super().import_obj(obj, data, dry_run)
+    def _reset_related_objects(self):
+        # Objects referenced by the template, resolved once per import
+        self.sample_kinds_by_name: Dict[str, SampleKind] = {}
+        self.containers_by_barcode: Dict[str, Container] = {}
+        self.individuals_by_name: Dict[str, Individual] = {}
+
+        # Errors raised while creating referenced objects up front; these are
+        # re-raised for every row which references the object in question.
+        self.container_errors: Dict[str, Exception] = {}
+        self.individual_errors: Dict[str, ValidationError] = {}
+
+        # Individuals created by this import which have not yet been used by
+        # a row; used to warn about re-used individuals like get_or_create.
+        self.created_individual_names = set()
+
+    # Row -> lookup helpers, shared by the bulk resolution step and the
+    # per-row import so that both agree on what a row refers to.
+
+    @staticmethod
+    def _get_individual_lookups(data) -> List[Tuple[str, dict]]:
+        """
+        Returns (name, get_or_create-style lookups) pairs for the individuals
+        referenced by a row, parents first. Parents are referenced by name.
+        """
 
         # Sample import can optionally create new individuals in the system;
         # or re-use existing ones. Along with the individual associated with
@@ -133,38 +172,304 @@ class SampleResource(GenericResource):
         pedigree = str_cast_and_normalize(get_normalized_str(data, "Pedigree"))
         cohort = str_cast_and_normalize(get_normalized_str(data, "Cohort"))
 
-        mother = None
-        father = None
+        lineage = {
+            **({"pedigree": pedigree} if pedigree else {}),  # Parents have same pedigree as offspring
+            **({"cohort": cohort} if cohort else {}),  # Parents have same cohort as offspring TODO: Confirm
+        }
+
+        lookups = []
+        parents = {}
 
         if data["Mother ID"]:
-            mother, _ = Individual.objects.get_or_create(
-                name=get_normalized_str(data, "Mother ID"),
-                sex=Individual.SEX_FEMALE,
-                taxon=taxon,  # Mother has same taxon as offspring
-                **({"pedigree": pedigree} if pedigree else {}),  # Mother has same pedigree as offspring
-                **({"cohort": cohort} if cohort else {}),  # Mother has same cohort as offspring TODO: Confirm
-            )
+            parents["mother"] = get_normalized_str(data, "Mother ID")
+            # Mother has same taxon as offspring
+            lookups.append((parents["mother"], dict(sex=Individual.SEX_FEMALE, taxon=taxon, **lineage)))
 
         if data["Father ID"]:
-            father, _ = Individual.objects.get_or_create(
-                name=get_normalized_str(data, "Father ID"),
-                sex=Individual.SEX_MALE,
-                taxon=taxon,  # Father has same taxon as offspring
-                **({"pedigree": pedigree} if pedigree else {}),  # Father has same pedigree as offspring
-                **({"cohort": cohort} if cohort else {}),  # Father has same cohort as offspring TODO: Confirm
-            )
+            parents["father"] = get_normalized_str(data, "Father ID")
+            # Father has same taxon as offspring
+            lookups.append((parents["father"], dict(sex=Individual.SEX_MALE, taxon=taxon, **lineage)))
 
-        # TODO: This should throw a nicer warning if the individual already exists
-        # TODO: Warn if the individual exists but pedigree/cohort is different
-        individual, individual_created = Individual.objects.get_or_create(
-            name=get_normalized_str(data, "Individual ID"),
+        lookups.append((get_normalized_str(data, "Individual ID"), dict(
             sex=get_normalized_str(data, "Sex", default=Individual.SEX_UNKNOWN),
             taxon=taxon,
-            **({"pedigree": pedigree} if pedigree else {}),
-            **({"cohort": cohort} if cohort else {}),
-            **({"mother": mother} if mother else {}),
-            **({"father": father} if father else {}),
+            **lineage,
+            **parents,
+        )))
+
+        return lookups
+
+    def _get_container_lookups(self, data) -> Tuple[dict, Optional[str]]:
+        """
+        Returns get_or_create-style lookups for the sample-holding container
+        referenced by a row, along with the sample's own coordinates (if the
+        container has a coordinate system.)
+        """
+
+        normalized_container_kind = get_normalized_str(data, "Container Kind").lower()
+        location_barcode = get_normalized_str(data, "Location Barcode")
+
+        container_parent = self.containers_by_barcode.get(location_barcode) if location_barcode else None
+        if location_barcode and container_parent is None:
+            # If a parent container barcode was specified, raise a
+            # better error message detailing what went wrong.
+            # Otherwise, we assume it was left blank on purpose.
+            raise Container.DoesNotExist(f"Container with barcode {location_barcode} does not exist")
+
+        container_data = dict(
+            kind=normalized_container_kind,
+            name=get_normalized_str(data, "Container Name"),
+            barcode=get_normalized_str(data, "Container Barcode"),
+            **(dict(location=container_parent) if container_parent else dict(location__isnull=True)),
         )
+
+        normalized_coords = get_normalized_str(data, "Location Coord")
+
+        if normalized_container_kind in SAMPLE_CONTAINER_KINDS_WITH_COORDS:
+            # Case where container itself has a coordinate system; in this
+            # case the SAMPLE gets the coordinates (e.g. with a plate.)
+            return container_data, normalized_coords
+
+        # Case where the container gets coordinates within the parent
+        # (e.g. a tube in a rack).
+        container_data["coordinates"] = normalized_coords
+        return container_data, None
+
+    # Bulk resolution of referenced objects
+
+    def before_import(self, dataset, using_transactions, dry_run, **kwargs):
+        skip_rows(dataset, self.preamble_rows)
+
+        self._reset_related_objects()
+
+        rows = dataset.dict
+
+        # Fetch everything the template refers to in a handful of IN (...)
+        # queries, rather than a few queries per row.
+
+        self.sample_kinds_by_name = get_instances_by_field(SampleKind, "name", (d["Sample Kind"] for d in rows))
+
+        barcodes = set()
+        container_names = set()
+        individual_names = set()
+
+        for d in rows:
+            barcodes.update((get_normalized_str(d, "Location Barcode"), get_normalized_str(d, "Container Barcode")))
+            container_names.add(get_normalized_str(d, "Container Name"))
+            individual_names.update(name for name, _ in self._get_individual_lookups(d))
+
+        barcodes.discard("")
+        container_names.discard("")
+
+        # Containers are also fetched by name, so that name collisions can be
+        # caught without running a uniqueness query per new container.
+        existing_containers = list(Container.objects.filter(Q(barcode__in=barcodes) | Q(name__in=container_names))) \
+            if barcodes or container_names else []
+
+        self.containers_by_barcode = {c.barcode: c for c in existing_containers}
+        self.individuals_by_name = get_instances_by_field(Individual, "name", individual_names)
+
+        # Load everything occupying the containers the template refers to, so
+        # that coordinate overlaps are checked in memory.
+        index = get_coordinate_occupancy_index()
+        if index is not None:
+            index.load(Container, "location", (c.pk for c in existing_containers))
+            index.load(Sample, "container", (c.pk for c in existing_containers))
+
+        # Then create whatever is missing, in bulk.
+        self._create_missing_containers(rows, {c.name for c in existing_containers}, dry_run)
+        self._create_missing_individuals(rows, dry_run)
+
+    def _create_missing_containers(self, rows, existing_names, dry_run):
+        new: Dict[str, Container] = {}
+
+        for d in rows:
+            if get_normalized_str(d, "Container Kind").lower() not in SAMPLE_CONTAINER_KINDS:
+                continue
+
+            try:
+                container_data, _ = self._get_container_lookups(d)
+            except Container.DoesNotExist:
+                # Reported when the row itself is imported
+                continue
+
+            barcode = container_data["barcode"]
+            if barcode in self.containers_by_barcode or barcode in new:
+                # Any mismatch with the existing container is reported by the
+                # per-row fallback to get_or_create.
+                continue
+
+            container_data.pop("location__isnull", None)
+            new[barcode] = Container(**container_data)
+
+        planned = self._validate_new_containers(new.values(), existing_names)
+
+        try:
+            with transaction.atomic(), counting_changes(planned):
+                created = Container.objects.bulk_create(planned)
+        except IntegrityError:
+            # A container was created elsewhere since they were fetched; create
+            # them one at a time to find out which, so that only the rows
+            # referencing it fail.
+            created = []
+            with counting_changes(planned):
+                for container in planned:
+                    try:
+                        with transaction.atomic():
+                            created.extend(Container.objects.bulk_create([container]))
+                    except IntegrityError as e:
+                        self.container_errors[container.barcode] = e
+
+        add_bulk_to_revision(created, dry_run)
+        self.containers_by_barcode.update((c.barcode, c) for c in created)
+
+    def _validate_new_containers(self, containers: Iterable[Container], existing_names: Set[str]) -> List[Container]:
+        """
+        Validates the containers to create as a batch, without any queries:
+        uniqueness is checked against the containers fetched up front and the
+        rest of the batch, and coordinates against the occupancy index. Errors
+        are kept for the rows referencing each container; returns the valid ones.
+        """
+
+        valid = []
+
+        for container in containers:
+            try:
+                container.full_clean(exclude=("location",), validate_unique=False)
+
+                if container.name in existing_names:
+                    raise ValidationError({"name": [container.unique_error_message(Container, ("name",))]})
+
+            except ValidationError as e:
+                self.container_errors[container.barcode] = e
+                continue
+
+            if container.location is not None:
+                # Containers created by the same template can't overlap either
+                add_coordinate_occupant(container.location.children, container, container.location)
+
+            container.update_ancestors()
+            existing_names.add(container.name)
+            valid.append(container)
+
+        return valid
+
+    def _create_missing_individuals(self, rows, dry_run):
+        planned: Dict[str, dict] = {}
+
+        def plan(name: str, lookups: dict) -> bool:
+            existing = self.individuals_by_name.get(name)
+            if existing is not None:
+                return instance_matches(existing, **lookups)
+            if name not in planned:
+                planned[name] = lookups
+            return planned[name] == lookups
+
+        for d in rows:
+            *parent_lookups, (name, lookups) = self._get_individual_lookups(d)
+            # Parents which conflict with an existing record make the row
+            # invalid; don't create the row's individual in that case.
+            parents_ok = all([plan(parent_name, pl) for parent_name, pl in parent_lookups if parent_name])
+            if name and parents_ok and name not in self.individuals_by_name and name not in planned:
+                planned[name] = lookups
+
+        # Individuals can only be written once their parents have primary
+        # keys, so create them in waves: parents first, then their children.
+
+        while planned:
+            wave = [name for name, lookups in planned.items()
+                    if not any(lookups.get(p) in planned for p in ("mother", "father"))]
+
+            if not wave:
+                # Circular parentage; leave these to the per-row fallback.
+                break
+
+            to_create = []
+
+            for name in wave:
+                lookups = planned.pop(name)
+                parents = {p: lookups[p] for p in ("mother", "father") if p in lookups}
+
+                if any(p not in self.individuals_by_name for p in parents.values()):
+                    # A parent couldn't be created; the row will report why.
+                    continue
+
+                individual = Individual(name=name, **{
+                    **lookups,
+                    **{p: self.individuals_by_name[parent_name] for p, parent_name in parents.items()},
+                })
+
+                try:
+                    # Parents were either fetched or just created, so they're
+                    # known to exist; uniqueness was checked when fetching.
+                    individual.full_clean(exclude=("mother", "father"), validate_unique=False)
+                except ValidationError as e:
+                    self.individual_errors[name] = e
+                    continue
+
+                to_create.append(individual)
+
+            created = Individual.objects.bulk_create(to_create)
+            add_bulk_to_revision(created, dry_run)
+            self.individuals_by_name.update((i.name, i) for i in created)
+            self.created_individual_names.update(i.name for i in created)
+
+    # Per-row resolution, using the objects resolved above
+
+    def _get_sample_kind(self, name: str) -> SampleKind:
+        sample_kind = self.sample_kinds_by_name.get(name)
+        if sample_kind is None:
+            # Will raise the usual DoesNotExist error for unknown kinds
+            sample_kind = self.sample_kinds_by_name[name] = SampleKind.objects.get(name=name)
+        return sample_kind
+
+    def _get_or_create_container(self, **container_data) -> Container:
+        barcode = container_data["barcode"]
+
+        if barcode in self.container_errors:
+            raise self.container_errors[barcode]
+
+        container = self.containers_by_barcode.get(barcode)
+        if container is not None and instance_matches(container, **container_data):
+            return container
+
+        # Fall back to get_or_create for anything which couldn't be resolved
+        # up front. This will throw an error if the kind specified mismatches
+        # with an existing barcode record in the database, which serves as an
+        # ad-hoc additional validation step.
+        container, _ = Container.objects.get_or_create(**container_data)
+        self.containers_by_barcode[barcode] = container
+        return container
+
+    def _get_or_create_individual(self, name: str, **lookups) -> Tuple[Individual, bool]:
+        if name in self.individual_errors:
+            raise self.individual_errors[name]
+
+        individual = self.individuals_by_name.get(name)
+        if individual is not None and instance_matches(individual, **lookups):
+            created = name in self.created_individual_names
+            self.created_individual_names.discard(name)
+            return individual, created
+
+        individual, created = Individual.objects.get_or_create(name=name, **lookups)
+        self.individuals_by_name[name] = individual
+        return individual, created
+
+    def import_obj(self, obj, data, dry_run):
+        super().import_obj(obj, data, dry_run)
+
+        *parent_lookups, (individual_name, individual_lookups) = self._get_individual_lookups(data)
+
+        for parent_name, lookups in parent_lookups:
+            self._get_or_create_individual(parent_name, **lookups)
+
+        for parent in ("mother", "father"):
+            if parent in individual_lookups:
+                individual_lookups[parent] = self.individuals_by_name[individual_lookups[parent]]
+
+        # TODO: This should throw a nicer warning if the individual already exists
+        # TODO: Warn if the individual exists but pedigree/cohort is different
+        individual, individual_created = self._get_or_create_individual(individual_name, **individual_lookups)
         obj.individual = individual
 
         # If we're doing a dry run (i.e. uploading for confirmation) and we're
@@ -191,7 +496,7 @@ class SampleResource(GenericResource):
         normalized_container_kind = get_normalized_str(data, "Container Kind").lower()
 
         if field.attribute == "sample_kind_name":
-            obj.sample_kind = SampleKind.objects.get(name=data["Sample Kind"])
+            obj.sample_kind = self._get_sample_kind(data["Sample Kind"])
 
         elif field.attribute == "container_barcode" and normalized_container_kind in SAMPLE_CONTAINER_KINDS:
             # Oddly enough, Location Coord is contextual - when Container Kind
@@ -200,44 +505,13 @@ class SampleResource(GenericResource):
             # of the container within the parent container.
             # TODO: Ideally this should be tweaked
 
-            location_barcode = get_normalized_str(data, "Location Barcode")
-
-            try:
-                container_parent = Container.objects.get(barcode=location_barcode)
-            except Container.DoesNotExist:
-                if location_barcode:
-                    # If a parent container barcode was specified, raise a
-                    # better error message detailing what went wrong.
-                    # Otherwise, we assume it was left blank on purpose.
-                    raise Container.DoesNotExist(f"Container with barcode {location_barcode} does not exist")
-                container_parent = None
-
-            container_data = dict(
-                kind=normalized_container_kind,
-                name=get_normalized_str(data, "Container Name"),
-                barcode=get_normalized_str(data, "Container Barcode"),
-                **(dict(location=container_parent) if container_parent else dict(location__isnull=True)),
-            )
-
-            normalized_coords = get_normalized_str(data, "Location Coord")
-
-            if normalized_container_kind in SAMPLE_CONTAINER_KINDS_WITH_COORDS:
-                # Case where container itself has a coordinate system; in this
-                # case the SAMPLE gets the coordinates (e.g. with a plate.)
-                obj.coordinates = normalized_coords
-            else:
-                # Case where the container gets coordinates within the parent
-                # (e.g. a tube in a rack).
-                container_data["coordinates"] = normalized_coords
+            container_data, sample_coordinates = self._get_container_lookups(data)
+            if sample_coordinates is not None:
+                obj.coordinates = sample_coordinates
 
             # If needed, create a sample-holding container to store the current
             # sample; or retrieve an existing one with the correct barcode.
-            # This will throw an error if the kind specified mismatches with an
-            # existing barcode record in the database, which serves as an
-            # ad-hoc additional validation step.
-
-            container, _ = Container.objects.get_or_create(**container_data)
-            obj.container = container
+            obj.container = self._get_or_create_container(**container_data)
 
             return
 
@@ -266,11 +540,8 @@ class SampleResource(GenericResource):
 
         super().import_field(field, obj, data, is_m2m)
 
-    def before_save_instance(self, instance, using_transactions, dry_run):
-        # TODO: Don't think this is needed
-        instance.individual.save()
-        super().before_save_instance(instance, using_transactions, dry_run)
-
-    def after_save_instance(self, instance, using_transactions, dry_run):
-        super().after_save_instance(instance, using_transactions, dry_run)
-        reversion.set_comment("Imported samples from template.")
+    def save_instance(self, instance, using_transactions=True, dry_run=False):
+        # Samples are only written once all rows are imported, so mark their
+        # position as taken right away for the rows after this one.
+        add_coordinate_occupant(instance.container.samples, instance, instance.container)
+        super().save_instance(instance, using_transactions, dry_run)
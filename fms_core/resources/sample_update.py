@@ -1,5 +1,3 @@
-import reversion
-
 import re
 import ast
 from decimal import Decimal
@@ -33,6 +31,9 @@ class SampleUpdateResource(GenericResource):
     depleted = Field(attribute="depleted", column_name="Depleted")
     update_comment = Field(attribute="update_comment", column_name="Update Comment")
 
+    preamble_rows = 6
+    revision_comment = "Updated samples from template."
+
     class Meta:
         model = Sample
         import_id_fields = ('id',)
@@ -44,27 +45,56 @@ class SampleUpdateResource(GenericResource):
         )
         exclude = ('container', 'coordinates')
 
+    def __init__(self):
+        super().__init__()
+        # Primary keys of the samples referenced by the template, keyed by (container barcode, coordinates)
+        self.sample_pks = {}
+
     @staticmethod
-    def _get_sample_pk(**query):
-        try:
-            return Sample.objects.get(**query).pk
-        except Sample.DoesNotExist:
+    def _get_sample_query(data) -> dict:
+        return dict(
+            container__barcode=get_normalized_str(data, "Container Barcode"),
+            coordinates=get_normalized_str(data, "Coord (if plate)"),
+        )
+
+    def _get_sample_pk(self, **query):
+        pks = self.sample_pks.get((query["container__barcode"], query["coordinates"]), [])
+        if not pks:
             raise Sample.DoesNotExist(f"Sample matching query {query} does not exist")
+        if len(pks) > 1:
+            raise Sample.MultipleObjectsReturned(f"More than one sample matching query {query} exists")
+        return pks[0]
 
     def before_import(self, dataset, using_transactions, dry_run, **kwargs):
-        skip_rows(dataset, 6)  # Skip preamble
+        skip_rows(dataset, self.preamble_rows)  # Skip preamble
+
+        queries = [self._get_sample_query(d) for d in dataset.dict]
+
+        # Fetch the samples of every container in the template at once, then
+        # match them up with the (barcode, coordinates) pairs of each row.
+        self.sample_pks = {}
+        for barcode, coordinates, pk in Sample.objects.filter(
+                container__barcode__in={q["container__barcode"] for q in queries}
+        ).values_list("container__barcode", "coordinates", "pk"):
+            self.sample_pks.setdefault((barcode, coordinates), []).append(pk)
+
+        def get_pk_or_none(query):
+            try:
+                return self._get_sample_pk(**query)
+            except (Sample.DoesNotExist, Sample.MultipleObjectsReturned):
+                # Reported for the row itself in before_import_row
+                return None
 
         # add column 'id' with pk
-        dataset.append_col([
-            SampleUpdateResource._get_sample_pk(
-                container__barcode=get_normalized_str(d, "Container Barcode"),
-                coordinates=get_normalized_str(d, "Coord (if plate)"),
-            ) for d in dataset.dict
-        ], header="id")
+        dataset.append_col([get_pk_or_none(q) for q in queries], header="id")
 
         super().before_import(dataset, using_transactions, dry_run, **kwargs)
 
     def before_import_row(self, row, **kwargs):
+        if row["id"] is None:
+            # Raises the error for a sample which could not be found
+            self._get_sample_pk(**self._get_sample_query(row))
+
         # Ensure that new volume and delta volume do not have both a value for the same row.
         vol = blank_str_to_none(row.get("New Volume (uL)"))
         delta_vol = blank_str_to_none(row.get("Delta Volume (uL)"))
@@ -123,10 +153,6 @@ class SampleUpdateResource(GenericResource):
 
         super().import_field(field, obj, data, is_m2m)
 
-    def after_save_instance(self, instance, using_transactions, dry_run):
-        super().after_save_instance(instance, using_transactions, dry_run)
-        reversion.set_comment("Updated samples from template.")
-
     def import_data(self, dataset, dry_run=False, raise_errors=False, use_transactions=None, collect_failed_rows=False,
                     **kwargs):
         results = super().import_data(dataset, dry_run, raise_errors, use_transactions, collect_failed_rows, **kwargs)
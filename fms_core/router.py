@@ -7,6 +7,7 @@ from .viewsets import (
     QueryViewSet,
     SampleViewSet,
     SampleKindViewSet,
+    TemplateImportJobViewSet,
     UserViewSet,
     GroupViewSet,
     VersionViewSet,
@@ -21,6 +22,7 @@ router.register(r"sample-kinds", SampleKindViewSet, basename="sample-kind")
 router.register(r"samples", SampleViewSet)
 router.register(r"individuals", IndividualViewSet)
 router.register(r"query", QueryViewSet, basename="query")
+router.register(r"template-jobs", TemplateImportJobViewSet)
 router.register(r"versions", VersionViewSet)
 router.register(r"users", UserViewSet)
 router.register(r"groups", GroupViewSet)
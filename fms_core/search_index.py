@@ -0,0 +1,301 @@
+"""
+In-process n-gram index for global search, used instead of the fzy extension
+where it isn't installed in the database.
+
+Searched texts (names, barcodes, aliases and user names) are split into
+lowercase words, and words into trigrams padded like pg_trgm's, so that word
+beginnings and endings weigh in. Texts are scored by the fraction of the
+query's trigrams they contain, which tolerates typos, scaled down for texts
+longer than the query. Queries shorter than a trigram are matched as
+substrings of the texts instead.
+
+The index is built from the database on first use, and kept current through
+model signals once changes are committed. Bulk writes (imports) and writes
+from other processes don't send signals here, so the index also remembers the
+latest revision and primary keys it was synced with; when they change, only
+the objects with versions saved since, and the objects created since, are
+read back. Users aren't versioned, so changes to existing users made by other
+processes aren't picked up; neither are deletes made by other processes, but
+deleted results are left out when search results are fetched.
+"""
+
+import re
+import threading
+
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+from django.db.models import Model, Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from reversion.models import Revision, Version
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple, Type
+
+from .models import Container, Individual, Sample
+
+
+__all__ = [
+    "SEARCHED_FIELDS",
+    "SearchIndex",
+    "fzy_installed",
+    "get_search_index",
+]
+
+
+# Model and fields indexed for each type of search result
+SEARCHED_FIELDS: Dict[str, Tuple[Type[Model], Tuple[str, ...]]] = {
+    "container": (Container, ("name", "barcode")),
+    "individual": (Individual, ("name",)),
+    "sample": (Sample, ("name", "alias")),
+    "user": (User, ("username", "first_name", "last_name")),
+}
+
+_TYPES_BY_MODEL = {model: search_type for search_type, (model, _) in SEARCHED_FIELDS.items()}
+
+NGRAM_LENGTH = 3
+
+# Texts must contain at least this fraction of a query's n-grams to match it
+MIN_NGRAM_COVERAGE = 0.5
+
+_WORD_RE = re.compile(r"[^\W_]+")
+
+# Indexed texts are identified by result type, primary key and field index
+TextKey = Tuple[str, Any, int]
+
+
+def _ngrams(text: str) -> Set[str]:
+    ngrams = set()
+    for word in _WORD_RE.findall(text.lower()):
+        padded = f"{' ' * (NGRAM_LENGTH - 1)}{word} "
+        ngrams.update(padded[i:i + NGRAM_LENGTH] for i in range(len(padded) - NGRAM_LENGTH + 1))
+    return ngrams
+
+
+def _length_factor(query: str, text: str) -> float:
+    # 1 for texts as long as the query, down to 1/2 for much longer ones
+    return (1 + len(query) / max(len(query), len(text))) / 2
+
+
+class SearchIndex:
+    """
+    Inverted index from n-grams to the texts of search results which contain
+    them. Safe to update and search from multiple threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._texts: Dict[TextKey, str] = {}
+        self._keys: Dict[Tuple[str, Any], List[TextKey]] = {}
+        self._postings: Dict[str, Set[TextKey]] = defaultdict(set)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def add(self, search_type: str, pk: Any, texts: Iterable[Optional[str]]):
+        """
+        Indexes (or re-indexes) the texts of a search result.
+        """
+
+        with self._lock:
+            self.remove(search_type, pk)
+
+            keys = []
+            for i, text in enumerate(texts):
+                if not text:
+                    continue
+                key = (search_type, pk, i)
+                keys.append(key)
+                self._texts[key] = text.lower()
+                for ngram in _ngrams(text):
+                    self._postings[ngram].add(key)
+
+            if keys:
+                self._keys[(search_type, pk)] = keys
+
+    def remove(self, search_type: str, pk: Any):
+        with self._lock:
+            for key in self._keys.pop((search_type, pk), ()):
+                for ngram in _ngrams(self._texts.pop(key)):
+                    postings = self._postings[ngram]
+                    postings.discard(key)
+                    if not postings:
+                        del self._postings[ngram]
+
+    def search(self, query: str, limit: int) -> List[Tuple[str, Any, float]]:
+        """
+        Returns the (type, primary key, score) of up to limit results matching
+        the query, best first.
+        """
+
+        query = query.lower()
+        scores: Dict[Tuple[str, Any], float] = {}
+
+        with self._lock:
+            query_ngrams = _ngrams(query)
+            if len(query.strip()) < NGRAM_LENGTH or not query_ngrams:
+                matches = ((key, _length_factor(query, text))
+                           for key, text in self._texts.items() if query in text)
+            else:
+                shared = Counter()
+                for ngram in query_ngrams:
+                    shared.update(self._postings.get(ngram, ()))
+                matches = ((key, n / len(query_ngrams) * _length_factor(query, self._texts[key]))
+                           for key, n in shared.items() if n / len(query_ngrams) >= MIN_NGRAM_COVERAGE)
+
+            for (search_type, pk, _), score in matches:
+                if score > scores.get((search_type, pk), 0):
+                    scores[(search_type, pk)] = score
+
+        ranked = sorted(scores.items(), key=lambda r: (-r[1], r[0][0], r[0][1]))[:limit]
+        return [(search_type, pk, score) for (search_type, pk), score in ranked]
+
+
+def fzy_installed() -> bool:
+    """
+    Whether the fzy extension's scoring function is installed in the database.
+    """
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT to_regprocedure('fzy(cstring, cstring)') IS NOT NULL")
+        return cursor.fetchone()[0]
+
+
+# Revisions are looked back on for this long before the latest one the index
+# was refreshed with, as transactions can commit in another order than they
+# saved their revisions in.
+REVISION_LOOKBACK = timedelta(minutes=1)
+
+
+class _SyncPoint(NamedTuple):
+    # Latest revision holding a version of an indexed object, and when it was saved
+    revision_id: Optional[int]
+    revision_date: Optional[datetime]
+    # Latest primary key of each indexed model, in the order of SEARCHED_FIELDS
+    latest_pks: Tuple[Any, ...]
+
+
+_index: Optional[SearchIndex] = None
+_index_synced: Optional[_SyncPoint] = None
+_index_lock = threading.Lock()
+
+
+def _content_type_ids() -> Dict[int, Type[Model]]:
+    # Cached by Django after the first call
+    return {ct.pk: model for model, ct in ContentType.objects.get_for_models(*_TYPES_BY_MODEL).items()}
+
+
+def _latest() -> Tuple[Optional[int], Tuple[Any, ...]]:
+    # Latest revision and primary keys, in a single query using the
+    # (content type, revision) index of versions and the primary keys'
+    qn = connection.ops.quote_name
+    content_type_ids = list(_content_type_ids())
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT GREATEST({}), {}".format(
+            ", ".join(f"(SELECT MAX(revision_id) FROM {qn(Version._meta.db_table)} WHERE content_type_id = %s)"
+                      for _ in content_type_ids),
+            ", ".join(f"(SELECT MAX({qn(model._meta.pk.column)}) FROM {qn(model._meta.db_table)})"
+                      for model, _ in SEARCHED_FIELDS.values()),
+        ), content_type_ids)
+        revision_id, *latest_pks = cursor.fetchone()
+    return revision_id, tuple(latest_pks)
+
+
+def _build() -> Tuple[SearchIndex, _SyncPoint]:
+    revision_id, latest_pks = _latest()
+    revision_date = None if revision_id is None else Revision.objects.values_list(
+        "date_created", flat=True).get(pk=revision_id)
+
+    index = SearchIndex()
+    for search_type, (model, fields) in SEARCHED_FIELDS.items():
+        for pk, *texts in model.objects.values_list("pk", *fields).iterator():
+            index.add(search_type, pk, texts)
+
+    return index, _SyncPoint(revision_id, revision_date, latest_pks)
+
+
+def _refresh(index: SearchIndex, synced: _SyncPoint, revision_id: Optional[int],
+             latest_pks: Tuple[Any, ...]) -> _SyncPoint:
+    # Re-indexes objects with versions saved since the index was last synced,
+    # and objects created since without one (users)
+    content_types = _content_type_ids()
+    changed = Q(revision_id__gt=synced.revision_id or 0)
+    if synced.revision_date is not None:
+        changed |= Q(revision__date_created__gte=synced.revision_date - REVISION_LOOKBACK)
+
+    object_ids = defaultdict(set)
+    revision_date = synced.revision_date
+    for content_type_id, object_id, date_created in Version.objects.filter(
+            changed, content_type_id__in=content_types).values_list(
+            "content_type_id", "object_id", "revision__date_created").iterator():
+        object_ids[content_types[content_type_id]].add(object_id)
+        revision_date = date_created if revision_date is None else max(revision_date, date_created)
+
+    for (search_type, (model, fields)), synced_pk, latest_pk in zip(
+            SEARCHED_FIELDS.items(), synced.latest_pks, latest_pks):
+        pks = {model._meta.pk.to_python(object_id) for object_id in object_ids[model]}
+        created = latest_pk is not None and latest_pk != synced_pk
+        if not pks and not created:
+            continue
+        if created:
+            objects = Q(pk__in=pks) | Q(pk__gt=synced_pk) if synced_pk is not None else Q()
+        else:
+            objects = Q(pk__in=pks)
+
+        found = set()
+        for pk, *texts in model.objects.filter(objects).values_list("pk", *fields).iterator():
+            index.add(search_type, pk, texts)
+            found.add(pk)
+        for pk in pks - found:
+            index.remove(search_type, pk)
+
+    return _SyncPoint(revision_id, revision_date, latest_pks)
+
+
+def get_search_index() -> SearchIndex:
+    """
+    Returns the index of every search result, built from the database on
+    first use, and brought up to date with objects saved since it was last
+    used, by any process.
+    """
+
+    global _index, _index_synced
+
+    revision_id, latest_pks = _latest()
+    with _index_lock:
+        if _index is None:
+            _index, _index_synced = _build()
+        elif (revision_id, latest_pks) != (_index_synced.revision_id, _index_synced.latest_pks):
+            _index_synced = _refresh(_index, _index_synced, revision_id, latest_pks)
+
+        return _index
+
+
+def _update_index(search_type: str, pk: Any, texts: Optional[Tuple[str, ...]]):
+    # Changes made by this process show up right away, without waiting for the
+    # next search to read them back; what the index was synced with doesn't
+    # change, so that changes made meanwhile by other processes are still read.
+    with _index_lock:
+        if _index is None:
+            return  # Built from the database on first use
+        if texts is None:
+            _index.remove(search_type, pk)
+        else:
+            _index.add(search_type, pk, texts)
+
+
+@receiver(post_save)
+def _index_after_save(sender, instance, **kwargs):
+    search_type = _TYPES_BY_MODEL.get(sender._meta.concrete_model)
+    if search_type is not None:
+        pk, texts = instance.pk, tuple(getattr(instance, f) for f in SEARCHED_FIELDS[search_type][1])
+        transaction.on_commit(lambda: _update_index(search_type, pk, texts))
+
+
+@receiver(post_delete)
+def _index_after_delete(sender, instance, **kwargs):
+    search_type = _TYPES_BY_MODEL.get(sender._meta.concrete_model)
+    if search_type is not None:
+        pk = instance.pk
+        transaction.on_commit(lambda: _update_index(search_type, pk, None))
@@ -2,11 +2,13 @@ from django.contrib.auth.models import User, Group
 from rest_framework import serializers
 from reversion.models import Version
 
-from .models import Container, Sample, Individual, SampleKind
+from .models import Container, Sample, Individual, SampleKind, TemplateImportJob
+from .utils import float_to_decimal
 
 
 __all__ = [
     "ContainerSerializer",
+    "ContainerCountsSerializer",
     "ContainerExportSerializer",
     "SimpleContainerSerializer",
     "IndividualSerializer",
@@ -14,6 +16,7 @@ __all__ = [
     "SampleSerializer",
     "SampleExportSerializer",
     "NestedSampleSerializer",
+    "TemplateImportJobSerializer",
     "VersionSerializer",
     "UserSerializer",
     "GroupSerializer",
@@ -26,13 +29,36 @@ class ContainerSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Container
-        fields = "__all__"
+        exclude = ("ancestors",)  # Internal index of the hierarchy
+
+
+class ContainerCountsSerializer(serializers.ModelSerializer):
+    """
+    Container with the number of its children and samples, rather than all of
+    their IDs; see container_hierarchy.annotate_container_counts. The first
+    of their IDs are only included if the context has an ids_limit.
+    """
+
+    children_count = serializers.IntegerField(read_only=True)
+    samples_count = serializers.IntegerField(read_only=True)
+    children = serializers.ListField(child=serializers.IntegerField(), source="children_ids", read_only=True)
+    samples = serializers.ListField(child=serializers.IntegerField(), source="samples_ids", read_only=True)
+
+    class Meta:
+        model = Container
+        exclude = ("ancestors",)  # Internal index of the hierarchy
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.context.get("ids_limit") is None:
+            self.fields.pop("children")
+            self.fields.pop("samples")
 
 
 class SimpleContainerSerializer(serializers.ModelSerializer):
     class Meta:
         model = Container
-        fields = "__all__"
+        exclude = ("ancestors",)  # Internal index of the hierarchy
 
 
 class ContainerExportSerializer(serializers.ModelSerializer):
@@ -88,6 +114,16 @@ class SampleExportSerializer(serializers.ModelSerializer):
                   'depleted', 'coordinates',
                   'comment')
 
+    # values() lookups and conversions giving the same results as the method
+    # fields below, used to stream exports without loading model instances.
+    values_fields = {
+        "location_barcode": ("container__location__barcode", lambda barcode: "" if barcode is None else barcode),
+        "current_volume": ("volume_history__-1__volume_value",
+                           lambda volume: float_to_decimal(0.0 if volume is None else volume)),
+        "father_name": ("individual__father__name", lambda name: "" if name is None else name),
+        "mother_name": ("individual__mother__name", lambda name: "" if name is None else name),
+    }
+
     def get_location_barcode(self, obj):
         if obj.container.location is None:
             return ''
@@ -117,6 +153,12 @@ class NestedSampleSerializer(serializers.ModelSerializer):
         fields = "__all__"
 
 
+class TemplateImportJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = TemplateImportJob
+        exclude = ("template", "token", "template_hash")
+
+
 class VersionSerializer(serializers.ModelSerializer):
     class Meta:
         model = Version
@@ -0,0 +1,478 @@
+"""
+Summary statistics for dashboards.
+
+Summaries are read from running counts (SummaryCount), which are updated
+incrementally whenever samples or containers are saved or deleted: through
+model signals, and through counting_changes for bulk writes, which don't send
+signals. Writers only insert the changes to the counts (SummaryCountChange),
+in the same transaction as the objects, so that rolled back imports
+(including dry runs) leave them untouched and concurrent writers never wait on
+each other for the few counts every write changes, such as total_count.
+Changes are added to the counts they're for when reading the summaries, and
+folded into them once there are enough of them.
+
+The counts can always be recomputed from scratch, and corrected if they ever
+drift, with reconcile_summaries (see the reconcile_summaries command).
+"""
+
+from collections import Counter
+from contextlib import contextmanager
+from django.db import connection, transaction
+from django.db.models import Model
+from django.db.models.signals import post_delete, post_init, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from typing import Any, Callable, Dict, FrozenSet, Iterable, List, NamedTuple, Optional, Tuple, Type
+
+from .models import Container, Sample, SampleKind, SummaryCount, SummaryCountChange
+
+
+__all__ = [
+    "SAMPLE_SUMMARY",
+    "CONTAINER_SUMMARY",
+    "SUMMARIES_BY_MODEL",
+    "compute_sample_summary",
+    "compute_container_summary",
+    "get_sample_summary",
+    "get_container_summary",
+    "get_total_counts",
+    "counting_changes",
+    "fold_summary_changes",
+    "reconcile_summaries",
+]
+
+
+SAMPLE_SUMMARY = "sample"
+CONTAINER_SUMMARY = "container"
+
+# Summary counts an object contributes to, by (summary, dimension, value).
+# Dimensions are the keys of the summary dictionaries; overall counts, such as
+# total_count, have a blank value.
+SummaryKey = Tuple[str, str, str]
+
+
+def _empty_sample_summary() -> dict:
+    return {
+        "total_count": 0,
+        "extracted_count": 0,
+        "kinds_counts": {},
+        "tissue_source_counts": {},
+        "collection_site_counts": {},
+        "experimental_group_counts": {},
+    }
+
+
+def _empty_container_summary() -> dict:
+    return {
+        "total_count": 0,
+        "root_count": 0,
+        "kind_counts": {},
+    }
+
+
+# Summary in which objects of a model are counted
+SUMMARIES_BY_MODEL = {
+    Sample: SAMPLE_SUMMARY,
+    Container: CONTAINER_SUMMARY,
+}
+
+_EMPTY_SUMMARIES = {
+    SAMPLE_SUMMARY: _empty_sample_summary,
+    CONTAINER_SUMMARY: _empty_container_summary,
+}
+
+
+# Computing summaries from scratch
+
+# Values of GROUPING(k.name, s.tissue_source, s.collection_site) for each of
+# the grouping sets below; bits are set for the columns which aren't grouped.
+_BY_SAMPLE_KIND = 0b011
+_BY_TISSUE_SOURCE = 0b101
+_BY_COLLECTION_SITE = 0b110
+_TOTALS = 0b111
+_BY_EXPERIMENTAL_GROUP = -1
+
+# Sample counts by kind, tissue source and collection site, and in total, are
+# all computed in a single pass with grouping sets. Experimental groups are
+# JSON arrays, expanded to count samples by group.
+_SAMPLE_SUMMARY_SQL = """
+SELECT
+    GROUPING(k.name, s.tissue_source, s.collection_site),
+    COALESCE(k.name, s.tissue_source, s.collection_site),
+    COUNT(*),
+    COUNT(s.extracted_from_id)
+FROM {sample} s JOIN {sample_kind} k ON k.id = s.sample_kind_id
+GROUP BY GROUPING SETS ((k.name), (s.tissue_source), (s.collection_site), ())
+
+UNION ALL
+
+SELECT {by_experimental_group}, g.value, COUNT(*), 0
+FROM {sample} s CROSS JOIN LATERAL jsonb_array_elements_text(s.experimental_group) AS g(value)
+WHERE jsonb_typeof(s.experimental_group) = 'array'
+GROUP BY g.value
+"""
+
+
+def compute_sample_summary() -> dict:
+    summary = _empty_sample_summary()
+
+    counts_keys = {
+        _BY_SAMPLE_KIND: "kinds_counts",
+        _BY_TISSUE_SOURCE: "tissue_source_counts",
+        _BY_COLLECTION_SITE: "collection_site_counts",
+        _BY_EXPERIMENTAL_GROUP: "experimental_group_counts",
+    }
+
+    with connection.cursor() as cursor:
+        cursor.execute(_SAMPLE_SUMMARY_SQL.format(
+            sample=Sample._meta.db_table,
+            sample_kind=SampleKind._meta.db_table,
+            by_experimental_group=_BY_EXPERIMENTAL_GROUP,
+        ))
+
+        for grouping, value, count, extracted_count in cursor.fetchall():
+            if grouping == _TOTALS:
+                summary["total_count"] = count
+                summary["extracted_count"] = extracted_count
+            else:
+                summary[counts_keys[grouping]][value] = count
+
+    return summary
+
+
+# Container counts by kind, and in total
+_CONTAINER_SUMMARY_SQL = """
+SELECT kind, COUNT(*), COUNT(*) FILTER (WHERE location_id IS NULL)
+FROM {container}
+GROUP BY ROLLUP (kind)
+"""
+
+
+def compute_container_summary() -> dict:
+    summary = _empty_container_summary()
+
+    with connection.cursor() as cursor:
+        cursor.execute(_CONTAINER_SUMMARY_SQL.format(container=Container._meta.db_table))
+
+        for kind, count, root_count in cursor.fetchall():
+            if kind is None:
+                summary["total_count"] = count
+                summary["root_count"] = root_count
+            else:
+                summary["kind_counts"][kind] = count
+
+    return summary
+
+
+# Reading summaries from the running counts
+
+# Running counts plus their changes not yet folded in, and how many of those there are
+_READ_COUNTS_SQL = """
+SELECT summary, dimension, value, SUM(count)::bigint, COUNT(*) - COUNT(folded)
+FROM (
+    SELECT summary, dimension, value, count, TRUE AS folded FROM {counts} WHERE summary = ANY(%s) {where}
+    UNION ALL
+    SELECT summary, dimension, value, count, NULL FROM {changes} WHERE summary = ANY(%s) {where}
+) c
+GROUP BY summary, dimension, value
+"""
+
+# Folds changes into the running counts, skipping those other transactions are
+# folding (or are yet to commit), so that folding never waits on writers or on
+# other folds. Counts are updated in key order, for concurrent folds to lock
+# them in the same order.
+_FOLD_CHANGES_SQL = """
+WITH folded AS (
+    DELETE FROM {changes} WHERE id IN (
+        SELECT id FROM {changes} ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED
+    )
+    RETURNING summary, dimension, value, count
+)
+INSERT INTO {counts} (summary, dimension, value, count)
+SELECT summary, dimension, value, SUM(count) FROM folded
+GROUP BY summary, dimension, value
+ORDER BY summary, dimension, value
+ON CONFLICT (summary, dimension, value) DO UPDATE SET count = {counts}.count + EXCLUDED.count
+"""
+
+# Changes are folded into the counts when reading a summary finds more of them than this
+FOLD_CHANGES_THRESHOLD = 1000
+
+
+def _read_counts(summaries: List[str], dimension: Optional[str] = None) -> Tuple[Counter, int]:
+    with connection.cursor() as cursor:
+        cursor.execute(_READ_COUNTS_SQL.format(
+            counts=SummaryCount._meta.db_table,
+            changes=SummaryCountChange._meta.db_table,
+            where="" if dimension is None else "AND dimension = %s",
+        ), [summaries, *([] if dimension is None else [dimension])] * 2)
+        rows = cursor.fetchall()
+
+    return Counter({(summary, d, value): count for summary, d, value, count, _ in rows}), sum(r[4] for r in rows)
+
+
+def fold_summary_changes(limit: Optional[int] = None) -> None:
+    """
+    Adds recorded changes (up to limit of them, if given) to the running
+    counts they are for, in a transaction of its own.
+    """
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(_FOLD_CHANGES_SQL.format(
+            counts=SummaryCount._meta.db_table,
+            changes=SummaryCountChange._meta.db_table,
+        ), [limit])
+
+
+def _get_summary(name: str) -> dict:
+    summary = _EMPTY_SUMMARIES[name]()
+
+    counts, changes = _read_counts([name])
+    if changes > FOLD_CHANGES_THRESHOLD:
+        fold_summary_changes()
+
+    for (_, dimension, value), count in counts.items():
+        if count <= 0:
+            continue
+        if isinstance(summary[dimension], dict):
+            summary[dimension][value] = count
+        else:
+            summary[dimension] = count
+
+    return summary
+
+
+def get_sample_summary() -> dict:
+    return _get_summary(SAMPLE_SUMMARY)
+
+
+def get_container_summary() -> dict:
+    return _get_summary(CONTAINER_SUMMARY)
+
+
+def get_total_counts(summaries: Iterable[str]) -> List[Tuple[str, int]]:
+    """
+    Returns the (summary, total count) of the given summaries, sorted.
+    """
+
+    summaries = list(summaries)
+    if not summaries:
+        return []
+    counts, _ = _read_counts(summaries, "total_count")
+    return sorted((summary, count) for (summary, _, _), count in counts.items())
+
+
+# Keeping the running counts up to date
+
+# Names of sample kinds by primary key, cached as kinds hardly ever change
+_sample_kind_names: Dict[Any, str] = {}
+
+
+def _sample_kind_name(pk) -> str:
+    if pk not in _sample_kind_names:
+        _sample_kind_names.clear()
+        _sample_kind_names.update(SampleKind.objects.values_list("pk", "name"))
+    return _sample_kind_names[pk]
+
+
+@receiver(post_save, sender=SampleKind)
+@receiver(post_delete, sender=SampleKind)
+def _forget_sample_kind_names(**kwargs):
+    _sample_kind_names.clear()
+
+
+def _sample_counts(sample_kind_id, extracted_from_id, tissue_source: str, collection_site: str,
+                   experimental_group) -> Counter:
+    counts = Counter((
+        (SAMPLE_SUMMARY, "total_count", ""),
+        (SAMPLE_SUMMARY, "kinds_counts", _sample_kind_name(sample_kind_id)),
+        (SAMPLE_SUMMARY, "tissue_source_counts", tissue_source),
+        (SAMPLE_SUMMARY, "collection_site_counts", collection_site),
+    ))
+    if extracted_from_id is not None:
+        counts[(SAMPLE_SUMMARY, "extracted_count", "")] += 1
+    if isinstance(experimental_group, list):
+        counts.update((SAMPLE_SUMMARY, "experimental_group_counts", g) for g in experimental_group)
+    return counts
+
+
+def _container_counts(kind: str, location_id) -> Counter:
+    counts = Counter((
+        (CONTAINER_SUMMARY, "total_count", ""),
+        (CONTAINER_SUMMARY, "kind_counts", kind),
+    ))
+    if location_id is None:
+        counts[(CONTAINER_SUMMARY, "root_count", "")] += 1
+    return counts
+
+
+class _CountedModel(NamedTuple):
+    # Model fields the counts of an object depend on
+    fields: FrozenSet[str]
+    # Attributes (and values() lookups) holding what the counts of an object depend on
+    attnames: Tuple[str, ...]
+    # Counts of an object, from its values
+    counts: Callable[..., Counter]
+
+
+_COUNTED_MODELS: Dict[Type[Model], _CountedModel] = {
+    Sample: _CountedModel(
+        fields=frozenset({"sample_kind", "extracted_from", "tissue_source", "collection_site", "experimental_group"}),
+        attnames=("sample_kind_id", "extracted_from_id", "tissue_source", "collection_site", "experimental_group"),
+        counts=_sample_counts,
+    ),
+    Container: _CountedModel(
+        fields=frozenset({"kind", "location"}),
+        attnames=("kind", "location_id"),
+        counts=_container_counts,
+    ),
+}
+
+
+def _instance_values(model: Type[Model], instance: Model) -> Optional[tuple]:
+    # None if some of the values aren't loaded (deferred fields)
+    attnames = _COUNTED_MODELS[model].attnames
+    if not all(a in instance.__dict__ for a in attnames):
+        return None
+    # Lists (experimental groups) are copied, as they may be changed in place
+    return tuple(list(v) if isinstance(v, list) else v for v in (instance.__dict__[a] for a in attnames))
+
+
+def _stored_counts(model: Type[Model], pks: List[Any]) -> Counter:
+    counted = _COUNTED_MODELS[model]
+    counts = Counter()
+    if pks:
+        for values in model.objects.filter(pk__in=pks).values_list(*counted.attnames):
+            counts.update(counted.counts(*values))
+    return counts
+
+
+def _instance_counts(model: Type[Model], instances: Iterable[Model]) -> Counter:
+    counted = _COUNTED_MODELS[model]
+    counts = Counter()
+    for instance in instances:
+        counts.update(counted.counts(*(getattr(instance, a) for a in counted.attnames)))
+    return counts
+
+
+def _add_counts(before: Counter, after: Counter) -> None:
+    # Changes are only ever inserted, so that concurrent writers don't wait on
+    # each other's counts until their transactions end
+    delta = Counter(after)
+    delta.subtract(before)
+    changes = [SummaryCountChange(summary=summary, dimension=dimension, value=value, count=n)
+               for (summary, dimension, value), n in delta.items() if n != 0]
+    if changes:
+        SummaryCountChange.objects.bulk_create(changes)
+
+
+@contextmanager
+def counting_changes(instances: Iterable[Model], fields: Optional[Iterable[str]] = None):
+    """
+    Updates summary counts for changes made within the block to the given
+    objects, for writes which don't send model signals, i.e. bulk_create and
+    bulk_update. Objects without a primary key once the block exits are taken
+    as not saved. Counts aren't updated if the block raises an exception.
+
+    If given, fields limits the changes to the given model fields, as for
+    bulk_update; nothing is counted if none of them are summarized.
+    """
+
+    fields = None if fields is None else frozenset(fields)
+
+    by_model: Dict[Type[Model], List[Model]] = {}
+    for instance in instances:
+        model = instance._meta.concrete_model
+        if model in _COUNTED_MODELS and (fields is None or fields & _COUNTED_MODELS[model].fields):
+            by_model.setdefault(model, []).append(instance)
+
+    before = {model: _stored_counts(model, [i.pk for i in group if i.pk is not None])
+              for model, group in by_model.items()}
+
+    yield
+
+    for model, group in by_model.items():
+        _add_counts(before[model], _instance_counts(model, (i for i in group if i.pk is not None)))
+        for instance in group:
+            instance._summary_values = _instance_values(model, instance)
+
+
+# Objects remember the values they were loaded (or last saved) with, so that
+# saving or deleting them doesn't need to read them back first.
+
+@receiver(post_init, sender=Sample)
+@receiver(post_init, sender=Container)
+def _remember_values(sender, instance, **kwargs):
+    instance._summary_values = _instance_values(sender, instance)
+
+
+@receiver(pre_save)
+@receiver(pre_delete)
+def _count_before_write(sender, instance, **kwargs):
+    model = sender._meta.concrete_model
+    if model not in _COUNTED_MODELS:
+        return
+
+    values = getattr(instance, "_summary_values", None)
+    if instance._state.adding and instance.pk is None:
+        instance._summary_counts_before = Counter()
+    elif not instance._state.adding and values is not None:
+        instance._summary_counts_before = _COUNTED_MODELS[model].counts(*values)
+    else:
+        # Not loaded from the database, or only partly: read back what's stored
+        instance._summary_counts_before = _stored_counts(model, [instance.pk])
+
+
+@receiver(post_save)
+def _count_after_save(sender, instance, **kwargs):
+    model = sender._meta.concrete_model
+    if model in _COUNTED_MODELS:
+        _add_counts(instance.__dict__.pop("_summary_counts_before", Counter()), _instance_counts(model, (instance,)))
+        instance._summary_values = _instance_values(model, instance)
+
+
+@receiver(post_delete)
+def _count_after_delete(sender, instance, **kwargs):
+    if sender._meta.concrete_model in _COUNTED_MODELS:
+        _add_counts(instance.__dict__.pop("_summary_counts_before", Counter()), Counter())
+
+
+# Reconciliation
+
+def _summary_counts(name: str, summary: dict) -> Counter:
+    counts = Counter()
+    for dimension, value in summary.items():
+        if isinstance(value, dict):
+            counts.update({(name, dimension, v): n for v, n in value.items()})
+        else:
+            counts[(name, dimension, "")] = value
+    return counts
+
+
+def reconcile_summaries() -> Dict[SummaryKey, Tuple[int, int]]:
+    """
+    Recomputes every summary from scratch and corrects the running counts
+    where they differ, after folding in every recorded change. Writes to
+    samples and containers (and other folds) wait for this to finish, so that
+    no change is counted twice or missed. Returns the corrected counts, as
+    (previous count, correct count) by summary key.
+    """
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(f"LOCK TABLE {Sample._meta.db_table}, {Container._meta.db_table} IN SHARE MODE")
+            cursor.execute(f"LOCK TABLE {SummaryCountChange._meta.db_table} IN EXCLUSIVE MODE")
+        fold_summary_changes()
+
+        stored = Counter({
+            (summary, dimension, value): count
+            for summary, dimension, value, count in SummaryCount.objects.select_for_update().values_list(
+                "summary", "dimension", "value", "count")
+        })
+        computed = _summary_counts(SAMPLE_SUMMARY, compute_sample_summary())
+        computed.update(_summary_counts(CONTAINER_SUMMARY, compute_container_summary()))
+
+        _add_counts(stored, computed)
+        fold_summary_changes()
+
+    return {key: (stored[key], computed[key]) for key in stored.keys() | computed.keys()
+            if stored[key] != computed[key]}
@@ -0,0 +1,188 @@
+"""
+Background processing of queued template submissions. Jobs are stored in the
+database as TemplateImportJob objects, so no message broker is needed; they
+are picked up and run by the run_template_jobs management command.
+Successful template checks are stored as jobs as well, so that any process
+can submit them by token, until they are submitted or expire.
+
+While a job runs, its worker reports progress and a heartbeat. Jobs whose
+heartbeat stopped, e.g. because their worker crashed, are queued again; their
+import ran in a transaction, so nothing of it was saved. Template files are
+deleted once their job succeeds or fails.
+"""
+
+import reversion
+import threading
+
+from datetime import timedelta
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, connection, transaction
+from django.utils import timezone
+from typing import Optional
+
+from . import viewsets
+from .models import TemplateImportJob
+from .template_reader import read_template
+
+
+__all__ = [
+    "claim_next_job",
+    "delete_expired_checks",
+    "requeue_stale_jobs",
+    "run_job",
+    "serialize_import_errors",
+]
+
+
+# Number of seconds between two progress updates (and heartbeats) of a running job
+PROGRESS_INTERVAL = 1.0
+
+
+def serialize_import_errors(result) -> dict:
+    def validation_error(e: ValidationError):
+        return e.message_dict if hasattr(e, "error_dict") else e.messages
+
+    return {
+        "base_errors": [str(e.error) for e in result.base_errors],
+        "rows": [{
+            "row": i,
+            "errors": [str(e.error) for e in r.errors],
+            "validation_error": validation_error(r.validation_error) if r.validation_error else None,
+        } for i, r in enumerate(result.rows, 1) if r.errors or r.validation_error],
+    }
+
+
+class _JobProgress:
+    """
+    Writes a running job's progress and heartbeat every PROGRESS_INTERVAL
+    seconds, from a thread with its own database connection: the import runs
+    inside a transaction, so progress written through the worker's connection
+    wouldn't be visible to anyone polling the job until the import is over.
+    Rows are counted in memory in the meantime.
+    """
+
+    def __init__(self, job_id: int):
+        self.job_id = job_id
+        self.rows_processed = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        try:
+            while not self._stopped.wait(PROGRESS_INTERVAL):
+                try:
+                    TemplateImportJob.objects.filter(pk=self.job_id, status=TemplateImportJob.STATUS_RUNNING).update(
+                        rows_processed=self.rows_processed, heartbeat_at=timezone.now())
+                except DatabaseError:
+                    # Keep reporting; the job would be queued again if the heartbeat stopped
+                    connection.close()
+        finally:
+            connection.close()  # The thread's own connection
+
+
+def requeue_stale_jobs() -> int:
+    """
+    Queues running jobs whose worker hasn't reported for longer than
+    TEMPLATE_JOB_STALE_TIMEOUT again, returning how many were.
+    """
+
+    stale = timezone.now() - timedelta(seconds=settings.TEMPLATE_JOB_STALE_TIMEOUT)
+    return TemplateImportJob.objects.filter(status=TemplateImportJob.STATUS_RUNNING, heartbeat_at__lt=stale).update(
+        status=TemplateImportJob.STATUS_QUEUED, started_at=None, heartbeat_at=None, rows_processed=0)
+
+
+def delete_expired_checks() -> int:
+    """
+    Deletes template checks which weren't submitted within
+    TEMPLATE_CHECK_TOKEN_TTL, along with their template files, returning how
+    many were.
+    """
+
+    expired = TemplateImportJob.objects.filter(
+        status=TemplateImportJob.STATUS_CHECKED,
+        created_at__lt=timezone.now() - timedelta(seconds=settings.TEMPLATE_CHECK_TOKEN_TTL))
+
+    for job in expired:
+        job.template.delete(save=False)
+    return expired.delete()[0]
+
+
+def claim_next_job() -> Optional[TemplateImportJob]:
+    """
+    Marks the oldest queued job as running and returns it, or returns None if
+    there are no queued jobs. Abandoned jobs are queued again first, and
+    expired template checks deleted. Safe to use from multiple workers at once.
+    """
+
+    requeue_stale_jobs()
+    delete_expired_checks()
+
+    with transaction.atomic():
+        job = (TemplateImportJob.objects.select_for_update(skip_locked=True)
+               .filter(status=TemplateImportJob.STATUS_QUEUED)
+               .order_by("created_at", "id")
+               .first())
+
+        if job is not None:
+            job.status = TemplateImportJob.STATUS_RUNNING
+            job.started_at = job.heartbeat_at = timezone.now()
+            job.save(update_fields=("status", "started_at", "heartbeat_at"))
+
+    return job
+
+
+def run_job(job: TemplateImportJob) -> None:
+    """
+    Imports a job's template and records the outcome on the job.
+    """
+
+    resource_class = getattr(viewsets, job.viewset).template_action_list[job.action]["resource"]
+
+    def finish(status: str, result: dict):
+        job.status = status
+        job.result = result
+        job.finished_at = timezone.now()
+        # Jobs aren't run again once over, so their template isn't needed anymore
+        job.template.delete(save=False)
+        job.save(update_fields=("status", "rows_processed", "result", "finished_at", "template"))
+
+    try:
+        with job.template.open("rb") as template_file:
+            dataset = read_template(
+                template_file,
+                job.template.name.endswith("xlsx"),
+                preamble_rows=0 if job.preamble_skipped else resource_class.preamble_rows,
+                max_rows=settings.TEMPLATE_MAX_ROWS)
+
+        job.rows_total = len(dataset)
+        job.heartbeat_at = timezone.now()
+        job.save(update_fields=("rows_total", "heartbeat_at"))
+
+        with _JobProgress(job.pk) as progress:
+            resource = resource_class()
+            resource.progress_callback = lambda row_number: setattr(progress, "rows_processed", row_number)
+
+            with reversion.create_revision():
+                reversion.set_user(job.created_by)
+                result = resource.import_data(dataset)
+
+    except Exception as e:
+        finish(TemplateImportJob.STATUS_FAILED, {"base_errors": [str(e)], "rows": []})
+        return
+
+    job.rows_processed = job.rows_total
+
+    if result.has_errors() or result.has_validation_errors():
+        finish(TemplateImportJob.STATUS_FAILED, serialize_import_errors(result))
+        return
+
+    finish(TemplateImportJob.STATUS_SUCCEEDED, {})
@@ -0,0 +1,157 @@
+"""
+Streaming reader for uploaded CSV and XLSX templates. Rows are read from the
+upload one at a time, the preamble is skipped as it goes and rows are
+normalized on the way into the dataset, so only one copy of the template's
+contents is ever held in memory.
+"""
+
+import codecs
+import csv
+import hashlib
+import openpyxl
+
+from io import BytesIO
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.utils.exceptions import InvalidFileException
+from tablib import Dataset
+from typing import Iterable, Iterator, Optional
+from zipfile import BadZipFile
+
+from .utils import str_normalize
+
+
+__all__ = [
+    "TemplateDataset",
+    "TemplateReadError",
+    "normalize_template_row",
+    "iter_template_rows",
+    "read_template",
+    "hash_template",
+    "write_template",
+]
+
+
+class TemplateReadError(Exception):
+    pass
+
+
+class TemplateDataset(Dataset):
+    """
+    Dataset whose preamble was already skipped while reading the template,
+    and whose rows are already normalized; see skip_rows.
+    """
+    preamble_skipped = True
+
+
+def normalize_template_row(row: Iterable, col_skip: int = 1) -> Optional[tuple]:
+    """
+    Normalizes a template row's values, returning None if the row is blank
+    (ignoring the first col_skip columns, e.g. the row number.)
+    """
+    row = tuple(row)
+    if all(c is None or c == "" for c in row[col_skip:]):
+        return None
+    return tuple(str_normalize(c) if isinstance(c, str) else ("" if c is None else c) for c in row)
+
+
+def iter_template_rows(template_file, xlsx: bool) -> Iterator[tuple]:
+    """
+    Lazily yields the raw rows of an uploaded template file. XLSX files are
+    read from the first sheet, using openpyxl's read-only mode.
+    """
+
+    if xlsx:
+        try:
+            workbook = openpyxl.load_workbook(template_file, read_only=True)
+        except (BadZipFile, InvalidFileException, KeyError) as e:
+            raise TemplateReadError(f"Could not read XLSX template: {e}")
+
+        try:
+            yield from workbook.active.iter_rows(values_only=True)
+        finally:
+            workbook.close()
+
+        return
+
+    try:
+        # Uploaded files are iterated line by line (keeping line endings, so
+        # quoted values spanning multiple lines are still parsed correctly.)
+        yield from (tuple(r) for r in csv.reader(codecs.iterdecode(template_file, "utf-8")))
+    except UnicodeDecodeError as e:
+        raise TemplateReadError(f"Could not decode CSV template: {e}")
+
+
+def read_template(template_file, xlsx: bool, preamble_rows: int = 0, max_rows: Optional[int] = None,
+                  col_skip: int = 1) -> TemplateDataset:
+    """
+    Reads an uploaded template into a dataset, skipping the first
+    preamble_rows rows and using the row after them as headers. Blank rows are
+    skipped and values are normalized, as done by skip_rows. Reading stops with
+    a TemplateReadError as soon as more than max_rows rows of data are found.
+    """
+
+    dataset = TemplateDataset()
+    width = 0
+
+    rows = iter_template_rows(template_file, xlsx)
+
+    try:
+        for i, row in enumerate(rows):
+            if i < preamble_rows:
+                continue
+
+            if i == preamble_rows:
+                dataset.headers = list(row)
+                width = len(row)
+                continue
+
+            row = normalize_template_row(row, col_skip)
+            if row is None:
+                continue
+
+            if max_rows is not None and dataset.height >= max_rows:
+                raise TemplateReadError(f"Template exceeds the maximum of {max_rows} rows")
+
+            # Pad or cut rows to the width of the headers, since spreadsheet
+            # rows don't all end at the same column.
+            dataset.append((*row[:width], *([""] * (width - len(row)))))
+
+    finally:
+        rows.close()
+
+    return dataset
+
+
+def hash_template(template_file) -> str:
+    """
+    Computes a SHA-256 digest of an uploaded template's contents, reading it in
+    chunks and rewinding it afterwards so that it can still be read.
+    """
+    digest = hashlib.sha256()
+    for chunk in template_file.chunks():
+        digest.update(chunk)
+    template_file.seek(0)
+    return digest.hexdigest()
+
+
+def write_template(dataset: Dataset) -> bytes:
+    """
+    Writes a dataset out as an XLSX file without any preamble, keeping value
+    types (e.g. dates) so that reading it back gives the same rows.
+    """
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+
+    for row in (dataset.headers, *dataset):
+        cells = []
+        for value in row:
+            cell = WriteOnlyCell(sheet, value=value)
+            if isinstance(value, str):
+                # Never let values be interpreted as formulas
+                cell.data_type = "s"
+            cells.append(cell)
+        sheet.append(cells)
+
+    stream = BytesIO()
+    workbook.save(stream)
+    return stream.getvalue()
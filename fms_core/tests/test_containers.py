@@ -1,7 +1,7 @@
 from django.test import TestCase
 
 from ..coordinates import alphas, ints
-from ..containers import CONTAINER_SPEC_96_WELL_PLATE, CONTAINER_SPEC_ROOM
+from ..containers import CONTAINER_SPEC_96_WELL_PLATE, CONTAINER_SPEC_384_WELL_PLATE, CONTAINER_SPEC_ROOM
 
 
 class AdminUtilsTestCase(TestCase):
@@ -19,3 +19,10 @@ class AdminUtilsTestCase(TestCase):
         })
 
         self.assertTrue(CONTAINER_SPEC_ROOM.is_source)
+
+    def test_container_spec_coordinates(self):
+        self.assertEqual(CONTAINER_SPEC_96_WELL_PLATE.capacity, 96)
+        self.assertEqual(CONTAINER_SPEC_384_WELL_PLATE.capacity, 384)
+        self.assertEqual(CONTAINER_SPEC_ROOM.capacity, 1)
+        self.assertEqual(CONTAINER_SPEC_384_WELL_PLATE.validate_and_normalize_coordinates("P24 "), "P24")
+        self.assertEqual(CONTAINER_SPEC_384_WELL_PLATE.coordinate_codec.to_index("P24"), 383)
@@ -1,5 +1,18 @@
+from django.core.exceptions import ValidationError
+from django.db import connection
 from django.test import TestCase
-from ..coordinates import CoordinateError, alphas, ints, validate_and_normalize_coordinates
+from django.test.utils import CaptureQueriesContext
+from ..coordinates import (
+    CoordinateCodec,
+    CoordinateError,
+    alphas,
+    ints,
+    validate_and_normalize_coordinates,
+    coordinate_occupancy_index,
+    get_coordinate_occupancy_index,
+)
+from ..models import Container
+from .constants import create_container
 
 
 class CoordinateTestCase(TestCase):
@@ -70,3 +83,124 @@ class CoordinateTestCase(TestCase):
         for iv in ("1A", "I12", "A13", "CC", "231", "  "):
             with self.assertRaises(CoordinateError):
                 validate_and_normalize_coordinates(iv, cs)
+
+    def test_codec(self):
+        codec = CoordinateCodec((alphas(8), ints(12, pad_to=2)))
+        self.assertEqual(codec.capacity, 96)
+        self.assertEqual(codec.shape, (8, 12))
+
+        self.assertEqual(codec.normalize(" B03 "), "B03")
+        self.assertEqual(codec.to_index("A01"), 0)
+        self.assertEqual(codec.to_index("A12"), 11)
+        self.assertEqual(codec.to_index("B01"), 12)
+        self.assertEqual(codec.to_index("H12"), 95)
+        self.assertEqual(codec.to_axes("B03"), (1, 2))
+
+        for i in range(codec.capacity):
+            self.assertEqual(codec.to_index(codec.from_index(i)), i)
+
+        for iv in (-1, 96):
+            with self.assertRaises(CoordinateError):
+                codec.from_index(iv)
+
+        for iv in ("A1", "I01", "A13", "  "):
+            with self.assertRaises(CoordinateError):
+                codec.to_index(iv)
+
+    def test_codec_no_coords(self):
+        codec = CoordinateCodec(())
+        self.assertEqual(codec.capacity, 1)
+        self.assertEqual(codec.shape, ())
+        self.assertEqual(codec.to_index(" "), 0)
+        self.assertEqual(codec.from_index(0), "")
+        self.assertEqual(codec.to_axes(""), ())
+
+    def test_occupancy_index(self):
+        rack = Container.objects.create(**create_container(barcode="R123456"))
+        Container.objects.create(**create_container(barcode="T123456", location=rack, coordinates="A01",
+                                                    kind="tube", name="tube1"))
+
+        # Fuller racks, to check that the queries don't depend on their contents
+        full_racks = [Container.objects.create(**create_container(barcode=f"R23456{r}", name=f"full_rack{r}"))
+                      for r in range(2)]
+        for r, full_rack in enumerate(full_racks):
+            for c in range(1, 13):
+                Container.objects.create(**create_container(barcode=f"T2345{r}{c:02}", location=full_rack,
+                                                            coordinates=f"A{c:02}", kind="tube",
+                                                            name=f"full_tube{r}{c:02}"))
+
+        def count_queries(f) -> int:
+            with CaptureQueriesContext(connection) as queries:
+                f()
+            return len(queries)
+
+        def clash(location):
+            with self.assertRaises(ValidationError):
+                Container(**create_container(barcode="T123457", location=location, coordinates="A01",
+                                             kind="tube", name="tube2")).clean()
+
+        self.assertIsNone(get_coordinate_occupancy_index())
+
+        with coordinate_occupancy_index() as index:
+            self.assertIs(get_coordinate_occupancy_index(), index)
+
+            # Contents of the racks are queried the same way however many there
+            # are, and only once
+            self.assertEqual(count_queries(lambda: index.load(Container, "location", (rack.pk,))),
+                             count_queries(lambda: index.load(Container, "location", (r.pk for r in full_racks))))
+            with self.assertNumQueries(0):
+                index.load(Container, "location", (rack.pk, *(r.pk for r in full_racks)))
+
+            # Existing containers are still caught; only fetched to describe the error
+            self.assertEqual(count_queries(lambda: clash(rack)), count_queries(lambda: clash(full_racks[0])))
+
+            # Unsaved containers which were accepted are caught as well
+            t3 = Container(**create_container(barcode="T123458", location=rack, coordinates="A02", kind="tube",
+                                              name="tube3"))
+            with self.assertNumQueries(0):
+                t3.clean()
+            index.add(rack.children, t3, rack)
+            with self.assertNumQueries(0), self.assertRaises(ValidationError):
+                Container(**create_container(barcode="T123459", location=rack, coordinates="A02",
+                                             kind="tube", name="tube4")).clean()
+
+            # Moving a container frees up its previous position
+            t1 = Container.objects.get(barcode="T123456")
+            t1.coordinates = "A03"
+            t1.save()
+            Container(**create_container(barcode="T123460", location=rack, coordinates="A01", kind="tube",
+                                         name="tube5")).clean()
+
+        self.assertIsNone(get_coordinate_occupancy_index())
+
+    def test_occupancy_index_rollback(self):
+        rack = Container.objects.create(**create_container(barcode="R123456"))
+        tube = Container.objects.create(**create_container(barcode="T123456", location=rack, coordinates="A01",
+                                                           kind="tube", name="tube1"))
+
+        def check(barcode, coordinates):
+            index.check(rack.children, Container(**create_container(
+                barcode=barcode, location=rack, coordinates=coordinates, kind="tube", name=barcode)), rack)
+
+        with coordinate_occupancy_index() as index:
+            savepoint = index.savepoint()
+            t2 = Container(**create_container(barcode="T123457", location=rack, coordinates="A02", kind="tube",
+                                              name="tube2"))
+            index.add(rack.children, t2, rack)
+            tube.coordinates = "A03"
+            index.add(rack.children, tube, rack)
+            with self.assertRaises(CoordinateError):
+                check("T123458", "A02")
+            index.rollback(savepoint)
+
+            # Back to what was loaded before the savepoint
+            check("T123458", "A02")
+            check("T123458", "A03")
+            with self.assertRaises(CoordinateError):
+                check("T123458", "A01")
+
+            savepoint = index.savepoint()
+            index.add(rack.children, t2, rack)
+            index.release(savepoint)
+            with self.assertRaises(CoordinateError):
+                check("T123458", "A02")
@@ -82,6 +82,34 @@ class ContainerTest(TestCase):
         self.assertEqual(Container.objects.count(), 1)
         self.assertEqual(Container.objects.all()[0].barcode, 'ParentBarcode01')
 
+    def test_container_ancestors(self):
+        room = Container.objects.create(**create_container(barcode="room1", name="room1", kind="room"))
+        freezer = Container.objects.create(**create_container(barcode="freezer1", name="freezer1",
+                                                              kind="freezer 3 shelves", location=room))
+        rack = Container.objects.create(**create_container(barcode="rack1", name="rack1", kind="tube rack 8x12",
+                                                           location=freezer, coordinates="A01"))
+        tube = Container.objects.create(**create_container(barcode="tube1", name="tube1", kind="tube",
+                                                           location=rack, coordinates="A01"))
+        self.assertListEqual(tube.ancestors, [room.id, freezer.id, rack.id])
+
+        # Moving a container updates the ancestors of everything nested within it
+        freezer.location = None
+        freezer.save()
+        rack.refresh_from_db()
+        tube.refresh_from_db()
+        self.assertListEqual(rack.ancestors, [freezer.id])
+        self.assertListEqual(tube.ancestors, [freezer.id, rack.id])
+
+        freezer.location = room
+        freezer.save()
+        tube.refresh_from_db()
+        self.assertListEqual(tube.ancestors, [room.id, freezer.id, rack.id])
+
+        # Containers can't be moved within themselves
+        room.location = freezer
+        with self.assertRaises(ValidationError):
+            room.full_clean()
+
     # coordinates tested in a separate file
 
 
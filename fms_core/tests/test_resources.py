@@ -1,13 +1,15 @@
 import reversion
 from decimal import Decimal
 from django.core.exceptions import ValidationError
-from django.db import IntegrityError, transaction
+from django.db import IntegrityError, connection, transaction
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from pathlib import Path
 from reversion.models import Version
 from tablib import Dataset
+from unittest.mock import patch
 
-from ..models import Container, Sample, ExtractedSample, Individual
+from ..models import Container, Sample, ExtractedSample, Individual, SampleKind
 from ..resources import (
     ContainerResource,
     ExtractionResource,
@@ -18,6 +20,7 @@ from ..resources import (
 )
 # noinspection PyProtectedMember
 from ..resources._utils import skip_rows
+from .constants import create_individual, create_sample
 
 
 def get_ds():
@@ -97,6 +100,17 @@ class ResourcesTestCase(TestCase):
         self.load_containers()
         self.assertEqual(len(Container.objects.all()), 6)
 
+    def test_import_revision_comment(self):
+        with reversion.create_revision(), open(CONTAINERS_CSV) as cf, \
+                CaptureQueriesContext(connection) as queries:
+            self.cr.import_data(Dataset().load(cf.read()), raise_errors=True)
+
+        # Versions are only written when the revision is saved, not looked up for every row
+        self.assertFalse(any("reversion_version" in q["sql"] for q in queries))
+
+        v = Version.objects.get_for_object(Container.objects.get(barcode="box001")).first()
+        self.assertEqual(v.revision.comment, ContainerResource.revision_comment)
+
     def test_sample_import(self):
         self.load_samples()
 
@@ -136,6 +150,106 @@ class ResourcesTestCase(TestCase):
                     {'concentration': ['Concentration must be specified if the biospecimen_type is DNA']})
                 raise e
 
+    def test_sample_import_shared_objects(self):
+        self.load_samples()
+
+        # Containers and individuals referenced by the template are created
+        # once, then shared by every row which refers to them.
+        self.assertEqual(Container.objects.filter(barcode="tube005").count(), 1)
+        self.assertEqual(Sample.objects.get(name="sample4").container.location.barcode, "rack002")
+        # Containers created in bulk are indexed within their locations too
+        self.assertListEqual(Container.objects.get(barcode="tube005").ancestors,
+                             [Container.objects.get(barcode="rack002").id])
+        self.assertEqual(Individual.objects.get(name="DLMother").mother_of.count(), 1)
+
+        s = Sample.objects.get(name="sample1")
+        vs = Version.objects.filter(object_id=str(s.container_id), content_type__model="container").count()
+        self.assertEqual(vs, 1)
+
+    def test_sample_import_template_overlap(self):
+        self.load_containers()
+
+        # Two new tubes at the same coordinates of the same rack can't both be
+        # created, even though neither exists in the database yet.
+        # noinspection PyTypeChecker
+        with reversion.create_revision(), self.assertRaises(ValidationError), \
+                open(TEST_DATA_ROOT / "tube_overlap.csv") as sf:
+            s = Dataset().load(sf.read())
+            try:
+                self.sr.import_data(s, raise_errors=True)
+            except ValidationError as e:
+                self.assertIn("coordinates", e.message_dict)
+                raise e
+
+    def test_failed_row_frees_coordinates(self):
+        self.load_containers()
+
+        def after_import_row(row, row_result, **kwargs):
+            if row["Sample Name"] == "sample1":
+                raise ValueError("Failed after saving")
+
+        plate = "96-well plate,sample_plate,plate001,"
+        with open(TEST_DATA_ROOT / "tube_overlap.csv") as sf:
+            template = sf.read().replace("tube,overlap_tube_1,overlap001,rack001", plate) \
+                .replace("tube,overlap_tube_2,overlap002,rack001", plate)
+
+        # The first sample's row fails after the sample was queued for saving at
+        # A01, so the second sample can take its place.
+        with reversion.create_revision(), patch.object(self.sr, "after_import_row", after_import_row):
+            result = self.sr.import_data(Dataset().load(template))
+
+        self.assertListEqual([n for n, _ in result.row_errors()], [1])
+        self.assertListEqual(result.invalid_rows, [])
+        # Only the second sample is left to be inserted, so the bulk insert succeeds
+        self.assertListEqual(result.base_errors, [])
+
+    def test_bulk_container_conflict(self):
+        self.load_containers()
+        bulk_create = Container.objects.bulk_create
+
+        def conflicting_bulk_create(containers, *args, **kwargs):
+            # As if tube005 was created elsewhere since the template's containers were fetched
+            if any(c.barcode == "tube005" for c in containers):
+                raise IntegrityError("duplicate key value violates unique constraint")
+            return bulk_create(containers, *args, **kwargs)
+
+        with open(SAMPLES_CSV) as sf:
+            template = sf.read() + "\n6,BLOOD,sample5,fifth sample,cohort1,group1,Homo sapiens,tube,sample5_tube," \
+                                   "tube006,box001,,Ksenia Zaytseva,F,pedigree2,,,15,,site2,,2020-04-03,,"
+
+        # The containers are created one at a time, and only the row referencing
+        # the conflicting one fails.
+        with reversion.create_revision(), patch.object(Container.objects, "bulk_create", conflicting_bulk_create):
+            result = self.sr.import_data(Dataset().load(template))
+
+        self.assertListEqual([n for n, _ in result.row_errors()], [4])
+        self.assertIsInstance(result.row_errors()[0][1][0].error, IntegrityError)
+        self.assertListEqual(result.base_errors, [])
+        self.assertEqual(result.totals["new"], 4)
+
+    def test_bulk_sample_conflict(self):
+        self.load_containers()
+        bulk_create = self.sr.bulk_create
+
+        def conflict_then_bulk_create(*args, **kwargs):
+            # Taken elsewhere once the template's samples were validated
+            Sample.objects.bulk_create([Sample(**create_sample(
+                SampleKind.objects.get(name="BLOOD"), Individual.objects.create(**create_individual("elsewhere")),
+                Container.objects.get(barcode="plate001"), coordinates="A01", name="elsewhere_sample"))])
+            bulk_create(*args, **kwargs)
+
+        # The samples are saved one at a time, and the error is reported on the
+        # row of the sample which couldn't be saved rather than on the import.
+        with reversion.create_revision(), open(SAMPLES_CSV) as sf, \
+                patch.object(self.sr, "bulk_create", conflict_then_bulk_create):
+            result = self.sr.import_data(Dataset().load(sf.read()))
+
+        self.assertListEqual([n for n, _ in result.row_errors()], [3])
+        self.assertIsInstance(result.row_errors()[0][1][0].error, IntegrityError)
+        self.assertListEqual(result.base_errors, [])
+        self.assertEqual(result.totals["error"], 1)
+        self.assertEqual(result.totals["new"], 3)
+
     def test_sample_extraction_import(self):
         self.load_samples_extractions()
 
@@ -234,6 +348,23 @@ class ResourcesTestCase(TestCase):
 
         # TODO: Test leaving coordinate blank not updating container coordinate
 
+    def test_sample_update_missing_samples(self):
+        self.load_samples()
+
+        with open(SAMPLE_UPDATE_CSV) as uf:
+            u = Dataset().load(uf.read().replace("tube005", "tube999").replace("A01", "H12"))
+
+        # Every missing sample is reported for its own row
+        result = self.ur.import_data(u, dry_run=True)
+        self.assertFalse(result.base_errors)
+        self.assertFalse(result.rows[0].errors)
+        self.assertEqual(
+            str(result.rows[1].errors[0].error),
+            "Sample matching query {'container__barcode': 'tube999', 'coordinates': ''} does not exist")
+        self.assertEqual(
+            str(result.rows[2].errors[0].error),
+            "Sample matching query {'container__barcode': 'plate001', 'coordinates': 'H12'} does not exist")
+
     def test_container_move(self):
         self.load_containers()
 
@@ -245,6 +376,7 @@ class ResourcesTestCase(TestCase):
         self.assertEqual(ci.location.barcode, "rack001")
         self.assertEqual(ci.coordinates, "D05")
         self.assertEqual(ci.update_comment, "sample moved")
+        self.assertListEqual(ci.ancestors, [ci.location.id])
 
     def test_container_rename(self):
         self.load_samples()
@@ -269,6 +401,35 @@ class ResourcesTestCase(TestCase):
 
         self.assertEqual(Container.objects.filter(location=ci).count(), 2)
 
+        # Versions hold the final barcodes and names, not the temporary ones
+
+        v = Version.objects.get_for_object(ci).first()
+        self.assertEqual(v.field_dict["barcode"], "box0001")
+        self.assertEqual(v.field_dict["name"], "original_box_2")
+
+    def test_container_rename_queries(self):
+        Container.objects.bulk_create(Container(kind="tube", name=f"rename_tube_{i}", barcode=f"rename{i:03}")
+                                      for i in range(110))
+
+        with open(CONTAINER_RENAME_CSV) as rf:
+            preamble = rf.read().split("#")[0]
+
+        def rename_template(containers: range) -> str:
+            return preamble + "\n".join((
+                "#,Old Container Barcode,New Container Barcode,New Container Name,Update Comment",
+                *(f"{n},rename{i:03},renamed{i:03},," for n, i in enumerate(containers, 1)),
+            ))
+
+        def count_container_queries(template: str) -> int:
+            with reversion.create_revision(), CaptureQueriesContext(connection) as queries:
+                self.rr.import_data(Dataset().load(template), raise_errors=True)
+            return sum(1 for q in queries if "fms_core_container" in q["sql"])
+
+        # The number of queries doesn't depend on the number of containers renamed
+        self.assertEqual(count_container_queries(rename_template(range(10))),
+                         count_container_queries(rename_template(range(10, 110))))
+        self.assertEqual(Container.objects.filter(barcode__startswith="renamed").count(), 110)
+
     def _test_invalid_rename_template(self, fh, err=IntegrityError):
         with reversion.create_revision(), self.assertRaises(err):
             d = fh.read()
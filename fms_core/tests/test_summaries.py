@@ -0,0 +1,132 @@
+import reversion
+
+from django.core.management import call_command
+from django.db.models import F
+from django.test import TestCase
+from io import StringIO
+from tablib import Dataset
+from unittest.mock import patch
+
+from .. import summaries
+from ..models import Container, Individual, Sample, SampleKind, SummaryCount, SummaryCountChange
+from ..resources import ContainerResource
+from ..summaries import (
+    compute_container_summary,
+    compute_sample_summary,
+    get_container_summary,
+    get_sample_summary,
+    reconcile_summaries,
+)
+from .constants import create_container, create_individual, create_sample_container
+from .test_viewsets import CONTAINERS_CSV, load_samples
+
+
+class SummaryCountsTestCase(TestCase):
+    def assert_counts_up_to_date(self):
+        self.assertDictEqual(get_sample_summary(), compute_sample_summary())
+        self.assertDictEqual(get_container_summary(), compute_container_summary())
+
+    def test_bulk_imports(self):
+        with reversion.create_revision(), open(CONTAINERS_CSV) as f:
+            result = ContainerResource().import_data(Dataset().load(f.read()), dry_run=True)
+        self.assertFalse(result.has_errors())
+
+        # Dry runs are rolled back, counts included
+        self.assertEqual(get_container_summary()["total_count"], 0)
+
+        load_samples()
+        self.assertGreater(get_sample_summary()["extracted_count"], 0)
+        self.assert_counts_up_to_date()
+
+    def test_saves_and_deletes(self):
+        rack = Container.objects.create(**create_container(barcode="R123456"))
+        tube = Container.objects.create(**create_sample_container("tube", "TestTube01", "T123456", "A01", rack))
+        individual = Individual.objects.create(**create_individual("jdoe"))
+        sample = Sample.objects.create(
+            sample_kind=SampleKind.objects.get(name="BLOOD"),
+            name="test_sample_01",
+            individual=individual,
+            volume_history=[{"date": "2020-04-15T03:50:45.127218Z", "update_type": "update", "volume_value": "5000"}],
+            experimental_group=["EG01", "EG02"],
+            collection_site="Site1",
+            container=tube,
+        )
+        self.assert_counts_up_to_date()
+        self.assertDictEqual(get_container_summary(), {
+            "total_count": 2,
+            "root_count": 1,
+            "kind_counts": {"tube rack 8x12": 1, "tube": 1},
+        })
+
+        tube.location = None
+        tube.coordinates = ""
+        tube.save()
+        self.assertEqual(get_container_summary()["root_count"], 2)
+
+        sample.experimental_group = ["EG02", "EG03"]
+        sample.collection_site = "Site2"
+        sample.save()
+        self.assert_counts_up_to_date()
+        self.assertDictEqual(get_sample_summary()["experimental_group_counts"], {"EG02": 1, "EG03": 1})
+
+        sample.delete()
+        rack.delete()
+        self.assert_counts_up_to_date()
+        self.assertEqual(get_sample_summary()["total_count"], 0)
+        self.assertEqual(get_container_summary()["total_count"], 1)
+
+    def test_changes_folded(self):
+        load_samples()
+        self.assertTrue(SummaryCountChange.objects.exists())
+
+        summary = get_sample_summary()
+        self.assertTrue(SummaryCountChange.objects.exists())
+
+        with patch("fms_core.summaries.FOLD_CHANGES_THRESHOLD", 0):
+            self.assertDictEqual(get_sample_summary(), summary)
+        self.assertFalse(SummaryCountChange.objects.exists())
+        self.assertEqual(SummaryCount.objects.get(summary="sample", dimension="total_count").count,
+                         summary["total_count"])
+        self.assert_counts_up_to_date()
+
+    def test_saves_without_reading_back(self):
+        rack = Container.objects.create(**create_container(barcode="R123456"))
+        Container.objects.create(**create_sample_container("tube", "TestTube01", "T123456", "A01", rack))
+
+        with patch("fms_core.summaries._stored_counts", wraps=summaries._stored_counts) as stored_counts:
+            tube = Container.objects.get(barcode="T123456")
+            tube.location = None
+            tube.coordinates = ""
+            tube.save()
+            self.assertEqual(get_container_summary()["root_count"], 2)
+
+            tube.kind = "tube box 6x6"
+            tube.save()
+            self.assertEqual(get_container_summary()["kind_counts"], {"tube rack 8x12": 1, "tube box 6x6": 1})
+            stored_counts.assert_not_called()
+
+            # Values of partly loaded objects are read back
+            Container.objects.only("pk").get(barcode="T123456").delete()
+            stored_counts.assert_called_once()
+
+        self.assert_counts_up_to_date()
+
+    def test_reconcile(self):
+        load_samples()
+        self.assertDictEqual(reconcile_summaries(), {})
+
+        SummaryCount.objects.filter(summary="sample", dimension="total_count").update(count=F("count") + 5)
+        SummaryCount.objects.filter(summary="container", dimension="kind_counts", value="tube").delete()
+
+        total_count = Sample.objects.count()
+        tube_count = Container.objects.filter(kind="tube").count()
+
+        self.assertDictEqual(reconcile_summaries(), {
+            ("sample", "total_count", ""): (total_count + 5, total_count),
+            ("container", "kind_counts", "tube"): (0, tube_count),
+        })
+        self.assert_counts_up_to_date()
+
+        out = StringIO()
+        call_command("reconcile_summaries", stdout=out)
+        self.assertIn("0 corrections", out.getvalue())
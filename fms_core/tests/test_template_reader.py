@@ -0,0 +1,73 @@
+import openpyxl
+import reversion
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase
+from io import BytesIO
+from pathlib import Path
+from tablib import Dataset
+
+from ..models import Container
+from ..resources import ContainerResource
+# noinspection PyProtectedMember
+from ..resources._utils import skip_rows
+from ..template_reader import TemplateReadError, read_template
+
+
+APP_DATA_ROOT = Path(__file__).parent.parent / "example_data" / "csv"
+CONTAINERS_CSV = APP_DATA_ROOT / "containers.csv"
+
+
+def csv_upload(path: Path) -> SimpleUploadedFile:
+    with open(path, "rb") as f:
+        return SimpleUploadedFile(path.name, f.read(), content_type="text/csv")
+
+
+def xlsx_upload(rows) -> SimpleUploadedFile:
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    for row in rows:
+        sheet.append(row)
+    stream = BytesIO()
+    workbook.save(stream)
+    return SimpleUploadedFile("template.xlsx", stream.getvalue())
+
+
+class TemplateReaderTestCase(TestCase):
+    def test_read_csv(self):
+        with open(CONTAINERS_CSV) as cf:
+            expected = Dataset().load(cf.read())
+        skip_rows(expected, ContainerResource.preamble_rows)
+
+        dataset = read_template(csv_upload(CONTAINERS_CSV), False, preamble_rows=ContainerResource.preamble_rows)
+        self.assertListEqual(dataset.headers, expected.headers)
+        self.assertListEqual(dataset[:], expected[:])
+
+        # The dataset can be imported directly, without skipping the preamble again
+        with reversion.create_revision():
+            ContainerResource().import_data(dataset, raise_errors=True)
+        self.assertEqual(Container.objects.count(), 6)
+
+    def test_read_xlsx(self):
+        dataset = read_template(xlsx_upload((
+            ("Preamble",),
+            ("#", "Name", "Count"),
+            (1, " a  b ", 3),
+            (2, None, None),
+            (3, "c"),
+        )), True, preamble_rows=1)
+
+        self.assertListEqual(dataset.headers, ["#", "Name", "Count"])
+        self.assertListEqual(dataset[:], [(1, "a  b", 3), (3, "c", "")])
+
+    def test_max_rows(self):
+        with self.assertRaises(TemplateReadError):
+            read_template(csv_upload(CONTAINERS_CSV), False, preamble_rows=ContainerResource.preamble_rows,
+                          max_rows=2)
+
+    def test_invalid_files(self):
+        with self.assertRaises(TemplateReadError):
+            read_template(SimpleUploadedFile("template.xlsx", b"not a workbook"), True)
+
+        with self.assertRaises(TemplateReadError):
+            read_template(SimpleUploadedFile("template.csv", b"\xff\xfe\xfa"), False)
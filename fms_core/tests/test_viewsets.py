@@ -0,0 +1,871 @@
+import json
+import reversion
+import tempfile
+
+from collections import Counter
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.db.models import F, Q
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from pathlib import Path
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from rest_framework_csv.renderers import CSVRenderer
+from tablib import Dataset
+from typing import List
+from unittest.mock import patch
+
+from .. import exports, search_index
+from ..models import Container, Individual, Sample, SampleKind, TemplateImportJob
+from ..resources import ContainerResource, ExtractionResource, SampleResource
+from ..serializers import ContainerExportSerializer, IndividualSerializer, SampleExportSerializer
+from ..template_jobs import claim_next_job, delete_expired_checks, run_job
+from ..template_reader import read_template
+from ..viewsets import ContainerViewSet, IndividualViewSet, QueryViewSet, SampleViewSet
+from .constants import create_container, create_individual, create_sample
+
+
+APP_DATA_ROOT = Path(__file__).parent.parent / "example_data" / "csv"
+CONTAINERS_CSV = APP_DATA_ROOT / "containers.csv"
+SAMPLES_CSV = APP_DATA_ROOT / "samples.csv"
+EXTRACTIONS_CSV = APP_DATA_ROOT / "extractions.csv"
+
+
+def load_samples():
+    for resource, path in ((ContainerResource, CONTAINERS_CSV), (SampleResource, SAMPLES_CSV),
+                           (ExtractionResource, EXTRACTIONS_CSV)):
+        with reversion.create_revision(), open(path) as f:
+            resource().import_data(Dataset().load(f.read()), raise_errors=True)
+
+
+def containers_upload() -> SimpleUploadedFile:
+    with open(CONTAINERS_CSV, "rb") as f:
+        return SimpleUploadedFile(CONTAINERS_CSV.name, f.read(), content_type="text/csv")
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class TemplateActionsTestCase(TestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def check_containers(self) -> dict:
+        response = self.client.post("/api/containers/template_check/", {
+            "action": "0",
+            "template": containers_upload(),
+        }, format="multipart")
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_submit_with_token(self):
+        check = self.check_containers()
+        self.assertTrue(check["valid"])
+        self.assertIsNotNone(check["token"])
+        self.assertEqual(Container.objects.count(), 0)
+
+        response = self.client.post("/api/containers/template_submit/", {
+            "action": "0",
+            "token": check["token"],
+        }, format="multipart")
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(Container.objects.count(), 6)
+
+        # Tokens can't be re-used
+        response = self.client.post("/api/containers/template_submit/", {
+            "action": "0",
+            "token": check["token"],
+        }, format="multipart")
+        self.assertEqual(response.status_code, 400)
+
+    def test_check_shared(self):
+        check = self.check_containers()
+
+        # Checks are stored in the database rather than in a process' memory,
+        # and aren't listed with the submitted jobs.
+        cache.clear()
+        checked = TemplateImportJob.objects.get(token=check["token"])
+        self.assertEqual(checked.status, TemplateImportJob.STATUS_CHECKED)
+        self.assertEqual(self.client.get("/api/template-jobs/").data["count"], 0)
+
+        response = self.client.post("/api/containers/template_submit/", {
+            "action": "0",
+            "token": check["token"],
+        }, format="multipart")
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(Container.objects.count(), 6)
+
+        # The check and its template are deleted once submitted
+        self.assertFalse(TemplateImportJob.objects.exists())
+        self.assertFalse(default_storage.exists(checked.template.name))
+
+    def test_check_expired(self):
+        check = self.check_containers()
+        checked = TemplateImportJob.objects.get(token=check["token"])
+        TemplateImportJob.objects.filter(pk=checked.pk).update(
+            created_at=timezone.now() - timedelta(seconds=settings.TEMPLATE_CHECK_TOKEN_TTL + 1))
+
+        response = self.client.post("/api/containers/template_submit/", {
+            "action": "0",
+            "token": check["token"],
+        }, format="multipart")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Container.objects.count(), 0)
+
+        # Expired checks are deleted along with their template
+        self.assertEqual(delete_expired_checks(), 1)
+        self.assertFalse(TemplateImportJob.objects.exists())
+        self.assertFalse(default_storage.exists(checked.template.name))
+
+    def test_submit_with_token_resolving_ids(self):
+        load_samples()
+        with open(APP_DATA_ROOT / "container_rename.csv", "rb") as f:
+            template = SimpleUploadedFile("container_rename.csv", f.read(), content_type="text/csv")
+
+        response = self.client.post("/api/containers/template_check/", {"action": "2", "template": template},
+                                    format="multipart")
+        self.assertTrue(response.data["valid"])
+
+        # Rows are kept as parsed, without the IDs resolved by the dry run
+        with TemplateImportJob.objects.get(token=response.data["token"]).template.open("rb") as f:
+            checked = read_template(f, True)
+        self.assertNotIn("id", checked.headers)
+        self.assertTrue(all(len(r) == len(checked.headers) for r in checked))
+
+        response = self.client.post("/api/containers/template_submit/", {
+            "action": "2",
+            "token": response.data["token"],
+        }, format="multipart")
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(Container.objects.get(barcode="box0001").name, "original_box_2")
+
+    def test_submit_with_token_different_file(self):
+        check = self.check_containers()
+
+        response = self.client.post("/api/containers/template_submit/", {
+            "action": "0",
+            "token": check["token"],
+            "template": SimpleUploadedFile("containers.csv", b"something else", content_type="text/csv"),
+        }, format="multipart")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Container.objects.count(), 0)
+
+    def test_submit_with_token_other_user(self):
+        check = self.check_containers()
+
+        self.client.force_authenticate(user=User.objects.create_superuser("other", "other@example.com", "other"))
+        response = self.client.post("/api/containers/template_submit/", {
+            "action": "0",
+            "token": check["token"],
+        }, format="multipart")
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class TemplateJobsTestCase(TestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def run_queued_job(self, job_id: int) -> dict:
+        job = claim_next_job()
+        self.assertEqual(job.id, job_id)
+        self.assertEqual(job.status, TemplateImportJob.STATUS_RUNNING)
+        template = job.template.name
+        self.assertTrue(default_storage.exists(template))
+        run_job(job)
+        self.assertIsNone(claim_next_job())
+
+        # The template file is deleted once the job is over, whatever the outcome
+        self.assertFalse(default_storage.exists(template))
+        self.assertFalse(TemplateImportJob.objects.get(pk=job_id).template)
+
+        response = self.client.get(f"/api/template-jobs/{job_id}/")
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_async_submit(self):
+        response = self.client.post("/api/containers/template_submit/", {
+            "action": "0",
+            "template": containers_upload(),
+            "async": "true",
+        }, format="multipart")
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(Container.objects.count(), 0)
+
+        with patch("fms_core.template_jobs.PROGRESS_INTERVAL", 0.001):  # Progress reported from another thread
+            job = self.run_queued_job(response.data["job"])
+        self.assertEqual(job["status"], TemplateImportJob.STATUS_SUCCEEDED)
+        self.assertEqual(job["rows_total"], 6)
+        self.assertEqual(job["rows_processed"], 6)
+        self.assertEqual(Container.objects.count(), 6)
+
+    def test_async_submit_with_token(self):
+        check = self.client.post("/api/containers/template_check/", {
+            "action": "0",
+            "template": containers_upload(),
+        }, format="multipart").data
+
+        response = self.client.post("/api/containers/template_submit/", {
+            "action": "0",
+            "token": check["token"],
+            "async": "true",
+        }, format="multipart")
+        self.assertEqual(response.status_code, 202)
+
+        job = self.run_queued_job(response.data["job"])
+        self.assertEqual(job["status"], TemplateImportJob.STATUS_SUCCEEDED)
+        self.assertEqual(Container.objects.count(), 6)
+
+    def test_async_submit_errors(self):
+        with open(CONTAINERS_CSV, "rb") as f:
+            # Tubes in a box which doesn't exist
+            template = f.read().replace(b"1,box,original_box,box001,,", b"1,,,,,")
+
+        response = self.client.post("/api/containers/template_submit/", {
+            "action": "0",
+            "template": SimpleUploadedFile("containers.csv", template, content_type="text/csv"),
+            "async": "true",
+        }, format="multipart")
+
+        job = self.run_queued_job(response.data["job"])
+        self.assertEqual(job["status"], TemplateImportJob.STATUS_FAILED)
+        self.assertEqual(job["rows_total"], 5)
+        self.assertTrue(job["result"]["rows"])
+        self.assertEqual(Container.objects.count(), 0)
+
+    def test_async_submit_unread(self):
+        # Templates are only read by the worker
+        with patch("fms_core.viewsets.read_template") as read_template:
+            response = self.client.post("/api/containers/template_submit/", {
+                "action": "0",
+                "template": SimpleUploadedFile("containers.xlsx", b"not a workbook"),
+                "async": "true",
+            }, format="multipart")
+        self.assertEqual(response.status_code, 202)
+        read_template.assert_not_called()
+
+        job = self.run_queued_job(response.data["job"])
+        self.assertEqual(job["status"], TemplateImportJob.STATUS_FAILED)
+        self.assertTrue(job["result"]["base_errors"])
+
+        response = self.client.post("/api/containers/template_submit/", {
+            "action": "9",
+            "template": containers_upload(),
+            "async": "true",
+        }, format="multipart")
+        self.assertEqual(response.status_code, 400)
+
+    def test_requeue_stale_jobs(self):
+        response = self.client.post("/api/containers/template_submit/", {
+            "action": "0",
+            "template": containers_upload(),
+            "async": "true",
+        }, format="multipart")
+        job = claim_next_job()
+        self.assertIsNone(claim_next_job())
+
+        # The worker running the job stopped reporting
+        TemplateImportJob.objects.filter(pk=job.pk).update(
+            heartbeat_at=timezone.now() - timedelta(seconds=settings.TEMPLATE_JOB_STALE_TIMEOUT + 1))
+
+        self.assertEqual(self.run_queued_job(response.data["job"])["status"], TemplateImportJob.STATUS_SUCCEEDED)
+        self.assertEqual(Container.objects.count(), 6)
+
+    def test_jobs_visibility(self):
+        self.client.post("/api/containers/template_submit/", {
+            "action": "0",
+            "template": containers_upload(),
+            "async": "true",
+        }, format="multipart")
+
+        self.assertEqual(self.client.get("/api/template-jobs/").data["count"], 1)
+
+        self.client.force_authenticate(user=User.objects.create_user("other", "other@example.com", "other"))
+        self.assertEqual(self.client.get("/api/template-jobs/").data["count"], 0)
+
+
+class ConditionalGetTestCase(TestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+        for i in range(3):
+            response = self.client.post("/api/containers/", create_container(
+                barcode=f"R{i}", name=f"Rack{i}"), format="json")
+            self.assertEqual(response.status_code, 201)
+
+    def test_conditional_list(self):
+        response = self.client.get("/api/containers/")
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+        last_modified = response["Last-Modified"]
+
+        with self.assertNumQueries(2):  # Latest revision and object counts only
+            response = self.client.get("/api/containers/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+        response = self.client.get("/api/containers/", HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+        # Different queries and formats have different representations
+        self.assertEqual(self.client.get("/api/containers/?limit=1", HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        self.assertEqual(self.client.get("/api/containers/?format=csv", HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        container = Container.objects.get(barcode="R0")
+        self.client.patch(f"/api/containers/{container.id}/", {"comment": "updated"}, format="json")
+        response = self.client.get("/api/containers/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+
+        # Deletes don't save a revision, but change the number of containers
+        self.client.delete(f"/api/containers/{container.id}/")
+        response = self.client.get("/api/containers/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["count"], 2)
+
+    def test_conditional_detail(self):
+        container = Container.objects.get(barcode="R1")
+        url = f"/api/containers/{container.id}/"
+
+        etag = self.client.get(url)["ETag"]
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.client.delete(url)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 404)
+
+
+class SparseFieldsetTestCase(TestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        load_samples()
+
+    def get_with_queries(self, url: str):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response, [q["sql"] for q in queries]
+
+    def test_sample_fields(self):
+        response, queries = self.get_with_queries("/api/samples/?fields=id,name,container&limit=5")
+        self.assertEqual(len(response.data["results"]), 5)
+        for sample in response.data["results"]:
+            self.assertEqual(set(sample), {"id", "name", "container"})
+            self.assertEqual(sample["container"], Sample.objects.get(id=sample["id"]).container_id)
+
+        sample_query = next(q for q in queries if "FROM \"fms_core_sample\"" in q and "LIMIT" in q)
+        self.assertNotIn("volume_history", sample_query)
+        self.assertNotIn("JOIN", sample_query)
+
+        sample = Sample.objects.first()
+        response, _ = self.get_with_queries(f"/api/samples/{sample.id}/?fields=name")
+        self.assertDictEqual(response.data, {"name": sample.name})
+
+        # Nested objects are still joined when requested
+        response, queries = self.get_with_queries("/api/samples/?nested=true&fields=id,container&limit=5")
+        self.assertEqual(set(response.data["results"][0]), {"id", "container"})
+        self.assertIn("barcode", response.data["results"][0]["container"])
+        self.assertNotIn("fms_core_individual", " ".join(queries))
+
+    def test_container_fields(self):
+        full = {c["id"]: c for c in self.client.get("/api/containers/?limit=1000").data["results"]}
+
+        response, queries = self.get_with_queries("/api/containers/?fields=id,children&limit=1000")
+        for container in response.data["results"]:
+            self.assertEqual(set(container), {"id", "children"})
+            self.assertEqual(container["children"], full[container["id"]]["children"])
+
+        # Samples aren't prefetched, and children are fetched by ID only
+        self.assertFalse(any("fms_core_sample" in q for q in queries))
+        children_query = next(q for q in queries if "location_id\" IN (" in q)
+        self.assertNotIn("barcode", children_query)
+
+    def test_unknown_fields(self):
+        response = self.client.get("/api/individuals/?fields=name,bogus")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("bogus", str(response.data["fields"]))
+
+
+class QuerySearchTestCase(TestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+        rack = Container.objects.create(**create_container(barcode="R123456", name="findme_rack"))
+        tube = Container.objects.create(**create_container(
+            barcode="T123456", name="tube_findme_1", kind="tube", location=rack, coordinates="A01"))
+        individual = Individual.objects.create(**create_individual(individual_name="findme"))
+        sample_kind, _ = SampleKind.objects.get_or_create(name="BLOOD")
+        Sample.objects.create(**create_sample(sample_kind, individual, tube, name="sample_findme_01"))
+        User.objects.create_user("findme_user")
+
+    @patch("fms_core.viewsets.fzy_installed", lambda: True)
+    def test_search(self):
+        with self.assertNumQueries(8):  # Ranking, then the results of each type and their prefetched relations
+            response = self.client.get("/api/query/search/", {"q": "findme"})
+        self.assertEqual(response.status_code, 200)
+
+        self.assertCountEqual([(r["type"], r["item"].get("name", r["item"].get("username"))) for r in response.data], [
+            ("container", "findme_rack"),
+            ("container", "tube_findme_1"),
+            ("individual", "findme"),
+            ("sample", "sample_findme_01"),
+            ("user", "findme_user"),
+        ])
+        scores = [r["score"] for r in response.data]
+        self.assertListEqual(scores, sorted(scores, reverse=True))
+        self.assertEqual(response.data[0]["item"]["name"], "findme")
+
+        with patch.object(QueryViewSet, "search_limit", 2):
+            self.assertEqual(len(self.client.get("/api/query/search/", {"q": "findme"}).data), 2)
+
+        # Objects are scored if they contain every character of the search term, in order
+        self.assertIn(("individual", "findme"), [
+            (r["type"], r["item"].get("name")) for r in self.client.get("/api/query/search/", {"q": "fndme"}).data])
+        self.assertIn(("individual", "findme"), [
+            (r["type"], r["item"].get("name")) for r in self.client.get("/api/query/search/", {"q": "fm"}).data])
+        self.assertListEqual(self.client.get("/api/query/search/", {"q": "fdnme"}).data, [])
+
+        # Search terms are passed as query parameters
+        self.assertListEqual(self.client.get("/api/query/search/", {"q": "'); DROP TABLE x; --"}).data, [])
+
+    def test_search_candidates(self):
+        def rank(q):
+            return QueryViewSet()._rank_with_fzy(q)
+
+        def unfiltered_rank(q):
+            with patch.object(QueryViewSet, "get_search_candidates", lambda _self, _q, _fields: [Q()]):
+                return rank(q)
+
+        # Looking up candidates doesn't change the top results: substrings, short prefixes, then scattered matches
+        for q in ("findme", "FINDME", "rack", "fndme", "fm"):
+            self.assertCountEqual(rank(q), unfiltered_rank(q), q)
+        with patch.object(QueryViewSet, "search_limit", 3):
+            self.assertCountEqual(rank("fi"), unfiltered_rank("fi"))
+
+        # Substrings are looked up in the trigram indexes, which compare UPPER(<field>::text)
+        with CaptureQueriesContext(connection) as queries:
+            rank("findme")
+        self.assertEqual(len(queries.captured_queries), 1)
+        self.assertIn('UPPER("fms_core_sample"."name"::text) LIKE UPPER(', queries.captured_queries[0]["sql"])
+
+    @patch("fms_core.viewsets.fzy_installed", lambda: False)
+    def test_search_without_fzy(self):
+        def search(q):
+            return [(r["type"], r["item"].get("name", r["item"].get("username")))
+                    for r in self.client.get("/api/query/search/", {"q": q}).data]
+
+        results = search("findme")
+        self.assertEqual(results[0], ("individual", "findme"))
+        self.assertCountEqual(results, [
+            ("container", "findme_rack"),
+            ("container", "tube_findme_1"),
+            ("individual", "findme"),
+            ("sample", "sample_findme_01"),
+            ("user", "findme_user"),
+        ])
+
+        # Barcodes are indexed, typos are tolerated and short queries are matched as substrings
+        self.assertEqual(search("T123456")[0], ("container", "tube_findme_1"))
+        self.assertEqual(search("fndme")[0], ("individual", "findme"))
+        self.assertIn(("sample", "sample_findme_01"), search("_0"))
+
+        # The index is kept in sync with the database, by reading back what changed
+        with patch("fms_core.search_index._build", wraps=search_index._build) as build:
+            with reversion.create_revision():
+                individual = Individual.objects.get(name="findme")
+                individual.name = "renamed"
+                individual.save()
+            self.assertEqual(search("renamed"), [("individual", "renamed")])
+            self.assertNotIn(("individual", "findme"), search("findme"))
+
+            Sample.objects.filter(name="sample_findme_01").delete()
+            self.assertNotIn(("sample", "sample_findme_01"), search("findme"))
+            User.objects.create_user("findme_too")
+            self.assertIn(("user", "findme_too"), search("findme"))
+            build.assert_not_called()
+
+        self.assertListEqual(search("zzzzzz"), [])
+
+
+class TypedSearchTestCase(TestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+        self.rack = Container.objects.create(**create_container(barcode="R123456", name="rack_tubes"))
+        self.tubes = [Container.objects.create(**create_container(
+            barcode=f"T12345{i}", name=f"tube_{i}", kind="tube", location=self.rack, coordinates=f"A0{i}"))
+            for i in (1, 2)]
+        individual = Individual.objects.create(**create_individual(individual_name="jdoe"))
+        sample_kind, _ = SampleKind.objects.get_or_create(name="BLOOD")
+        self.sample = Sample.objects.create(**create_sample(
+            sample_kind, individual, self.tubes[0], name="sample_01", alias="first_sample"))
+
+    def search(self, path: str, q: str, **params) -> List[int]:
+        response = self.client.get(f"/api/{path}/search/", {"q": q, **params})
+        self.assertEqual(response.status_code, 200)
+        return sorted(r["id"] for r in response.data["results"])
+
+    def test_containers(self):
+        tube_ids = sorted(t.id for t in self.tubes)
+
+        self.assertListEqual(self.search("containers", str(self.rack.id)), [self.rack.id])
+        self.assertListEqual(self.search("containers", "T123452"), [self.tubes[1].id])
+        self.assertListEqual(self.search("containers", " tube_1 "), [self.tubes[0].id])
+        self.assertListEqual(self.search("containers", "TUBE"), tube_ids)  # Names starting with it only
+        self.assertListEqual(self.search("containers", "tubes"), [self.rack.id])  # Then names containing it
+        self.assertListEqual(self.search("containers", "tube", parent="true"), [self.rack.id])
+        self.assertListEqual(self.search("containers", "nothing"), [])
+        self.assertEqual(len(self.search("containers", "")), 3)
+
+        # Numbers match primary keys and barcodes together
+        numbered = Container.objects.create(**create_container(barcode=str(self.rack.id), name="numbered_rack"))
+        self.assertListEqual(self.search("containers", str(self.rack.id)), sorted((self.rack.id, numbered.id)))
+
+        # Primary keys are never compared as text
+        with CaptureQueriesContext(connection) as queries:
+            self.search("containers", str(self.rack.id)[:1])
+        self.assertFalse(any('"id"::text' in q["sql"] for q in queries.captured_queries))
+
+    def test_samples_and_individuals(self):
+        self.assertListEqual(self.search("samples", str(self.sample.id)), [self.sample.id])
+        self.assertListEqual(self.search("samples", "sample"), [self.sample.id])
+        self.assertListEqual(self.search("samples", "first"), [self.sample.id])  # Aliases are only searched last
+        self.assertListEqual(self.search("samples", "SAMPLE_01"), [self.sample.id])
+
+        # Numbers match primary keys and names together
+        numbered = Sample.objects.create(**create_sample(
+            self.sample.sample_kind, self.sample.individual, self.tubes[1], name=str(self.sample.id)))
+        self.assertListEqual(self.search("samples", str(self.sample.id)), sorted((self.sample.id, numbered.id)))
+
+        individual_id = self.sample.individual_id
+        self.assertListEqual(self.search("individuals", "jdoe"), [individual_id])
+        self.assertListEqual(self.search("individuals", "DOE"), [individual_id])
+        self.assertListEqual(self.search("individuals", str(individual_id)), [individual_id])
+
+    def test_autocomplete(self):
+        def autocomplete(path: str, q: str, **params):
+            response = self.client.get(f"/api/{path}/autocomplete/", {"q": q, **params})
+            self.assertEqual(response.status_code, 200)
+            return [r["name"] for r in response.data]
+
+        self.assertListEqual(autocomplete("containers", "TUBE"), ["tube_1", "tube_2"])
+        self.assertListEqual(autocomplete("containers", "t123452"), ["tube_2"])  # Barcodes too
+        self.assertListEqual(autocomplete("containers", "tube", limit="1"), ["tube_1"])
+        self.assertListEqual(autocomplete("containers", "t1"), ["tube_1", "tube_2"])
+        self.assertListEqual(autocomplete("containers", "t1", parent="true"), [])
+        self.assertListEqual(autocomplete("containers", "r1", parent="true"), ["rack_tubes"])
+        self.assertListEqual(autocomplete("containers", "ube"), [])
+        self.assertListEqual(autocomplete("containers", ""), [])
+        self.assertEqual(self.client.get("/api/containers/autocomplete/", {"q": "t", "limit": "x"}).status_code, 400)
+
+        # Exact matches of any field come first, then prefixes of each field in turn, in index order
+        Container.objects.create(**create_container(barcode="R654321", name="tube_"))
+        Container.objects.create(**create_container(barcode="R654322", name="t1234520_rack"))
+        with CaptureQueriesContext(connection) as queries:
+            self.assertListEqual(autocomplete("containers", "tube_", limit="2"), ["tube_", "tube_1"])
+        self.assertTrue(all("USING ~<~" in q["sql"] for q in queries.captured_queries if "ORDER BY" in q["sql"]))
+        self.assertListEqual(autocomplete("containers", "t123452", limit="1"), ["tube_2"])
+        self.assertListEqual(autocomplete("containers", "t123452"), ["tube_2", "t1234520_rack"])
+        self.assertListEqual(autocomplete("containers", "R65432"), ["tube_", "t1234520_rack"])
+
+        response = self.client.get("/api/samples/autocomplete/", {"q": "sam"})
+        self.assertListEqual(response.data, [
+            {"id": self.sample.id, "name": "sample_01", "alias": "first_sample", "container": self.tubes[0].id}])
+        self.assertListEqual(autocomplete("individuals", "J"), ["jdoe"])
+
+
+class CursorPaginationTestCase(TestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+        rack = Container.objects.create(**create_container(barcode="R1", name="rack1"))
+        Container.objects.create(**create_container(barcode="R2", name="rack2"))
+        for i, comment in enumerate(("b", "a", "b", "a", "a")):
+            Container.objects.create(**{
+                **create_container(barcode=f"T{i}", location=rack, coordinates=f"A0{i + 1}", kind="tube",
+                                   name=f"tube{i}"),
+                "comment": comment,
+            })
+
+    def walk(self, url: str, key: str) -> List[List[int]]:
+        pages = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn("count", response.data)
+            pages.append([c["id"] for c in response.data["results"]])
+            url = response.data[key]
+        return pages
+
+    def test_cursor_pagination(self):
+        for ordering, expected_ordering in (
+            ("", ("pk",)),
+            ("-id", ("-pk",)),
+            ("comment", ("comment", "pk")),
+            ("-comment", ("-comment", "pk")),
+            ("location", (F("location").asc(nulls_last=True), "pk")),
+            ("-location", (F("location").desc(nulls_first=True), "pk")),
+            ("location,-comment", (F("location").asc(nulls_last=True), "-comment", "pk")),
+        ):
+            expected = list(Container.objects.order_by(*expected_ordering).values_list("id", flat=True))
+
+            pages = self.walk(f"/api/containers/?cursor=&limit=2&ordering={ordering}", "next")
+            self.assertListEqual([len(p) for p in pages], [2, 2, 2, 1])
+            self.assertListEqual([i for p in pages for i in p], expected)
+
+            # Walking back from the last page gives the same pages
+            last = self.client.get(f"/api/containers/?cursor=&limit=2&ordering={ordering}")
+            while last.data["next"]:
+                last = self.client.get(last.data["next"])
+            self.assertListEqual(self.walk(last.data["previous"], "previous")[::-1], pages[:-1])
+
+    def test_cursor_pagination_count(self):
+        response = self.client.get("/api/containers/?cursor=&count=true&limit=2")
+        self.assertEqual(response.data["count"], 7)
+        self.assertEqual(len(response.data["results"]), 2)
+
+        # Limit/offset pagination stays the default
+        response = self.client.get("/api/containers/?limit=2&offset=2")
+        self.assertEqual(response.data["count"], 7)
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get("/api/containers/?cursor=abc").status_code, 404)
+
+
+class ListExportTestCase(TestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+        load_samples()
+
+    def test_streaming_export(self):
+        for url, serializer_class, queryset, viewset_class in (
+            ("/api/containers/list_export/", ContainerExportSerializer, Container.objects.all(), ContainerViewSet),
+            ("/api/samples/list_export/", SampleExportSerializer, Sample.objects.all(), SampleViewSet),
+            ("/api/individuals/list_export/", IndividualSerializer, Individual.objects.all(), IndividualViewSet),
+        ):
+            data = serializer_class(queryset.order_by("pk"), many=True).data
+
+            # Export CSVs are the same as the ones previously rendered from the whole list of objects
+            viewset = viewset_class(action="list_export", request=None, format_kwarg=None)
+            expected = CSVRenderer().render(data, renderer_context=viewset.get_renderer_context())
+
+            with patch.object(exports, "EXPORT_CHUNK_SIZE", 2):
+                response = self.client.get(url, {"format": "csv", "ordering": "id"})
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.streaming)
+            self.assertEqual(b"".join(response.streaming_content), expected)
+
+            response = self.client.get(url, {"format": "ndjson", "ordering": "id"})
+            self.assertTrue(response.streaming)
+            self.assertEqual(response["Content-Type"], "application/x-ndjson; charset=utf-8")
+            self.assertListEqual(
+                [json.loads(line) for line in b"".join(response.streaming_content).decode("utf-8").splitlines()],
+                json.loads(JSONRenderer().render(data)))
+
+            # Other formats are rendered as before
+            response = self.client.get(url, {"format": "json", "ordering": "id"})
+            self.assertFalse(response.streaming)
+            self.assertEqual(response.content, JSONRenderer().render(data))
+
+    def test_sample_export_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/samples/list_export/", {"format": "csv"})
+            content = b"".join(response.streaming_content)
+
+        # All columns, including parents and locations, are fetched with a single query
+        self.assertEqual(len(queries), 1)
+        self.assertIn(b"box001", content)
+        self.assertIn(b"David Lougheed", content)
+
+
+class ContainerHierarchyTestCase(TestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+        self.containers = {}
+        location = None
+        for barcode, kind, coordinates in (
+            ("room1", "room", ""),
+            ("freezer1", "freezer 3 shelves", ""),
+            ("frack1", "freezer rack 4x4", "A01"),
+            ("box1", "tube box 6x6", "A01"),
+            ("tube1", "tube", "A01"),
+        ):
+            location = Container.objects.create(**create_container(
+                barcode=barcode, name=barcode, kind=kind, location=location, coordinates=coordinates))
+            self.containers[barcode] = location
+
+        self.containers["tube2"] = Container.objects.create(**create_container(
+            barcode="tube2", name="tube2", kind="tube", location=self.containers["box1"], coordinates="A02"))
+        self.containers["tube3"] = Container.objects.create(**create_container(
+            barcode="tube3", name="tube3", kind="tube"))
+
+        individual = Individual.objects.create(**create_individual(individual_name="jdoe"))
+        sample_kind, _ = SampleKind.objects.get_or_create(name="BLOOD")
+        self.samples = {
+            barcode: Sample.objects.create(**create_sample(
+                sample_kind, individual, self.containers[barcode], name=f"sample_{barcode}"))
+            for barcode in ("tube1", "tube2", "tube3")
+        }
+
+    def get_barcodes(self, url: str, params: dict = None) -> List[str]:
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        barcodes_by_id = {c.id: barcode for barcode, c in self.containers.items()}
+        containers = response.data["results"] if "results" in response.data else response.data
+        return [barcodes_by_id[c["id"]] for c in containers]
+
+    def test_list_parents(self):
+        tube1 = self.containers["tube1"]
+        with self.assertNumQueries(3):  # Ancestors, then their children and samples
+            self.assertListEqual(self.get_barcodes(f"/api/containers/{tube1.id}/list_parents/"),
+                                 ["room1", "freezer1", "frack1", "box1"])
+
+        self.assertListEqual(self.get_barcodes(f"/api/containers/{self.containers['room1'].id}/list_parents/"), [])
+        self.assertEqual(self.client.get("/api/containers/0/list_parents/").status_code, 404)
+
+    def test_subtree(self):
+        freezer1 = self.containers["freezer1"]
+        url = f"/api/containers/{freezer1.id}/subtree/"
+        self.assertSetEqual(set(self.get_barcodes(url)), {"frack1", "box1", "tube1", "tube2"})
+        self.assertSetEqual(set(self.get_barcodes(url, {"depth": "1"})), {"frack1"})
+        self.assertSetEqual(set(self.get_barcodes(url, {"depth": "2"})), {"frack1", "box1"})
+        self.assertSetEqual(set(self.get_barcodes(url, {"depth": "2", "kind": "tube box 6x6"})), {"box1"})
+        self.assertListEqual(self.get_barcodes(url, {"depth": "0"}), [])
+        self.assertEqual(self.client.get(url, {"depth": "-1"}).status_code, 400)
+
+    def test_subtree_samples(self):
+        def get_samples(container: str, params: dict = None):
+            response = self.client.get(f"/api/containers/{self.containers[container].id}/subtree_samples/", params)
+            self.assertEqual(response.status_code, 200)
+            return {s["name"] for s in response.data["results"]}
+
+        self.assertSetEqual(get_samples("room1"), {"sample_tube1", "sample_tube2"})
+        self.assertSetEqual(get_samples("box1", {"depth": "1"}), {"sample_tube1", "sample_tube2"})
+        self.assertSetEqual(get_samples("box1", {"depth": "0"}), set())
+        self.assertSetEqual(get_samples("tube1", {"depth": "0"}), {"sample_tube1"})
+        self.assertSetEqual(get_samples("freezer1", {"depth": "2"}), set())
+
+    def test_counts(self):
+        box1, tube1, tube2 = (self.containers[b] for b in ("box1", "tube1", "tube2"))
+
+        with self.assertNumQueries(3):  # Conditional GET validators, then the container with its counts
+            response = self.client.get(f"/api/containers/{box1.id}/", {"counts": "true"})
+        self.assertEqual(response.data["children_count"], 2)
+        self.assertEqual(response.data["samples_count"], 0)
+        self.assertNotIn("children", response.data)
+        self.assertNotIn("ancestors", response.data)  # The hierarchy index stays internal
+
+        response = self.client.get("/api/containers/", {"counts": "true", "ids_limit": "1", "id__in": box1.id})
+        self.assertEqual(response.data["results"][0]["children"], [tube1.id])
+
+        with self.assertNumQueries(1):
+            response = self.client.get(f"/api/containers/{box1.id}/list_children/", {
+                "counts": "true", "ids_limit": "5"})
+        self.assertListEqual([(c["samples_count"], c["samples"]) for c in response.data], [
+            (1, [self.samples["tube1"].id]),
+            (1, [self.samples["tube2"].id]),
+        ])
+
+        # Full ID lists are still the default
+        response = self.client.get(f"/api/containers/{box1.id}/")
+        self.assertListEqual(sorted(response.data["children"]), [tube1.id, tube2.id])
+        self.assertNotIn("children_count", response.data)
+        self.assertNotIn("ancestors", response.data)
+
+        self.assertEqual(self.client.get("/api/containers/", {"counts": "true", "ids_limit": "x"}).status_code, 400)
+
+    def test_ancestor_filter(self):
+        room1 = self.containers["room1"]
+        self.assertSetEqual(set(self.get_barcodes("/api/containers/", {"ancestor": room1.id})),
+                            {"freezer1", "frack1", "box1", "tube1", "tube2"})
+        self.assertSetEqual(set(self.get_barcodes("/api/containers/", {"ancestor": room1.id, "kind": "tube"})),
+                            {"tube1", "tube2"})
+
+        response = self.client.get("/api/samples/", {"ancestor": self.containers["box1"].id})
+        self.assertSetEqual({s["name"] for s in response.data["results"]}, {"sample_tube1", "sample_tube2"})
+        response = self.client.get("/api/samples/", {"ancestor": self.containers["tube3"].id})
+        self.assertSetEqual({s["name"] for s in response.data["results"]}, {"sample_tube3"})
+
+        self.assertEqual(self.client.get("/api/samples/", {"ancestor": "abc"}).status_code, 400)
+
+    def test_resolve_barcodes(self):
+        with self.assertNumQueries(4):  # Containers with their ancestors and their samples, within a savepoint
+            response = self.client.post("/api/containers/resolve_barcodes/", {
+                "barcodes": ["tube2", "unknown1", " tube1", "box1", "tube2", "tube3"],
+            }, format="json")
+        self.assertEqual(response.status_code, 200)
+
+        self.assertListEqual([c["barcode"] for c in response.data["containers"]], ["tube2", "tube1", "box1", "tube3"])
+        self.assertListEqual([[s["name"] for s in c["samples"]] for c in response.data["containers"]],
+                             [["sample_tube2"], ["sample_tube1"], [], ["sample_tube3"]])
+        self.assertListEqual([c["barcode"] for c in response.data["ancestors"]],
+                             ["room1", "freezer1", "frack1", "box1"])
+        self.assertListEqual(response.data["unknown"], ["unknown1"])
+        self.assertNotIn("ancestors", response.data["containers"][0])
+        self.assertNotIn("ancestors", response.data["ancestors"][0])
+
+        for barcodes in ("tube1", [1], ["tube1"] * (ContainerViewSet.resolve_barcodes_limit + 1)):
+            response = self.client.post("/api/containers/resolve_barcodes/", {"barcodes": barcodes}, format="json")
+            self.assertEqual(response.status_code, 400)
+
+
+class SummaryTestCase(TestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def test_sample_summary(self):
+        self.assertDictEqual(self.client.get("/api/samples/summary/").data, {
+            "total_count": 0,
+            "extracted_count": 0,
+            "kinds_counts": {},
+            "tissue_source_counts": {},
+            "collection_site_counts": {},
+            "experimental_group_counts": {},
+        })
+
+        load_samples()
+
+        experimental_groups = Counter()
+        for eg in Sample.objects.values_list("experimental_group", flat=True):
+            experimental_groups.update(eg)
+
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/samples/summary/")
+
+        self.assertDictEqual(response.data, {
+            "total_count": Sample.objects.count(),
+            "extracted_count": Sample.objects.filter(extracted_from__isnull=False).count(),
+            "kinds_counts": {
+                k.name: k.sample_set.count() for k in SampleKind.objects.all() if k.sample_set.exists()
+            },
+            "tissue_source_counts": Counter(Sample.objects.values_list("tissue_source", flat=True)),
+            "collection_site_counts": Counter(Sample.objects.values_list("collection_site", flat=True)),
+            "experimental_group_counts": dict(experimental_groups),
+        })
+        self.assertEqual(response.data["extracted_count"], 2)
@@ -0,0 +1,133 @@
+"""
+Search actions which pick the most specific indexed lookup a query can be
+answered with, instead of scanning every object for the query as a substring,
+and prefix autocompletion.
+"""
+
+from django.db.models import OrderBy, Q, TextField
+from django.db.models.functions import Cast, Upper
+from functools import reduce
+from operator import or_
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+from typing import List, Tuple
+
+from .utils import str_normalize
+
+
+__all__ = [
+    "TypedSearchMixin",
+    "AutocompleteMixin",
+]
+
+
+def _any_of(lookup: str, fields: Tuple[str, ...], value) -> List[Q]:
+    return [reduce(or_, (Q(**{f"{f}{lookup}": value}) for f in fields))] if fields else []
+
+
+class TypedSearchMixin:
+    """
+    Searches objects with, in order:
+     - exact matches: objects with exact values of exact_search_fields (e.g.
+       unique barcodes and names, or other lookups such as name__iexact),
+       along with the object with the query as primary key, for whole numbers;
+     - prefix matches of prefix_search_fields;
+     - substring matches of contains_search_fields.
+    Only the first kind of match finding anything is returned. Exact and
+    prefix matches are answered from indexes (unique, and trigram indexes on
+    names, which also serve case-insensitive prefixes).
+    """
+
+    exact_search_fields: Tuple[str, ...] = ()
+    prefix_search_fields: Tuple[str, ...] = ()
+    contains_search_fields: Tuple[str, ...] = ()
+
+    def get_search_lookups(self, search_input: str) -> List[Q]:
+        # A number can be a primary key as well as a name or barcode, so they're all matched together
+        exact = [Q(**{f: search_input}) for f in self.exact_search_fields]
+        if search_input.isdigit():
+            exact.append(Q(pk=int(search_input)))
+
+        return [
+            *([reduce(or_, exact)] if exact else []),
+            *_any_of("__istartswith", self.prefix_search_fields, search_input),
+            *_any_of("__icontains", self.contains_search_fields, search_input),
+        ]
+
+    def search_queryset(self, queryset, search_input: str):
+        search_input = str_normalize(search_input or "")
+        if not search_input:
+            return queryset
+
+        *lookups, fallback = self.get_search_lookups(search_input)
+        for lookup in lookups:
+            matches = queryset.filter(lookup)
+            if matches.exists():
+                return matches
+
+        return queryset.filter(fallback)
+
+
+class _PatternOrder(OrderBy):
+    # Orders case-insensitively, character by character like text_pattern_ops
+    # indexes on UPPER(<field>::text) do, so that matches are read from them in
+    # order. ASC can't follow USING, but Django expects it in ordering clauses,
+    # hence the comment.
+    template = "%(expression)s USING ~<~ /* %(ordering)s */"
+
+    def __init__(self, field: str):
+        super().__init__(Upper(Cast(field, output_field=TextField())))
+
+
+class AutocompleteMixin:
+    """
+    Adds an autocomplete action, listing the autocomplete_result_fields of at
+    most ?limit= objects with one of autocomplete_search_fields equal to or
+    starting with ?q= (case-insensitively). Exact matches of any search field
+    come first, then objects starting with ?q=, by search field in order, each
+    in the order of the field. Each search field needs a text_pattern_ops index
+    on UPPER(<field>::text), for matches to be read from the index in order.
+    """
+
+    autocomplete_search_fields: Tuple[str, ...] = ("name",)
+    autocomplete_result_fields: Tuple[str, ...] = ("id", "name")
+    autocomplete_default_limit = 10
+    autocomplete_max_limit = 100
+
+    def get_autocomplete_queryset(self):
+        return self.queryset.model.objects.all()
+
+    @action(detail=False, methods=["get"])
+    def autocomplete(self, request):
+        """
+        Lists the objects whose name (or other searched fields) starts with
+        ?q=, up to ?limit= of them.
+        """
+
+        limit = request.query_params.get("limit", "")
+        if limit and not limit.isdigit():
+            raise ValidationError({"limit": ["Enter a whole number."]})
+        limit = min(int(limit) if limit else self.autocomplete_default_limit, self.autocomplete_max_limit)
+
+        prefix = str_normalize(request.query_params.get("q", ""))
+        if not prefix or not limit:
+            return Response([])
+
+        fields = self.autocomplete_search_fields
+        tiers = [
+            (*_any_of("__iexact", fields, prefix), fields[0]),
+            *((Q(**{f"{f}__istartswith": prefix}), f) for f in fields),
+        ]
+
+        queryset = self.get_autocomplete_queryset()
+        results, seen = [], set()
+        for lookup, ordering in tiers:
+            matches = queryset.filter(lookup).exclude(pk__in=seen).order_by(_PatternOrder(ordering), "pk")
+            for result in matches.values("pk", *self.autocomplete_result_fields)[:limit - len(results)]:
+                seen.add(result.pop("pk"))
+                results.append(result)
+            if len(results) == limit:
+                break
+
+        return Response(results)
@@ -1,21 +1,45 @@
 import json
+import re
 
-from collections import Counter
+from datetime import timedelta
 from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import UploadedFile
 from django.contrib.auth.models import User, Group
-from django.db.models import Count, Q, Func, F
+from django.db.models import Q, Func, F, FloatField, IntegerField, Value
 from django.db.models.functions import Greatest
 from django.http.response import HttpResponseNotFound, HttpResponseBadRequest
+from django.utils import timezone
+from django.utils.functional import cached_property
+from functools import reduce
+from operator import or_
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import AllowAny, IsAuthenticated, DjangoModelPermissions
 from rest_framework.response import Response
 from reversion.models import Version
 from tablib import Dataset
-from typing import Any, Dict, List, Tuple, Union
-
+from typing import Any, Dict, List, Optional, Tuple, Union
+from uuid import uuid4
+
+from . import template_jobs
+from .conditional import ConditionalGetMixin
+from .container_hierarchy import (
+    annotate_container_counts,
+    container_descendants_q,
+    sample_descendants_q,
+    get_container_ancestors,
+    get_containers_by_barcode,
+    get_container_subtree,
+    get_container_subtree_samples,
+)
 from .containers import ContainerSpec, CONTAINER_KIND_SPECS, PARENT_CONTAINER_KINDS, SAMPLE_CONTAINER_KINDS
-from .models import Container, Sample, Individual, SampleKind
+from .exports import EXPORT_RENDERER_CLASSES, is_streaming_export, stream_export
+from .fieldsets import SparseFieldsetMixin
+from .filters import ANCESTOR_FILTER_BACKENDS
+from .models import Container, Sample, Individual, SampleKind, TemplateImportJob
+from .pagination import LimitOffsetOrCursorPagination
 from .resources import (
     ContainerResource,
     ContainerMoveResource,
@@ -26,16 +50,21 @@ from .resources import (
 )
 from .serializers import (
     ContainerSerializer,
+    ContainerCountsSerializer,
     ContainerExportSerializer,
+    SimpleContainerSerializer,
     SampleKindSerializer,
     SampleSerializer,
     SampleExportSerializer,
     NestedSampleSerializer,
     IndividualSerializer,
+    TemplateImportJobSerializer,
     VersionSerializer,
     UserSerializer,
     GroupSerializer,
 )
+from .search_index import fzy_installed, get_search_index
+from .summaries import get_container_summary, get_sample_summary
 from .template_paths import (
     CONTAINER_CREATION_TEMPLATE,
     CONTAINER_MOVE_TEMPLATE,
@@ -44,6 +73,9 @@ from .template_paths import (
     SAMPLE_SUBMISSION_TEMPLATE,
     SAMPLE_UPDATE_TEMPLATE,
 )
+from .template_reader import TemplateDataset, TemplateReadError, hash_template, read_template, write_template
+from .typed_search import AutocompleteMixin, TypedSearchMixin
+from .utils import str_normalize
 
 __all__ = [
     "ContainerKindViewSet",
@@ -52,6 +84,7 @@ __all__ = [
     "QueryViewSet",
     "SampleViewSet",
     "SampleKindViewSet",
+    "TemplateImportJobViewSet",
     "UserViewSet",
     "GroupViewSet",
     "VersionViewSet",
@@ -95,19 +128,15 @@ class TemplateActionsMixin:
     template_action_list = []
 
     @classmethod
-    def _get_action(cls, request) -> Tuple[bool, Union[str, Tuple[dict, Dataset]]]:
+    def _get_action_file(cls, request) -> Tuple[bool, Union[str, Tuple[dict, UploadedFile]]]:
         """
-        Gets template action from request data. Requests should be
-        multipart/form-data, with two key-value pairs:
+        Gets template action and uploaded template file from request data,
+        without reading the file. Requests should be multipart/form-data,
+        with two key-value pairs:
             action: index of the template action (based on the list provided by template_actions/)
             template: completed template file with data
-        Returns a tuple of:
-            bool
-                True if an error occurred, False if the request was processed
-                to the point of reading the file into a dataset.
-            Union[str, Tuple[dict, Dataset]]
-                str if an error occured, where the string is the error message.
-                Dataset otherwise, with the contents of the uploaded file.
+        Returns a tuple in the same format as _get_action, with the uploaded
+        file instead of a dataset.
         """
 
         action_id = request.POST.get("action")
@@ -118,20 +147,77 @@ class TemplateActionsMixin:
 
         try:
             action_def = cls.template_action_list[int(action_id)]
-        except (KeyError, ValueError):
+        except (IndexError, ValueError):
             # If the action index is out of bounds or not int-castable, return an error.
             return True, f"Action {action_id} not found"
 
+        return False, (action_def, template_file)
+
+    @classmethod
+    def _get_action(cls, request) -> Tuple[bool, Union[str, Tuple[dict, Dataset]]]:
+        """
+        Gets template action from request data, and reads the uploaded
+        template file into a dataset; see _get_action_file.
+        Returns a tuple of:
+            bool
+                True if an error occurred, False if the request was processed
+                to the point of reading the file into a dataset.
+            Union[str, Tuple[dict, Dataset]]
+                str if an error occured, where the string is the error message.
+                Dataset otherwise, with the contents of the uploaded file.
+        """
+
+        error, action_file = cls._get_action_file(request)
+        if error:
+            return error, action_file
+
+        action_def, template_file = action_file
+
         # There are only two file types accepted; .xlsx and .csv. XLSX files
-        # must be treated differently since it's binary data.
+        # must be treated differently since it's binary data. The file is
+        # streamed into the dataset, skipping the template's preamble.
 
         xlsx = template_file.name.endswith("xlsx")
-        file_bytes = template_file.read()
 
-        dataset = Dataset().load(file_bytes if xlsx else file_bytes.decode("utf-8"), format="xlsx" if xlsx else "csv")
+        try:
+            dataset = read_template(template_file, xlsx, preamble_rows=action_def["resource"].preamble_rows,
+                                    max_rows=settings.TEMPLATE_MAX_ROWS)
+        except TemplateReadError as e:
+            return True, str(e)
 
         return False, (action_def, dataset)
 
+    @classmethod
+    def _get_checked_action(cls, request, token: str) -> Tuple[bool, Union[str, Tuple[dict, TemplateImportJob]]]:
+        """
+        Gets a template action from the result of a previous successful
+        template check, identified by the token it returned, instead of
+        reading the uploaded file again. If the template file is sent along
+        with the token, it must be the same file which was checked.
+        Returns a tuple in the same format as _get_action, with the checked
+        template's job instead of a dataset.
+        """
+
+        checked = TemplateImportJob.objects.filter(
+            token=token,
+            status=TemplateImportJob.STATUS_CHECKED,
+            viewset=cls.__name__,
+            created_by=request.user.pk,
+            created_at__gte=timezone.now() - timedelta(seconds=settings.TEMPLATE_CHECK_TOKEN_TTL),
+        ).first()
+
+        if checked is None:
+            return True, "Template check not found or expired"
+
+        if str(checked.action) != request.POST.get("action"):
+            return True, f"Template check was done for action {checked.action}"
+
+        template_file = request.FILES.get("template")
+        if template_file is not None and hash_template(template_file) != checked.template_hash:
+            return True, "Template file does not match the checked template"
+
+        return False, (cls.template_action_list[checked.action], checked)
+
     @action(detail=False, methods=["get"])
     def template_actions(self, request):
         """
@@ -148,6 +234,10 @@ class TemplateActionsMixin:
         """
         Checks a template submission without saving any of the data to the
         database. Used to check for errors prior to final submission.
+        If the template is valid, a token is returned which can be passed to
+        template_submit instead of sending and parsing the file again. The
+        checked template is stored with the token in the database, so any
+        server process (or the template job worker) can use it.
         """
 
         error, action_data = self._get_action(request)
@@ -156,11 +246,44 @@ class TemplateActionsMixin:
 
         action_def, dataset = action_data
 
+        # Rows are kept as parsed: importing adds columns to the dataset
+        # (e.g. the IDs resolved by SampleUpdateResource.before_import), which
+        # the import at submission adds again.
+        headers, rows = list(dataset.headers), dataset[:]
+
         resource_instance = action_def["resource"]()
         result = resource_instance.import_data(dataset, dry_run=True)
 
+        valid = not (result.has_errors() or result.has_validation_errors())
+        token = None
+
+        if valid:
+            # Only the parsed rows are kept for submission, not the dry run's
+            # result: nothing it did can be committed, so submitting imports
+            # the rows again. Resources resolve references and derive related
+            # objects (volume histories, extracted samples, container
+            # hierarchies) in their import hooks, so replaying a plan would
+            # need a second code path for each of them. Those lookups are done
+            # in bulk, so importing again only costs a few queries, and always
+            # catches changes made since the check.
+            template_jobs.delete_expired_checks()
+            job = TemplateImportJob(
+                viewset=self.__class__.__name__,
+                action=self.template_action_list.index(action_def),
+                preamble_skipped=True,
+                status=TemplateImportJob.STATUS_CHECKED,
+                token=uuid4().hex,
+                template_hash=hash_template(request.FILES["template"]),
+                created_by=request.user,
+            )
+            job.template.save("template.xlsx", ContentFile(write_template(TemplateDataset(*rows, headers=headers))),
+                              save=False)
+            job.save()
+            token = job.token
+
         return Response({
-            "valid": not (result.has_errors() or result.has_validation_errors()),
+            "valid": valid,
+            "token": token,
             "base_errors": [{
                 "error": str(e.error),
                 "traceback": e.traceback if settings.DEBUG else "",
@@ -182,14 +305,28 @@ class TemplateActionsMixin:
         Submits a template action. Should be done only after an initial check,
         since this endpoint does not return any helpful error messages. Will
         save any submitted data to the database unless an error occurs.
+        The token returned by template_check can be passed instead of (or along
+        with) the template file, to re-use the checked template's contents.
+        If async is set to true, the submission is queued instead and the ID of
+        the job importing it is returned; see template-jobs/ for its progress.
         """
 
-        error, action_data = self._get_action(request)
+        token = request.POST.get("token")
+
+        if request.POST.get("async", "").lower() == "true":
+            return self._queue_submission(request, token)
+
+        error, action_data = self._get_checked_action(request, token) if token else self._get_action(request)
         if error:
             return HttpResponseBadRequest(json.dumps({"detail": action_data}), content_type="application/json")
 
         action_def, dataset = action_data
 
+        if token:
+            checked = dataset
+            with checked.template.open("rb") as template_file:
+                dataset = read_template(template_file, True, preamble_rows=0, max_rows=settings.TEMPLATE_MAX_ROWS)
+
         resource_instance = action_def["resource"]()
         result = resource_instance.import_data(dataset)
 
@@ -198,8 +335,43 @@ class TemplateActionsMixin:
             return HttpResponseBadRequest(json.dumps({"detail": "Template errors encountered in submission"}),
                                           content_type="application/json")
 
+        if token:
+            # Tokens can only be used for a single submission
+            checked.template.delete(save=False)
+            checked.delete()
+
         return Response(status=204)
 
+    def _queue_submission(self, request, token: Optional[str]):
+        # Uploaded files are stored as they are and only read by the worker;
+        # checked templates are queued as they were stored by the check.
+        if token:
+            error, action_data = self._get_checked_action(request, token)
+        else:
+            error, action_data = self._get_action_file(request)
+        if error:
+            return HttpResponseBadRequest(json.dumps({"detail": action_data}), content_type="application/json")
+
+        if token:
+            _, job = action_data
+            # Tokens can only be used for a single submission
+            if not TemplateImportJob.objects.filter(pk=job.pk, status=TemplateImportJob.STATUS_CHECKED).update(
+                    status=TemplateImportJob.STATUS_QUEUED, token=""):
+                return HttpResponseBadRequest(json.dumps({"detail": "Template check not found or expired"}),
+                                              content_type="application/json")
+            return Response({"job": job.id}, status=202)
+
+        action_def, template = action_data
+        job = TemplateImportJob(
+            viewset=self.__class__.__name__,
+            action=self.template_action_list.index(action_def),
+            created_by=request.user,
+        )
+        job.template.save(template.name, template, save=False)
+        job.save()
+
+        return Response({"job": job.id}, status=202)
+
 
 def _prefix_keys(prefix: str, d: Dict[str, Any]) -> Dict[str, Any]:
     return {prefix + k: v for k, v in d.items()}
@@ -276,9 +448,38 @@ _sample_minimal_filterset_fields: FiltersetFields = {
     "name": CATEGORICAL_FILTERS_LOOSE,
 }
 
-class ContainerViewSet(viewsets.ModelViewSet, TemplateActionsMixin):
+def _get_depth_param(request) -> Tuple[bool, Optional[int]]:
+    depth = request.query_params.get("depth", "")
+    if depth == "":
+        return True, None
+    if not depth.isdigit():
+        return False, None
+    return True, int(depth)
+
+
+def _invalid_depth() -> HttpResponseBadRequest:
+    return HttpResponseBadRequest(json.dumps({"detail": "Depth must be a non-negative integer"}),
+                                  content_type="application/json")
+
+
+def _container_not_found(pk) -> HttpResponseNotFound:
+    return HttpResponseNotFound(json.dumps({"detail": f"Could not find container '{pk}'"}),
+                                content_type="application/json")
+
+
+class ContainerViewSet(ConditionalGetMixin, SparseFieldsetMixin, TypedSearchMixin, AutocompleteMixin,
+                       viewsets.ModelViewSet, TemplateActionsMixin):
     queryset = Container.objects.select_related("location").prefetch_related("children", "samples").all()
     serializer_class = ContainerSerializer
+    exact_search_fields = ("barcode", "name")
+    prefix_search_fields = ("name",)
+    contains_search_fields = ("name",)
+    autocomplete_search_fields = ("name", "barcode")
+    autocomplete_result_fields = ("id", "name", "barcode", "kind")
+    conditional_models = (Container, Sample)  # Containers list the IDs of their samples
+    pagination_class = LimitOffsetOrCursorPagination
+    filter_backends = ANCESTOR_FILTER_BACKENDS
+    ancestor_filter = staticmethod(container_descendants_q)
     filterset_fields = {
         **_container_filterset_fields,
         **_prefix_keys("location__", _container_filterset_fields),
@@ -306,6 +507,36 @@ class ContainerViewSet(viewsets.ModelViewSet, TemplateActionsMixin):
         },
     ]
 
+    # Actions listing containers which can count their children and samples
+    # with ?counts=true, instead of listing all of their IDs
+    counts_actions = ("list", "retrieve", "list_root", "list_children", "list_parents", "subtree")
+
+    # Maximum number of barcodes resolved by a single resolve_barcodes request
+    resolve_barcodes_limit = 5000
+
+    @cached_property
+    def counts_params(self) -> Tuple[bool, Optional[int]]:
+        if self.action not in self.counts_actions or self.request.query_params.get("counts") != "true":
+            return False, None
+
+        ids_limit = self.request.query_params.get("ids_limit", "")
+        if ids_limit == "":
+            return True, None
+        if not ids_limit.isdigit():
+            raise ValidationError({"ids_limit": ["Enter a whole number."]})
+        return True, int(ids_limit)
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        counts, ids_limit = self.counts_params
+        return annotate_container_counts(queryset, ids_limit) if counts else queryset
+
+    def get_serializer_class(self):
+        return ContainerCountsSerializer if self.counts_params[0] else super().get_serializer_class()
+
+    def get_serializer_context(self):
+        return {**super().get_serializer_context(), "ids_limit": self.counts_params[1]}
+
     def get_renderer_context(self):
         context = super().get_renderer_context()
         if self.action == 'list_export':
@@ -322,14 +553,7 @@ class ContainerViewSet(viewsets.ModelViewSet, TemplateActionsMixin):
         front-ends and getting quick figures without needing to download actual
         container records.
         """
-        return Response({
-            "total_count": Container.objects.all().count(),
-            "root_count": Container.objects.filter(location_id__isnull=True).count(),
-            "kind_counts": {
-                c["kind"]: c["kind__count"]
-                for c in Container.objects.values("kind").annotate(Count("kind"))
-            },
-        })
+        return Response(get_container_summary())
 
     @action(detail=False, methods=["get"])
     def list_root(self, _request):
@@ -339,7 +563,7 @@ class ContainerViewSet(viewsets.ModelViewSet, TemplateActionsMixin):
         """
 
         # TODO: Can be replaced by ?location__isnull=True query param
-        containers_data = Container.objects.filter(location_id__isnull=True).prefetch_related("children", "samples")
+        containers_data = self.get_queryset().filter(location_id__isnull=True)
         page = self.paginate_queryset(containers_data)
         if page is not None:
             serializer = self.get_serializer(page, many=True)
@@ -353,24 +577,30 @@ class ContainerViewSet(viewsets.ModelViewSet, TemplateActionsMixin):
         Searches for parent containers that match the given query
         """
         search_input = _request.GET.get("q")
-        is_parent = _request.GET.get("parent") == 'true'
-        is_sample_holding = _request.GET.get("sample_holding") == 'true'
-
-        query = Q(name__icontains=search_input)
-        query.add(Q(id__icontains=search_input), Q.OR)
-        if is_parent:
-            query.add(Q(kind__in=PARENT_CONTAINER_KINDS), Q.AND)
-        if is_sample_holding:
-            query.add(Q(kind__in=SAMPLE_CONTAINER_KINDS), Q.AND)
 
-        containers_data = Container.objects.filter(query)
+        containers_data = self.search_queryset(Container.objects.filter(self._kinds_q()), search_input)
         page = self.paginate_queryset(containers_data)
         serializer = self.get_serializer(page, many=True)
         return self.get_paginated_response(serializer.data)
 
-    @action(detail=False, methods=["get"])
-    def list_export(self, _request):
-        serializer = ContainerExportSerializer(self.filter_queryset(self.get_queryset()), many=True)
+    def _kinds_q(self) -> Q:
+        # ?parent=true and ?sample_holding=true limit searches to kinds of containers
+        query = Q()
+        if self.request.GET.get("parent") == 'true':
+            query.add(Q(kind__in=PARENT_CONTAINER_KINDS), Q.AND)
+        if self.request.GET.get("sample_holding") == 'true':
+            query.add(Q(kind__in=SAMPLE_CONTAINER_KINDS), Q.AND)
+        return query
+
+    def get_autocomplete_queryset(self):
+        return Container.objects.filter(self._kinds_q())
+
+    @action(detail=False, methods=["get"], renderer_classes=EXPORT_RENDERER_CLASSES)
+    def list_export(self, request):
+        queryset = self.filter_queryset(self.get_queryset())
+        if is_streaming_export(request):
+            return stream_export(request, queryset, ContainerExportSerializer, self.get_renderer_context())
+        serializer = ContainerExportSerializer(queryset, many=True)
         return Response(serializer.data)
 
     @action(detail=True, methods=["get"])
@@ -379,7 +609,7 @@ class ContainerViewSet(viewsets.ModelViewSet, TemplateActionsMixin):
         Lists all containers that are direct children of a specified container.
         """
         # TODO: Can be replaced by ?location=pk query param
-        serializer = self.get_serializer(Container.objects.filter(location_id=pk), many=True)
+        serializer = self.get_serializer(self.get_queryset().filter(location_id=pk), many=True)
         return Response(serializer.data)
 
     @action(detail=True, methods=["get"])
@@ -389,15 +619,53 @@ class ContainerViewSet(viewsets.ModelViewSet, TemplateActionsMixin):
         from closest-to-root to the queried container, of all the containers in
         that tree traversal.
         """
-        containers = []
-        current = Container.objects.get(pk=pk).location
-        while current:
-            containers.append(current)
-            current = current.location
-        containers.reverse()
+        containers = get_container_ancestors(int(pk), self.get_queryset()) if pk.isdigit() else None
+        if containers is None:
+            return _container_not_found(pk)
         serializer = self.get_serializer(containers, many=True)
         return Response(serializer.data)
 
+    @action(detail=True, methods=["get"])
+    def subtree(self, request, pk=None):
+        """
+        Lists all containers nested within a given container, either at any
+        depth or at most ?depth=N levels below it (1 for its direct children.)
+        """
+        valid, depth = _get_depth_param(request)
+        if not valid:
+            return _invalid_depth()
+        if not pk.isdigit():
+            return _container_not_found(pk)
+
+        containers = self.filter_queryset(get_container_subtree(int(pk), depth, self.get_queryset()))
+        page = self.paginate_queryset(containers)
+        if page is not None:
+            serializer = self.get_serializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+        serializer = self.get_serializer(containers, many=True)
+        return Response(serializer.data)
+
+    @action(detail=True, methods=["get"])
+    def subtree_samples(self, request, pk=None):
+        """
+        Lists all samples stored in a given container or in any container
+        nested within it, either at any depth or at most ?depth=N levels below
+        it (0 for the samples stored directly in the container.)
+        """
+        valid, depth = _get_depth_param(request)
+        if not valid:
+            return _invalid_depth()
+        if not pk.isdigit():
+            return _container_not_found(pk)
+
+        samples = get_container_subtree_samples(int(pk), depth)
+        page = self.paginate_queryset(samples)
+        if page is not None:
+            serializer = SampleSerializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+        serializer = SampleSerializer(samples, many=True)
+        return Response(serializer.data)
+
     @action(detail=True, methods=["get"])
     def list_samples(self, _request, pk=None):
         """
@@ -407,6 +675,42 @@ class ContainerViewSet(viewsets.ModelViewSet, TemplateActionsMixin):
         serializer = SampleSerializer(samples, many=True)
         return Response(serializer.data)
 
+    @action(detail=False, methods=["post"])
+    def resolve_barcodes(self, request):
+        """
+        Resolves a list of scanned barcodes (posted as {"barcodes": [...]}) in
+        one round trip: returns the matching containers, in the order they
+        were given, with the samples they hold, every container they are
+        nested within (see their ancestors), and the barcodes which don't
+        belong to any container.
+        """
+
+        barcodes = request.data.get("barcodes") if isinstance(request.data, dict) else None
+        if not isinstance(barcodes, list) or not all(isinstance(b, str) for b in barcodes):
+            raise ValidationError({"barcodes": ["Expected a list of barcodes."]})
+        if len(barcodes) > self.resolve_barcodes_limit:
+            raise ValidationError({"barcodes": [
+                f"At most {self.resolve_barcodes_limit} barcodes can be resolved at once."]})
+
+        barcodes = list(dict.fromkeys(str_normalize(b) for b in barcodes))
+        containers_by_barcode, ancestors = get_containers_by_barcode(barcodes)
+
+        samples_by_container = {}
+        samples = Sample.objects.filter(container_id__in=[c.id for c in containers_by_barcode.values()])
+        for sample in samples.order_by("id"):
+            samples_by_container.setdefault(sample.container_id, []).append(sample)
+
+        containers = [containers_by_barcode[b] for b in barcodes if b in containers_by_barcode]
+        return Response({
+            "containers": [{
+                **SimpleContainerSerializer(c).data,
+                "samples": SampleSerializer(samples_by_container.get(c.id, []), many=True).data,
+            } for c in containers],
+            "ancestors": SimpleContainerSerializer(
+                sorted(ancestors.values(), key=lambda c: (len(c.ancestors), c.id)), many=True).data,
+            "unknown": [b for b in barcodes if b not in containers_by_barcode],
+        })
+
     # noinspection PyUnusedLocal
     @action(detail=True, methods=["get"])
     def versions(self, request, pk=None):
@@ -423,8 +727,18 @@ class SampleKindViewSet(viewsets.ModelViewSet):
     permission_classes = [AllowAny]
 
 
-class SampleViewSet(viewsets.ModelViewSet, TemplateActionsMixin):
+class SampleViewSet(ConditionalGetMixin, SparseFieldsetMixin, TypedSearchMixin, AutocompleteMixin,
+                    viewsets.ModelViewSet, TemplateActionsMixin):
     queryset = Sample.objects.all().select_related("individual", "container", "sample_kind")
+    # Sample names aren't unique; they're matched with the index on UPPER(name)
+    exact_search_fields = ("name__iexact",)
+    prefix_search_fields = ("name",)
+    contains_search_fields = ("name", "alias")
+    autocomplete_result_fields = ("id", "name", "alias", "container")
+    conditional_models = (Sample, Container, Individual)  # Nested samples include their container and individual
+    pagination_class = LimitOffsetOrCursorPagination
+    filter_backends = ANCESTOR_FILTER_BACKENDS
+    ancestor_filter = staticmethod(sample_descendants_q)
     ordering_fields = (
         *_list_keys(_sample_filterset_fields),
     )
@@ -473,9 +787,14 @@ class SampleViewSet(viewsets.ModelViewSet, TemplateActionsMixin):
             context['labels'] = {i: i.replace('_', ' ').capitalize() for i in fields}
         return context
 
-    @action(detail=False, methods=["get"])
-    def list_export(self, _request):
-        serializer = SampleExportSerializer(self.filter_queryset(self.get_queryset()), many=True)
+    @action(detail=False, methods=["get"], renderer_classes=EXPORT_RENDERER_CLASSES)
+    def list_export(self, request):
+        queryset = self.filter_queryset(self.get_queryset()).select_related(
+            "container__location", "individual__mother", "individual__father")
+        if is_streaming_export(request):
+            return stream_export(request, queryset, SampleExportSerializer, self.get_renderer_context(),
+                                 values_fields=SampleExportSerializer.values_fields)
+        serializer = SampleExportSerializer(queryset, many=True)
         return Response(serializer.data)
 
     @action(detail=False, methods=["get"])
@@ -491,11 +810,7 @@ class SampleViewSet(viewsets.ModelViewSet, TemplateActionsMixin):
         """
         search_input = _request.GET.get("q")
 
-        query = Q(name__icontains=search_input)
-        query.add(Q(alias__icontains=search_input), Q.OR)
-        query.add(Q(id__icontains=search_input), Q.OR)
-
-        samples_data = Sample.objects.filter(query)
+        samples_data = self.search_queryset(Sample.objects.all(), search_input)
         page = self.paginate_queryset(samples_data)
         serializer = self.get_serializer(page, many=True)
         return self.get_paginated_response(serializer.data)
@@ -506,30 +821,7 @@ class SampleViewSet(viewsets.ModelViewSet, TemplateActionsMixin):
         Returns summary statistics about the current set of samples in the
         database.
         """
-
-        experimental_groups = Counter()
-        for eg in Sample.objects.values_list("experimental_group", flat=True):
-            experimental_groups.update(eg)
-
-        sample_kind_names_by_id = {sample_kind.id: sample_kind.name for sample_kind in SampleKind.objects.all()}
-
-        return Response({
-            "total_count": Sample.objects.all().count(),
-            "extracted_count": Sample.objects.filter(extracted_from_id__isnull=False).count(),
-            "kinds_counts": {
-                sample_kind_names_by_id[c["sample_kind"]]: c["sample_kind__count"]
-                for c in Sample.objects.values("sample_kind").annotate(Count("sample_kind"))
-            },
-            "tissue_source_counts": {
-                c["tissue_source"]: c["tissue_source__count"]
-                for c in Sample.objects.values("tissue_source").annotate(Count("tissue_source"))
-            },
-            "collection_site_counts": {
-                c["collection_site"]: c["collection_site__count"]
-                for c in Sample.objects.values("collection_site").annotate(Count("collection_site"))
-            },
-            "experimental_group_counts": dict(experimental_groups),
-        })
+        return Response(get_sample_summary())
 
     # noinspection PyUnusedLocal
     @action(detail=True, methods=["get"])
@@ -537,9 +829,13 @@ class SampleViewSet(viewsets.ModelViewSet, TemplateActionsMixin):
         return versions_detail(self.get_object())
 
 
-class IndividualViewSet(viewsets.ModelViewSet):
+class IndividualViewSet(SparseFieldsetMixin, TypedSearchMixin, AutocompleteMixin, viewsets.ModelViewSet):
     queryset = Individual.objects.all()
     serializer_class = IndividualSerializer
+    exact_search_fields = ("name",)
+    prefix_search_fields = ("name",)
+    contains_search_fields = ("name",)
+    pagination_class = LimitOffsetOrCursorPagination
     filterset_fields = _individual_filterset_fields
 
     # noinspection PyUnusedLocal
@@ -547,9 +843,12 @@ class IndividualViewSet(viewsets.ModelViewSet):
     def versions(self, request, pk=None):
         return versions_detail(self.get_object())
 
-    @action(detail=False, methods=["get"])
-    def list_export(self, _request):
-        serializer = IndividualSerializer(self.filter_queryset(self.get_queryset()), many=True)
+    @action(detail=False, methods=["get"], renderer_classes=EXPORT_RENDERER_CLASSES)
+    def list_export(self, request):
+        queryset = self.filter_queryset(self.get_queryset())
+        if is_streaming_export(request):
+            return stream_export(request, queryset, IndividualSerializer, self.get_renderer_context())
+        serializer = IndividualSerializer(queryset, many=True)
         return Response(serializer.data)
 
     @action(detail=False, methods=["get"])
@@ -559,29 +858,53 @@ class IndividualViewSet(viewsets.ModelViewSet):
         """
         search_input = _request.GET.get("q")
 
-        query = Q(id__icontains=search_input)
-        query.add(Q(name__icontains=search_input), Q.OR)
-
-        individuals_data = Individual.objects.filter(query)
+        individuals_data = self.search_queryset(Individual.objects.all(), search_input)
         page = self.paginate_queryset(individuals_data)
         serializer = self.get_serializer(page, many=True)
         return self.get_paginated_response(serializer.data)
 
 class FZY(Func):
-    template = "%(function)s('%(search_term)s', %(expressions)s::cstring)"
+    """
+    Fuzzy match score of a field against a search term (0 if it doesn't
+    match), from the fzy extension. The search term is passed as a query
+    parameter, never interpolated into the SQL.
+    """
+
+    template = "%(function)s(%(expressions)s::cstring)"
     function = "fzy"
+    output_field = FloatField()
 
     def __init__(self, expression, search_term, **extras):
         super(FZY, self).__init__(
+            Value(search_term),
             expression,
-            search_term=search_term,
             **extras
         )
 
+
 # noinspection PyMethodMayBeStatic,PyUnusedLocal
 class QueryViewSet(viewsets.ViewSet):
     basename = "query"
 
+    # Maximum number of results, across all types
+    search_limit = 100
+
+    # Candidates for fzy scoring are looked up, in order, as objects with a
+    # searched field containing the query (with the trigram indexes on
+    # UPPER(<field>::text)), or starting with it for queries too short to have
+    # trigrams (with the prefix indexes; users, which are few, are scanned).
+    # Only if none are found are objects containing the query's characters in
+    # order, i.e. everything fzy scores, looked for, by scanning every object.
+    search_trigram_length = 3
+
+    # Result type, objects searched, fields scored against the query, and serializer for each kind of result
+    search_types = (
+        ("container", Container.objects.prefetch_related("children", "samples"), ("name",), ContainerSerializer),
+        ("individual", Individual.objects.all(), ("name",), IndividualSerializer),
+        ("sample", Sample.objects.all(), ("name",), SampleSerializer),
+        ("user", User.objects.prefetch_related("groups"), ("username", "first_name", "last_name"), UserSerializer),
+    )
+
     @action(detail=False, methods=["get"])
     def search(self, request):
         query = request.GET.get("q")
@@ -589,56 +912,66 @@ class QueryViewSet(viewsets.ViewSet):
         if not query:
             return Response([])
 
-        def serialize(s) -> dict:
-            item_type = s["type"]
-            s["score"] = s["item"].score
-            if item_type == Container:
-                s["type"] = "container"
-                s["item"] = ContainerSerializer(s["item"]).data
-                return s
-            if item_type == Sample:
-                s["type"] = "sample"
-                s["item"] = SampleSerializer(s["item"]).data
-                return s
-            if item_type == Individual:
-                s["type"] = "individual"
-                s["item"] = IndividualSerializer(s["item"]).data
-                return s
-            if item_type == User:
-                s["type"] = "user"
-                s["item"] = UserSerializer(s["item"]).data
-                return s
-            raise ValueError("unreachable")
-
-        def query_and_score(model, fields):
-            scores = list(map(lambda f: FZY(F(f), query), fields))
-            scores = scores[0] if len(scores) == 1 else Greatest(*scores)
-            return [{
-                "type": model,
-                "item": s
-            } for s in model.objects
-                .annotate(
-                    score=scores
-                )
-                .filter(score__gt=0)
-                .order_by('-score')[:100]
-            ]
-
-        containers = query_and_score(Container, ["name"])
-        individuals = query_and_score(Individual, ["name"])
-        samples = query_and_score(Sample, ["name"])
-        users = query_and_score(User, ["username", "first_name", "last_name"])
-
-        results = containers + individuals + samples + users
-        results.sort(key=lambda c: c["item"].score, reverse=True)
-        data = map(serialize, results[:100])
-
-        return Response(data)
+        if fzy_installed():
+            results = self._rank_with_fzy(query)
+        else:
+            results = get_search_index().search(query, self.search_limit)
+
+        pks_by_type = {}
+        for search_type, pk, _ in results:
+            pks_by_type.setdefault(search_type, []).append(pk)
+        objects_by_type = {t: self.search_types_by_name[t][1].in_bulk(pks) for t, pks in pks_by_type.items()}
+
+        # Objects deleted since they were indexed are left out
+        return Response([{
+            "type": search_type,
+            "item": self.search_types_by_name[search_type][3](objects_by_type[search_type][pk]).data,
+            "score": score,
+        } for search_type, pk, score in results if pk in objects_by_type[search_type]])
+
+    @cached_property
+    def search_types_by_name(self):
+        return {search_type[0]: search_type for search_type in self.search_types}
+
+    def get_search_candidates(self, query: str, fields: Tuple[str, ...]) -> List[Q]:
+        lookup = "__icontains" if len(query) >= self.search_trigram_length else "__istartswith"
+        # fzy only scores texts containing every character of the query, in order (case-insensitively)
+        subsequence = ".*".join(re.escape(c) for c in query)
+        return [
+            reduce(or_, (Q(**{f"{f}{lookup}": query}) for f in fields)),
+            reduce(or_, (Q(**{f"{f}__iregex": subsequence}) for f in fields)),
+        ]
+
+    def _rank_with_fzy(self, query: str) -> List[Tuple[str, int, float]]:
+        # Every type is scored and ranked in a single UNION ALL query; objects
+        # are only fetched for the top results overall.
+        candidates_by_type = [self.get_search_candidates(query, fields) for _, _, fields, _ in self.search_types]
+
+        results = []
+        for tier in range(len(candidates_by_type[0])):
+            ranked = []
+            for i, (_, queryset, fields, _) in enumerate(self.search_types):
+                scores = [FZY(F(f), query) for f in fields]
+                ranked.append(queryset.model.objects
+                              .filter(candidates_by_type[i][tier])
+                              .annotate(score=scores[0] if len(scores) == 1 else Greatest(*scores),
+                                        search_type=Value(i, output_field=IntegerField()))
+                              .filter(score__gt=0)
+                              .order_by("-score")
+                              .values_list("search_type", "pk", "score")[:self.search_limit])
+
+            results = [(self.search_types[i][0], pk, score) for i, pk, score in
+                       ranked[0].union(*ranked[1:], all=True).order_by("-score")[:self.search_limit]]
+            if results:
+                break
+
+        return results
 
 
 class VersionViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = Version.objects.all().prefetch_related("content_type", "revision")
     serializer_class = VersionSerializer
+    pagination_class = LimitOffsetOrCursorPagination
     filterset_fields = {
         "object_id": FK_FILTERS,
 
@@ -653,6 +986,26 @@ class VersionViewSet(viewsets.ReadOnlyModelViewSet):
         "revision__user": ["exact"],
     }
 
+class TemplateImportJobViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    Progress and outcome of template submissions queued with async=true.
+    Users can only see their own jobs, unless they are superusers.
+    """
+
+    # Checked templates only become jobs once they are submitted
+    queryset = TemplateImportJob.objects.exclude(status=TemplateImportJob.STATUS_CHECKED).order_by("-id")
+    serializer_class = TemplateImportJobSerializer
+    filterset_fields = {
+        "status": CATEGORICAL_FILTERS,
+        "viewset": CATEGORICAL_FILTERS,
+    }
+
+    def get_queryset(self):
+        if self.request.user.is_superuser:
+            return self.queryset
+        return self.queryset.filter(created_by=self.request.user)
+
+
 class UserViewSet(viewsets.ModelViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer